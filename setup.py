@@ -19,14 +19,19 @@ setup(
     keywords='twitch plays llm',
     packages=['twitch_plays_llm'],
     install_requires=[
-        'openai',
+        'openai<1',  # The 0.x API (ChatCompletion.acreate, aiosession, openai.error)
         'twitchio',
-        'pydantic',
+        'pydantic>=2',
         'pydantic_settings',
-        'asgiref',
+        'aiohttp',
+        'fastapi',
+        'uvicorn',
+        'loguru',
     ],
     extras_require={
-        'dev': ['isort', 'blue'],
+        'dev': ['isort', 'blue', 'pytest'],
+        'tokenizer': ['tiktoken'],
+        'uvloop': ['uvloop'],
     },
     entry_points={
         'console_scripts': ['twitch-plays-llm=twitch_plays_llm.__main__:main'],
@@ -0,0 +1,66 @@
+from typing import Optional
+
+import pytest
+
+from twitchio.ext.commands.stringparser import StringParser
+
+from twitch_plays_llm.chat_queue import FakeChannel
+from twitch_plays_llm.config import config
+
+
+@pytest.fixture(autouse=True)
+def temp_paths(tmp_path, monkeypatch):
+    """Keeps the files a game writes out of the working directory"""
+    monkeypatch.setattr(config, 'image_cache_dir', str(tmp_path / 'images'))
+    monkeypatch.setattr(config, 'initial_prompt_pool_path', str(tmp_path / 'initial_prompts.json'))
+
+
+class FakeAuthor:
+    def __init__(self, name: str, is_mod: bool = False):
+        self.name = name
+        self.is_mod = is_mod
+
+
+class FakeMessage:
+    def __init__(self, content: str):
+        self.content = content
+
+
+class FakeContext:
+    """The parts of a twitchio command context used by Command.invoke and the bot"""
+
+    def __init__(self, bot, channel: str, author: FakeAuthor, content: str):
+        self.bot = bot
+        self.channel = FakeChannel(name=channel)
+        self.author = author
+        self.message = FakeMessage(content)
+        self.view = StringParser()
+        self.view.process_string(content[1:])  # After the '!' prefix
+        self.command = bot.get_command(self.view.words[0])
+        self.args = ()
+        self.kwargs = {}
+
+
+def _raise_command_error(event_name: str, *args):
+    # Command.invoke reports failures as events, which would hide them from the test
+    if event_name == 'command_error':
+        raise args[-1]
+
+
+async def send_command(
+    bot, user: str, content: str, is_mod: bool = False, channel: Optional[str] = None
+):
+    """
+    Runs a chat command through the bot as twitchio does once the message is
+    parsed, as sent in the given channel or else the first channel of the bot
+    """
+    bot.run_event = _raise_command_error
+    channel = channel or next(iter(bot.game_channels))
+    ctx = FakeContext(bot, channel, FakeAuthor(user, is_mod), content)
+    await ctx.command(ctx)
+
+
+@pytest.fixture
+def chat():
+    """Returns send_command, for sending chat commands to a bot"""
+    return send_command
@@ -0,0 +1,56 @@
+import pytest
+
+from fastapi.testclient import TestClient
+
+from twitch_plays_llm import metrics
+from twitch_plays_llm.app import app
+from twitch_plays_llm.config import config
+from twitch_plays_llm.llm_backend import FakeLlmBackend
+from twitch_plays_llm.llm_game import LlmGame
+from twitch_plays_llm.models import Proposal
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(metrics.Profiling, 'enabled', False)
+    return TestClient(app)  # Without startup, no games are created
+
+
+def test_profiling_endpoint_is_off_without_a_token(client):
+    assert client.post('/profiling?enabled=true').status_code == 404
+    assert not metrics.Profiling.enabled
+
+
+def test_profiling_endpoint_requires_the_token(client, monkeypatch):
+    monkeypatch.setattr(config, 'profiling_token', 'secret')
+    response = client.post('/profiling?enabled=true', headers={'X-Profiling-Token': 'guess'})
+    assert response.status_code == 403
+    assert client.post('/profiling?enabled=true').status_code == 403
+    assert not metrics.Profiling.enabled
+
+    response = client.post('/profiling?enabled=true', headers={'X-Profiling-Token': 'secret'})
+    assert response.status_code == 200
+    assert metrics.Profiling.enabled
+
+
+class OneGameRegistry:
+    def __init__(self, game: LlmGame):
+        self.game = game
+
+    def get(self, channel: str) -> LlmGame:
+        return self.game
+
+
+def test_proposals_are_served_as_documented(client, monkeypatch):
+    game = LlmGame(backend=FakeLlmBackend())
+    game._insert_proposal(Proposal(user='alice', message='open the brass door', vote=2))
+    monkeypatch.setattr(app.state, 'registry', OneGameRegistry(game), raising=False)
+
+    paths = client.get('/openapi.json').json()['paths']
+    for path in ('/proposals', '/channels/{channel}/proposals'):
+        response = paths[path]['get']['responses']['200']['content']['application/json']
+        assert response['schema']['items'] == {'$ref': '#/components/schemas/Proposal'}
+
+        response = client.get(path.format(channel='test'))
+        assert response.headers['content-type'] == 'application/json'
+        assert [Proposal(**proposal) for proposal in response.json()] == game.proposals
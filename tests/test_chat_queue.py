@@ -0,0 +1,144 @@
+import asyncio
+import selectors
+
+from twitch_plays_llm.chat_queue import ChatPriority, FakeChannel, OutboundChatQueue
+from twitch_plays_llm.llm_backend import FakeLlmBackend
+from twitch_plays_llm.llm_game import LlmGame
+from twitch_plays_llm.llm_twitch_bot import GameChannel, LlmTwitchBot
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class _JumpingSelector(selectors.DefaultSelector):
+    """Instead of waiting for the next timer, moves the clock forward to it"""
+
+    def __init__(self, clock: FakeClock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        if timeout:
+            self.clock.now += timeout
+            timeout = 0
+        return super().select(timeout)
+
+
+def run_with_fake_clock(test):
+    """Runs test(clock) on an event loop whose time only passes while it is idle"""
+    clock = FakeClock()
+    loop = asyncio.SelectorEventLoop(_JumpingSelector(clock))
+    loop.time = clock
+    try:
+        loop.run_until_complete(test(clock))
+    finally:
+        loop.close()
+
+
+async def drain(queue: OutboundChatQueue, channel: FakeChannel, count: int):
+    """Waits for count messages to be sent, and a minute longer for any unexpected ones"""
+    for _ in range(60000):
+        if len(channel.messages) >= count:
+            break
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(60)
+    await queue.close()
+
+
+def test_sends_at_the_token_bucket_rate():
+    async def test(clock: FakeClock):
+        channel = FakeChannel(clock=clock)
+        queue = OutboundChatQueue(channel.send, rate=0.5, burst=3, clock=clock)
+        queue.start()
+        for i in range(7):
+            queue.put(f'message {i}')
+        await drain(queue, channel, 7)
+
+        assert channel.messages == [f'message {i}' for i in range(7)]
+        # The burst goes out at once, then one message every 2 seconds
+        assert [round(t, 1) for t in channel.sent_at] == [0, 0, 0, 2, 4, 6, 8]
+
+    run_with_fake_clock(test)
+
+
+def test_higher_priorities_skip_the_line():
+    async def test(clock: FakeClock):
+        channel = FakeChannel(clock=clock)
+        queue = OutboundChatQueue(channel.send, rate=1, burst=1, clock=clock)
+        queue.start()
+        for i in range(3):
+            queue.put(f'reply {i}')
+        await asyncio.sleep(0.5)
+        queue.put('tally', priority=ChatPriority.tally)
+        queue.put('narration', priority=ChatPriority.narration)
+        await drain(queue, channel, 5)
+
+        assert channel.messages == ['reply 0', 'narration', 'reply 1', 'reply 2', 'tally']
+
+    run_with_fake_clock(test)
+
+
+def test_keyed_messages_are_coalesced():
+    async def test(clock: FakeClock):
+        channel = FakeChannel(clock=clock)
+        queue = OutboundChatQueue(channel.send, rate=10, burst=10, clock=clock)
+        queue.start()
+        votes = 0
+
+        def tally():
+            return f'{votes} votes'
+
+        for votes in range(1, 101):
+            queue.put(tally, key='tally', min_interval=5)
+            await asyncio.sleep(0.1)
+        await drain(queue, channel, 3)
+
+        # Evaluated when sent, at most once per 5 seconds
+        assert channel.messages == ['1 votes', '51 votes', '100 votes']
+        assert [round(t, 1) for t in channel.sent_at] == [0, 5, 10]
+        assert queue.coalesced == 97
+
+    run_with_fake_clock(test)
+
+
+def test_messages_waiting_too_long_are_dropped():
+    async def test(clock: FakeClock):
+        channel = FakeChannel(clock=clock)
+        queue = OutboundChatQueue(channel.send, rate=1, burst=1, max_age=2.5, clock=clock)
+        queue.start()
+        for i in range(4):
+            queue.put(f'reply {i}')
+        queue.put('narration', priority=ChatPriority.narration, max_age=None)
+        await drain(queue, channel, 3)
+
+        assert channel.messages == ['narration', 'reply 0', 'reply 1']
+        assert queue.dropped == 2
+
+    run_with_fake_clock(test)
+
+
+def test_commands_never_wait_for_the_chat(chat):
+    async def test(clock: FakeClock):
+        game = LlmGame(backend=FakeLlmBackend())
+        game_channel = GameChannel(game, channel_name='test')
+        game_channel.channel = FakeChannel(latency=1.0, clock=clock)  # A slow connection
+        queue = OutboundChatQueue(game_channel._send_now, rate=1, burst=1, clock=clock)
+        game_channel.chat_queue = queue
+        queue.start()
+        bot = LlmTwitchBot([game_channel])
+
+        for i in range(20):
+            await chat(bot, f'viewer{i}', '!points')
+        assert clock.now == 0  # All replies were queued without waiting
+        assert len(queue) >= 19
+
+        await drain(queue, game_channel.channel, 20)
+        assert len(game_channel.channel.messages) == 20
+        await game.close()
+
+    run_with_fake_clock(test)
@@ -0,0 +1,109 @@
+import asyncio
+import sys
+
+import pytest
+
+from loguru import logger
+
+from twitch_plays_llm.context_window import ContextWindow, TokenCounter
+from twitch_plays_llm.models import StoryEntry
+
+system_messages = [{'role': 'system', 'content': 'You are the narrator.'}]
+
+
+@pytest.fixture
+def counter(monkeypatch):
+    """A token counter using the approximation, as without tiktoken installed"""
+    monkeypatch.setitem(sys.modules, 'tiktoken', None)  # Makes the import fail
+    return TokenCounter()
+
+
+@pytest.fixture
+def warnings():
+    messages = []
+    handler = logger.add(messages.append, level='WARNING', format='{message}')
+    yield messages
+    logger.remove(handler)
+
+
+def story(turns: int):
+    """An opening and turns whose narrations are 100 tokens each by the approximation"""
+    return [StoryEntry(story_action='', narration_result='opening')] + [
+        StoryEntry(story_action=f'action {i:02}', narration_result=f'{i:02}' * 200)
+        for i in range(1, turns + 1)
+    ]
+
+
+async def summarize(summary: str, entries):
+    return summary + ''.join(f'[{entry.story_action}]' for entry in entries)
+
+
+def test_token_counter_falls_back_to_four_characters_per_token(counter):
+    assert counter.encoding is None
+    assert counter.count('') == 0
+    assert counter.count('abcd') == 1
+    assert counter.count('abcde') == 2
+    assert counter.count_messages([{'role': 'user', 'content': 'abcd'}]) == 2 + 4 + 1
+
+
+def test_oldest_turns_over_the_budget_are_dropped(counter):
+    window = ContextWindow(summarize, token_budget=600, keep_last_turns=2, counter=counter)
+    entries = story(10)
+    messages = window.build_messages(system_messages, entries, 'go north')
+
+    assert messages[0] == system_messages[0]
+    assert messages[-1] == {'role': 'user', 'content': 'go north'}
+    history = [message['content'] for message in messages[1:-1]]
+    # Each turn costs 4 + 3 + 4 + 100 tokens, the newest ones that fit are kept in order
+    assert history == [
+        part for i in range(6, 11) for part in (f'action {i:02}', f'{i:02}' * 200)
+    ]
+    assert counter.count_messages(messages) <= window.token_budget
+
+
+def test_summarized_turns_are_replaced_by_the_summary(counter):
+    async def main():
+        window = ContextWindow(summarize, token_budget=10000, keep_last_turns=2, counter=counter)
+        entries = story(5)
+        window.schedule_summary_update(entries)
+        await window.summary_task
+        assert window.summarized_count == len(entries) - 2
+        assert window.summary == '[][action 01][action 02][action 03]'
+
+        messages = window.build_messages(system_messages, entries, 'go north')
+        assert messages[1] == {
+            'role': 'system',
+            'content': 'Summary of the story so far: ' + window.summary,
+        }
+        assert [message['content'] for message in messages[2:-1]] == [
+            'action 04', '04' * 200, 'action 05', '05' * 200
+        ]
+
+        # Nothing new to fold in
+        window.schedule_summary_update(entries)
+        assert window.summary_task.done()
+
+    asyncio.run(main())
+
+
+def test_dropped_turns_are_logged_once_per_summary_cycle(counter, warnings):
+    async def main():
+        window = ContextWindow(summarize, token_budget=600, keep_last_turns=2, counter=counter)
+        entries = story(10)
+        for _ in range(3):
+            window.build_messages(system_messages, entries, 'go north')
+        assert len(warnings) == 1
+        assert 'Dropping 6 story entries' in warnings[0]
+
+        entries += story(10)[1:]
+        window.schedule_summary_update(entries)
+        await window.summary_task
+        window.build_messages(system_messages, entries, 'go north')
+        window.build_messages(system_messages, entries, 'go north')
+        assert len(warnings) == 1  # Everything older than the last turns is summarized
+
+        window.reset()
+        window.build_messages(system_messages, entries, 'go north')
+        assert len(warnings) == 2
+
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+import os
+
+from twitch_plays_llm.image_pipeline import ImageCache
+
+
+class FakeResponse:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    async def read(self) -> bytes:
+        return self.data
+
+
+class FakeSession:
+    """Serves the given images by URL, in place of the aiohttp session"""
+
+    closed = False
+
+    def __init__(self, images):
+        self.images = images
+
+    def get(self, url: str) -> FakeResponse:
+        return FakeResponse(self.images[url])
+
+    async def close(self):
+        self.closed = True
+
+
+def image_name(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest() + '.png'
+
+
+def test_nothing_is_touched_until_first_use(tmp_path):
+    directory = tmp_path / 'images'
+    cache = ImageCache(str(directory), max_bytes=100)
+    assert not directory.exists() and not cache.scanned
+
+    assert cache.path(image_name(b'missing')) is None
+    assert cache.scanned and not directory.exists()
+    assert asyncio.run(cache.store('/fake/image.png')) == '/fake/image.png'
+    assert not directory.exists()
+
+
+def test_images_of_earlier_runs_are_found_on_first_lookup(tmp_path):
+    old, new = image_name(b'old'), image_name(b'new')
+    for name, mtime in ((old, 1000), (new, 2000)):
+        path = tmp_path / name
+        path.write_bytes(b'x' * 10)
+        os.utime(path, (mtime, mtime))
+    cache = ImageCache(str(tmp_path), max_bytes=100)
+    assert cache.sizes == {}
+
+    assert cache.path(new) == str(tmp_path / new)
+    assert list(cache.sizes) == [old, new]  # Least recently used first
+    assert cache.total_bytes == 20
+
+
+def test_stored_images_evict_the_least_recently_used(tmp_path):
+    images = {f'https://images/{i}': bytes([i]) * 40 for i in range(3)}
+    directory = tmp_path / 'images'
+
+    async def main():
+        cache = ImageCache(str(directory), max_bytes=100)
+        cache.session = FakeSession(images)
+        urls = [await cache.store(f'https://images/{i}') for i in range(2)]
+        assert urls == [f'/images/{image_name(images[f"https://images/{i}"])}' for i in range(2)]
+        cache.path(urls[0].rsplit('/', 1)[-1])  # Viewed, so the second one is evicted
+        await cache.store('https://images/2')
+        await cache.close()
+        return cache
+
+    cache = asyncio.run(main())
+    names = [image_name(images[f'https://images/{i}']) for i in (0, 2)]
+    assert list(cache.sizes) == names
+    assert sorted(os.listdir(directory)) == sorted(names)
+    assert cache.total_bytes == 80
@@ -0,0 +1,42 @@
+import asyncio
+import json
+
+from twitch_plays_llm.prompt_pool import InitialPromptPool
+
+
+def test_the_saved_pool_is_read_on_first_use(tmp_path):
+    path = tmp_path / 'initial_prompts.json'
+    path.write_text(json.dumps(['A storm gathers over the harbor.', '', 7]))
+    generated = []
+
+    async def generate() -> str:
+        generated.append(f'Opening {len(generated)}')
+        return generated[-1]
+
+    async def main():
+        pool = InitialPromptPool(generate, str(path), size=2, fallback='Once upon a time.')
+        assert pool._prompts is None  # Nothing was read yet
+
+        assert pool.take() == 'A storm gathers over the harbor.'
+        await pool.refill_task
+        await pool.persist_task
+        assert pool.prompts == generated == ['Opening 0', 'Opening 1']
+        assert json.loads(path.read_text()) == generated
+
+    asyncio.run(main())
+
+
+def test_a_missing_pool_is_not_created_until_refilled(tmp_path):
+    path = tmp_path / 'initial_prompts.json'
+
+    async def generate() -> str:
+        raise RuntimeError('The LLM is down')
+
+    async def main():
+        pool = InitialPromptPool(generate, str(path), size=2, fallback='Once upon a time.')
+        assert pool.take() == 'Once upon a time.'
+        await pool.refill_task
+        assert pool.prompts == []
+
+    asyncio.run(main())
+    assert not path.exists()
@@ -0,0 +1,93 @@
+import asyncio
+
+from typing import List
+
+import pytest
+
+from twitch_plays_llm.events import EventBus
+from twitch_plays_llm.models import StoryEntry
+from twitch_plays_llm.quest_handle import QuestHandler, _stems
+
+
+class ScriptedBackend:
+    """Answers quest evaluations with the given responses, raising those that are exceptions"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.prompts: List[str] = []
+
+    async def chat(self, messages, model=None, task='default') -> str:
+        self.prompts.append(messages[-1]['content'])
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def entry(action: str, narration: str = 'Nothing else happens.') -> StoryEntry:
+    return StoryEntry(story_action=action, narration_result=narration)
+
+
+def story_stems(text: str):
+    return _stems(text.lower().split())
+
+
+def test_stems_drop_short_words_and_stopwords():
+    assert _stems(['the', 'dragon', 'of', 'an', 'old', 'tower']) == {'drago', 'old', 'tower'}
+    assert _stems(['recover', 'recovered', 'recovering']) == {'recov'}
+
+
+@pytest.mark.parametrize(
+    'story, expected',
+    [
+        ('You slay the dragons in their lair', True),  # Inflections share a stem
+        ('The old dragon watches you', True),
+        ('You buy bread at the bakery', False),
+        ('Then you find something', False),  # Only stopwords in common
+        ('The guard died in the fire', True),  # Ending cues match any quest
+        ('You have completed the task', True),
+    ],
+)
+def test_prefilter(story, expected):
+    handler = QuestHandler(ScriptedBackend(), EventBus())
+    quest = handler.add('Slay the dragon of the northern mountains')
+    assert handler.might_change(quest, story_stems(story)) is expected
+
+
+def test_prefilter_uses_the_keywords_if_given():
+    handler = QuestHandler(ScriptedBackend(), EventBus())
+    quest = handler.add('Bring the pie to grandma', keywords=['bakery', 'oven'])
+    assert handler.might_change(quest, story_stems('You reach the bakery'))
+    assert not handler.might_change(quest, story_stems('You eat the pie with grandma'))
+
+
+def test_unrelated_entries_skip_the_llm():
+    async def main():
+        backend = ScriptedBackend()
+        handler = QuestHandler(backend, EventBus())
+        handler.add('Slay the dragon')
+        assert await handler.evaluate([entry('buy bread')]) == []
+        assert backend.prompts == [] and handler.prefiltered == 1
+        assert handler.checked_until == 1
+
+    asyncio.run(main())
+
+
+def test_entries_are_evaluated_again_after_a_failed_call():
+    async def main():
+        backend = ScriptedBackend(asyncio.TimeoutError(), '1: Complete')
+        handler = QuestHandler(backend, EventBus())
+        quest = handler.add('Slay the dragon')
+        entries = [entry('attack the dragon', 'The dragon falls.')]
+
+        with pytest.raises(asyncio.TimeoutError):
+            await handler.evaluate(entries)
+        assert handler.checked_until == 0
+
+        entries.append(entry('rest'))
+        assert await handler.evaluate(entries) == [quest]
+        assert quest.status == 'Complete'
+        assert handler.checked_until == 2
+        assert 'The dragon falls.' in backend.prompts[-1]
+
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import asyncio
+
+from twitch_plays_llm.config import config
+from twitch_plays_llm.llm_backend import FakeLlmBackend
+from twitch_plays_llm.llm_twitch_bot import LlmTwitchBot
+from twitch_plays_llm.registry import GameRegistry
+
+
+class OfflineBot:
+    """Stands in for the connection of LlmTwitchBot, recording whether it was closed"""
+
+    closed = False
+
+    async def start(self):
+        await asyncio.Event().wait()
+
+    async def close(self):
+        OfflineBot.closed = True
+
+
+def run_with_registry(tmp_path, monkeypatch, test):
+    """Runs test(registry) with the games of the channels main and second"""
+    monkeypatch.setattr(config, 'database_path', str(tmp_path / 'game.db'))
+    monkeypatch.setattr(config, 'twitch_channel_name', 'main')
+    monkeypatch.setattr(LlmTwitchBot, 'start', OfflineBot.start)
+    monkeypatch.setattr(LlmTwitchBot, 'close', OfflineBot.close)
+    monkeypatch.setattr(OfflineBot, 'closed', False)
+
+    async def main():
+        registry = GameRegistry(FakeLlmBackend())
+        registry.add_channel('main')
+        registry.add_channel('Second')
+        await test(registry)
+
+    asyncio.run(main())
+
+
+def test_one_bot_plays_every_channel(tmp_path, monkeypatch, chat):
+    async def test(registry: GameRegistry):
+        registry.start()
+        bot = registry.bot
+        assert sorted(bot.game_channels) == ['main', 'second']
+
+        await chat(bot, 'alice', '!action open the brass door', channel='main')
+        await chat(bot, 'bob', '!action climb the clock tower', channel='second')
+        await chat(bot, 'carol', '!vote 1', channel='second')
+
+        main, second = registry.get('main'), registry.get('second')
+        assert [(p.user, p.vote) for p in main.proposals] == [('alice', 0)]
+        assert [(p.user, p.vote) for p in second.proposals] == [('bob', 1)]
+        assert 'carol' in registry.game_channels['second'].viewer_points
+        assert 'carol' not in registry.game_channels['main'].viewer_points
+        await registry.close()
+
+    run_with_registry(tmp_path, monkeypatch, test)
+
+
+def test_close_stops_the_bot_and_the_games(tmp_path, monkeypatch):
+    async def test(registry: GameRegistry):
+        registry.start()
+        await asyncio.sleep(0)
+        tasks = []
+        for channel in registry.channels:
+            game = registry.get(channel)
+            await game.add_proposal('open the brass door', 'alice')
+            tasks.append(game.background_task)  # The vote is open
+
+        await registry.close()
+        assert OfflineBot.closed
+        assert registry.bot_task.done()
+        assert all(task.cancelled() for task in tasks)
+        assert all(registry.get(channel).background_task is None for channel in registry.channels)
+
+    run_with_registry(tmp_path, monkeypatch, test)
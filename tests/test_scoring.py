@@ -0,0 +1,86 @@
+import random
+
+from typing import List
+
+from twitch_plays_llm.scoring import ProposalRanking
+
+
+def expected_leaders(votes: List[int], k: int) -> List[int]:
+    return sorted(range(1, len(votes) + 1), key=lambda i: (-votes[i - 1], i))[:k]
+
+
+def ranking_with(votes: List[int], k: int = 2) -> ProposalRanking:
+    ranking = ProposalRanking(k)
+    for count in votes:
+        proposal_id = ranking.add()
+        if count:
+            ranking.vote(proposal_id, count)
+    return ranking
+
+
+def test_votes_reorder_the_leaders():
+    ranking = ranking_with([0, 0, 0])
+    assert ranking.leaders == [1, 2]  # Ties go to the earlier proposal
+
+    assert ranking.vote(3, 1) == 1
+    assert ranking.leaders == [3, 1]
+    ranking.vote(2, 2)
+    assert ranking.leaders == [2, 3]
+    ranking.vote(3, 1)
+    assert ranking.leaders == [2, 3]  # Tied, proposal 2 was first
+    assert ranking.leader == 2
+
+
+def test_removed_votes_let_the_others_overtake():
+    ranking = ranking_with([5, 3, 4, 1])
+    assert ranking.leaders == [1, 3]
+
+    ranking.vote(1, -3)  # A voter switched away from the leader
+    assert ranking.leaders == [3, 2]
+    ranking.vote(3, -4)
+    assert ranking.leaders == [2, 1]
+    ranking.vote(4, -1)  # Not a leader, nothing changes
+    assert ranking.leaders == [2, 1]
+
+
+def test_an_evicted_proposal_restarts_from_zero():
+    ranking = ranking_with([2, 1, 3], k=3)
+    # The least voted proposal is replaced: its votes are removed, the new one takes its id
+    ranking.vote(2, -1)
+    assert ranking.leaders == [3, 1, 2]
+    ranking.vote(2, 4)
+    assert ranking.leaders == [2, 3, 1]
+
+    # The leader can be replaced too, once every proposal is tied
+    ranking = ranking_with([1, 1, 1], k=2)
+    ranking.vote(1, -1)
+    assert ranking.leaders == [2, 3]
+
+
+def test_leaders_match_a_full_sort_under_random_votes():
+    rng = random.Random(0)
+    for k in (1, 2, 3):
+        ranking = ProposalRanking(k)
+        votes = []
+        for step in range(5000):
+            if len(votes) < 10 and rng.random() < 0.01:
+                ranking.add()
+                votes.append(0)
+            elif votes:
+                proposal_id = rng.randint(1, len(votes))
+                weight = rng.choice([1, 1, 1, 99, -1, -99])
+                weight = max(weight, -votes[proposal_id - 1])  # Only cast votes are removed
+                votes[proposal_id - 1] += weight
+                assert ranking.vote(proposal_id, weight) == votes[proposal_id - 1]
+            if step % 7 == 0:  # Leaders are not always read between votes
+                assert ranking.leaders == expected_leaders(votes, k)
+        assert len(ranking._heap) <= 2 * len(votes) + 65
+
+
+def test_reset_starts_from_the_given_votes():
+    ranking = ranking_with([3, 1])
+    ranking.reset([0, 2, 5])
+    assert ranking.leaders == [3, 2]
+    ranking.reset()
+    assert ranking.leaders == [] and ranking.leader is None
+    assert ranking.add() == 1 and ranking.leaders == [1]
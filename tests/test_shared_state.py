@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+from contextlib import suppress
+
+from twitch_plays_llm import app as api
+from twitch_plays_llm.llm_backend import FakeLlmBackend
+from twitch_plays_llm.llm_game import LlmGame
+from twitch_plays_llm.shared_state import SqliteStateStore, StatePublisher
+
+
+class ConnectedRequest:
+    async def is_disconnected(self) -> bool:
+        return False
+
+
+async def published(store: SqliteStateStore, game: LlmGame):
+    """Waits until the publisher caught up with the game"""
+    for _ in range(200):
+        view = await asyncio.get_running_loop().run_in_executor(None, store.view, 'test')
+        if view and view.event_seq() == game.events.seq:
+            return view
+        await asyncio.sleep(0.01)
+    raise AssertionError('State was not published')
+
+
+def run_published_game(tmp_path, test):
+    """Runs test(game, store) with the game published to a store, as by the owner process"""
+
+    async def main():
+        store = SqliteStateStore(str(tmp_path / 'state.db'))
+        game = LlmGame(backend=FakeLlmBackend())
+        publisher = StatePublisher(store, interval=0.01)
+        publisher.add_game('test', game)
+        try:
+            await test(game, store)
+        finally:
+            await publisher.close()
+            if game.background_task:
+                game.background_task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await game.background_task
+            await game.generator.images.close()
+
+    asyncio.run(main())
+
+
+def test_published_events_match_the_game(tmp_path):
+    async def test(game: LlmGame, store: SqliteStateStore):
+        await game.add_proposal('open the brass door', 'alice')
+        await game.add_proposal('climb the clock tower', 'bob')
+        game.vote(2, user='carol')
+        view = await published(store, game)
+
+        assert [proposal['vote'] for proposal in json.loads(view.proposals_json())] == [0, 1]
+        events = store.events_since('test', 0)
+        assert [event.model_dump() for event in events] == [
+            json.loads(event.model_dump_json()) for event in game.events.backlog
+        ]
+        assert store.events_since('test', 2) == events[2:]
+        assert store.events_since('test', game.events.seq) == []
+        assert store.events_since('test', game.events.seq + 1) is None  # The owner restarted
+
+    run_published_game(tmp_path, test)
+
+
+def test_api_workers_stream_the_published_events(tmp_path, monkeypatch):
+    async def test(game: LlmGame, store: SqliteStateStore):
+        await game.add_proposal('open the brass door', 'alice')
+        await published(store, game)
+        monkeypatch.setattr(api.app.state, 'registry', None, raising=False)
+        monkeypatch.setattr(api.app.state, 'state_store', store, raising=False)
+        monkeypatch.setattr(api.config, 'state_publish_interval', 0.01)
+
+        stream = api._stored_events(ConnectedRequest(), 'test', None)
+        snapshot = await stream.__anext__()
+        assert snapshot.startswith(f'id: {game.events.seq}\nevent: snapshot\n')
+        data = json.loads(snapshot.split('data: ', 1)[1])
+        assert [proposal['message'] for proposal in data['proposals']] == ['open the brass door']
+        assert len(data['story_history']) == len(game.generator.past_story_entries)
+
+        seq = game.events.seq
+        game.vote(1, user='bob')
+        vote_event = game.events.backlog[-1]
+        relayed = []
+        while not relayed or relayed[-1] != vote_event.to_sse():
+            relayed.append(await asyncio.wait_for(stream.__anext__(), 5))
+        events = list(game.events.backlog)
+        assert relayed == [event.to_sse() for event in events if seq < event.seq <= vote_event.seq]
+        await stream.aclose()
+
+        # A client resuming from its last event gets only what it missed
+        stream = api._stored_events(ConnectedRequest(), 'test', vote_event.seq - 1)
+        assert await stream.__anext__() == vote_event.to_sse()
+        await stream.aclose()
+
+    run_published_game(tmp_path, test)
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from twitch_plays_llm.models import StoryEntry
+from twitch_plays_llm.story_history import StoryHistory
+
+
+def entry(i: int) -> StoryEntry:
+    return StoryEntry(story_action=f'action {i}', narration_result=f'narration {i}')
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = StoryHistory(hot_entries=3, directory=str(tmp_path))
+    yield history
+    history.close()
+
+
+def test_entries_beyond_the_hot_tail_are_spilled(history):
+    history.extend(entry(i) for i in range(10))
+
+    assert len(history) == 10
+    assert history.spilled == history.tail_start == 7
+    assert len(history.hot) == 3
+    assert history.first.story_action == 'action 0'  # The opening stays in memory
+    assert [e.story_action for e in history] == [f'action {i}' for i in range(10)]
+    assert history[-1] == entry(9)
+    assert history[2:5] == [entry(2), entry(3), entry(4)]
+    with pytest.raises(IndexError):
+        history[10]
+
+
+def test_nothing_is_written_until_an_entry_spills(history):
+    history.extend(entry(i) for i in range(3))
+    assert history.file is None
+    history.append(entry(3))
+    assert history.file is not None
+    assert history.size == len(entry(0).model_dump_json()) + 1
+
+
+def test_set_image_url_on_a_spilled_entry(history):
+    history.extend(entry(i) for i in range(10))
+    size = history.size
+
+    history.set_image_url(4, '/images/4.png')
+    history.set_image_url(0, '/images/0.png')
+    history.set_image_url(8, '/images/8.png')
+
+    assert history[4].narration_image_url == '/images/4.png'
+    assert history[0].narration_image_url == '/images/0.png'
+    assert history.first.narration_image_url == '/images/0.png'
+    assert history[8].narration_image_url == '/images/8.png'
+    assert history.size > size  # New versions of the spilled entries were appended
+    assert [e.narration_image_url for e in history].count('') == 7
+
+
+def test_reads_remap_after_the_file_grows(history):
+    history.extend(entry(i) for i in range(5))
+    assert history[1] == entry(1)
+    mapped_size = history._mapped_size
+    view = history.json_slice(1, 2)[0]
+
+    history.extend(entry(i) for i in range(5, 50))
+    assert history[40] == entry(40)
+    assert history._mapped_size > mapped_size
+    assert history[1] == entry(1)
+    assert json.loads(bytes(view)) == entry(1).model_dump()  # Old views stay valid
+
+
+def test_json_pages(history):
+    history.extend(entry(i) for i in range(20))
+    history.set_image_url(5, '/images/5.png')
+
+    for start in range(0, 20, 6):
+        page = history.json_slice(start, start + 6)
+        assert [json.loads(bytes(data)) for data in page] == [
+            e.model_dump() for e in history[start : start + 6]
+        ]
+    assert history.json_slice(18, 100) == history.json_slice(18, 20)
+    assert history.json_slice(25, 30) == []
+    assert json.loads(history.entry_json(5))['narration_image_url'] == '/images/5.png'
+
+
+def test_closed_history_keeps_handed_out_views(history):
+    history.extend(entry(i) for i in range(10))
+    page = history.json_slice(0, 10)
+    history.close()
+    assert [json.loads(bytes(data))['story_action'] for data in page] == [
+        f'action {i}' for i in range(10)
+    ]
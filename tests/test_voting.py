@@ -0,0 +1,150 @@
+import asyncio
+import random
+
+from collections import Counter
+from typing import Tuple
+
+from twitch_plays_llm.chat_queue import FakeChannel
+from twitch_plays_llm.config import config
+from twitch_plays_llm.llm_backend import FakeLlmBackend
+from twitch_plays_llm.llm_game import LlmGame
+from twitch_plays_llm.llm_twitch_bot import GameChannel, LlmTwitchBot
+from twitch_plays_llm.models import Proposal
+
+proposal_count = 5
+
+
+def run_with_game(test):
+    """Runs test(game) on an event loop, with a round of proposals by p1, p2, ..."""
+
+    async def main():
+        game = LlmGame(backend=FakeLlmBackend())
+        for i in range(1, proposal_count + 1):
+            game._insert_proposal(Proposal(user=f'p{i}', message=f'proposal {i}', vote=0))
+        try:
+            await test(game)
+        finally:
+            await game.generator.images.close()
+
+    asyncio.run(main())
+
+
+def play_in_chat(game: LlmGame) -> Tuple[LlmTwitchBot, GameChannel]:
+    """Connects the game to a bot playing it in the test channel"""
+    game_channel = GameChannel(game, channel_name='test')
+    game.hooks = game_channel
+    game_channel.channel = FakeChannel()
+    return LlmTwitchBot([game_channel]), game_channel
+
+
+def flood(rng: random.Random, votes: int, viewers: int):
+    """Random (user, proposal_id) votes, with many repeats and switches"""
+    return [
+        (f'viewer{rng.randrange(viewers)}', rng.randint(1, proposal_count)) for _ in range(votes)
+    ]
+
+
+def test_one_vote_per_user():
+    async def test(game: LlmGame):
+        votes = flood(random.Random(0), 10000, 1000)
+        for user, proposal_id in votes:
+            game.vote(proposal_id, user=user)
+        last_votes = dict(votes)
+        expected = Counter(last_votes.values())
+        assert [proposal.vote for proposal in game.proposals] == [
+            expected[i] for i in range(1, proposal_count + 1)
+        ]
+        assert sum(proposal.vote for proposal in game.proposals) == len(last_votes)
+        assert game.ranking.leader == max(expected, key=lambda i: (expected[i], -i))
+
+    run_with_game(test)
+
+
+def test_vote_switching_moves_the_vote():
+    async def test(game: LlmGame):
+        game.vote(1, user='alice')
+        game.vote(2, user='alice')
+        assert [proposal.vote for proposal in game.proposals][:2] == [0, 1]
+        assert game.voted_for('alice') == 2
+
+        game.vote(3, weight=99, user='mod')
+        game.vote(1, weight=99, user='mod')  # The weight moves along
+        assert [proposal.vote for proposal in game.proposals][:3] == [99, 1, 0]
+
+    run_with_game(test)
+
+
+def test_repeat_vote_is_a_no_op():
+    async def test(game: LlmGame):
+        game.vote(1, user='alice')
+        seq = game.events.seq
+        for _ in range(100):
+            game.vote(1, user='alice')
+        assert game.proposals[0].vote == 1
+        assert game.events.seq == seq  # Nothing was published
+
+    run_with_game(test)
+
+
+def test_only_the_first_vote_earns_points_under_a_flood(chat):
+    async def test(game: LlmGame):
+        bot, game_channel = play_in_chat(game)
+        votes = flood(random.Random(1), 10000, 2000)
+        for user, proposal_id in votes:
+            await chat(bot, user, f'!vote {proposal_id}')
+
+        first_votes = {}
+        for user, proposal_id in votes:
+            first_votes.setdefault(user, proposal_id)
+        for user in first_votes:
+            assert game_channel.viewer_points[user] == config.vote_points
+        proposer_votes = Counter(first_votes.values())
+        for i in range(1, proposal_count + 1):
+            points = proposer_votes[i] * config.points_earned_per_vote
+            assert game_channel.viewer_points[f'p{i}'] == points
+        last_votes = dict(votes)
+        assert len(game.voters) == len(last_votes)
+        assert all(game.voted_for(user) == last_votes[user] for user in last_votes)
+        assert sum(proposal.vote for proposal in game.proposals) == len(last_votes)
+
+    run_with_game(test)
+
+
+def test_replaced_proposal_voters_do_not_earn_points_again(chat, monkeypatch):
+    monkeypatch.setattr(config, 'max_proposals', proposal_count)
+
+    async def test(game: LlmGame):
+        bot, game_channel = play_in_chat(game)
+        for proposal_id, user in enumerate(['bob', 'alice', 'carol', 'dave', 'erin'], start=1):
+            await chat(bot, user, f'!vote {proposal_id}')
+        # Every proposal has one vote, the oldest is replaced
+        await chat(bot, 'frank', '!action climb the bell tower')
+        assert game.proposals[0].message == 'climb the bell tower'
+        assert game.voted_for('bob') is None and game.has_voted('bob')
+
+        points = game_channel.viewer_points['bob']
+        await chat(bot, 'bob', '!vote 1')
+        assert game_channel.viewer_points['bob'] == points
+        assert game.voted_for('bob') == 1
+        assert [proposal.vote for proposal in game.proposals] == [1, 1, 1, 1, 1]
+
+    run_with_game(test)
+
+
+def test_the_oldest_of_the_least_voted_proposals_is_replaced(monkeypatch):
+    monkeypatch.setattr(config, 'max_proposals', proposal_count)
+
+    async def test(game: LlmGame):
+        for proposal_id, votes in enumerate([2, 0, 1, 0, 3], start=1):
+            for i in range(votes):
+                game.vote(proposal_id, user=f'viewer{proposal_id}-{i}')
+        assert game.ranking.leaders[:2] == [5, 1]
+
+        assert await game.add_proposal('climb the bell tower', 'frank') == (2, True)
+        assert game.proposals[1].message == 'climb the bell tower'
+        assert await game.add_proposal('sneak into the vault', 'grace') == (4, True)
+        game.vote(4, weight=99, user='mod')
+        assert game.ranking.leaders[:2] == [4, 5]
+        assert [proposal.vote for proposal in game.proposals] == [2, 0, 1, 99, 3]
+
+    run_with_game(test)
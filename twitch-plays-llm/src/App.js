@@ -1,5 +1,4 @@
 import React, { useEffect, useState, useRef } from 'react';
-import axios from 'axios';
 
 // ProgressBar component displays a progress bar 
 // given the current count, total, and color
@@ -19,12 +18,16 @@ const ProgressBar = ({ count, total }) => {
 };
 
 
+const API_URL = 'http://localhost:9511';
+
+
 function getLastNonEmptyNarrationImage(storyHistory) {
   for (let i = storyHistory.length - 1; i >= 0; i--) {
     const narration = storyHistory[i].narration_image_url;
     if (narration !== "") {
       const isLastEntry = i === storyHistory.length - 1;
-      return { url: narration, isLastEntry: isLastEntry };
+      // Cached images are served by the backend under a relative path
+      return { url: new URL(narration, API_URL).href, isLastEntry: isLastEntry };
     }
   }
   return { url: '', isLastEntry: false };
@@ -37,6 +40,8 @@ function App() {
   const [proposals, setProposals] = useState([]);
   const [storyHistory, setStoryHistory] = useState([]);
   const [timeInfo, setTimeInfo] = useState(null);
+  const [voteDeadline, setVoteDeadline] = useState(null);
+  const storyStart = useRef(0); // Story index of storyHistory[0], older entries aren't loaded
   const proposalRef = useRef(null); // Ref for scrolling
   const storyRef = useRef(null);   // Ref for scrolling
 
@@ -45,30 +50,80 @@ function App() {
     isLastEntry: isNarrationImageUrlRecent
   } = getLastNonEmptyNarrationImage(storyHistory);
 
-  // Use useEffect to fetch data from server on mount and every second
+  // Subscribe to the server's event stream. The server pushes only what changed,
+  // and EventSource resumes from the last received event id after a reconnect
   useEffect(() => {
-    async function fetchData() {
-      const proposalsRes = await axios.get('http://localhost:9511/proposals');
-  
-      // Sort the proposals by vote count in descending order
-      const sortedProposals = proposalsRes.data.sort((a, b) => b.vote - a.vote);
-      
-      setProposals(sortedProposals);
-  
-      const storyHistoryRes = await axios.get('http://localhost:9511/story-history');
-      setStoryHistory(storyHistoryRes.data);
-  
-      const timeInfo = await axios.get('http://localhost:9511/vote-time-remaining')
-      setTimeInfo(timeInfo.data);
-    }
-  
-    fetchData();  // Fetch data immediately on component mount
-    const intervalId = setInterval(fetchData, 1000);  // Fetch data every second
-  
+    const source = new EventSource(`${API_URL}/events`);
+    const on = (type, handler) => source.addEventListener(type, (e) => handler(JSON.parse(e.data)));
+
+    on('snapshot', (data) => {
+      setProposals(data.proposals.map((proposal, index) => ({ ...proposal, id: index + 1 })));
+      storyStart.current = data.story_start || 0;
+      setStoryHistory(data.story_history);
+      setVoteDeadline(data.time_remaining && {
+        end: Date.now() + data.time_remaining.seconds_remaining * 1000,
+        total: data.time_remaining.total_seconds,
+      });
+    });
+    // Added proposals may replace the least voted one when the round is full
+    on('proposal_added', ({ id, proposal }) => {
+      setProposals((prev) => [...prev.filter((p) => p.id !== id), { ...proposal, id }]);
+    });
+    on('proposal_updated', ({ id, proposal }) => {
+      setProposals((prev) => prev.map((p) => (p.id === id ? { ...proposal, id } : p)));
+    });
+    on('vote_changed', ({ id, vote }) => {
+      setProposals((prev) => prev.map((p) => (p.id === id ? { ...p, vote } : p)));
+    });
+    on('proposals_cleared', () => setProposals([]));
+    const onVoteDeadline = ({ seconds_remaining, total_seconds }) => {
+      setVoteDeadline({ end: Date.now() + seconds_remaining * 1000, total: total_seconds });
+    };
+    on('vote_started', onVoteDeadline);
+    // The vote closes early once it is decided or chat went quiet
+    on('vote_deadline_changed', onVoteDeadline);
+    on('vote_ended', () => setVoteDeadline(null));
+    // Narrations are streamed in chunks before the finished entry is appended.
+    // Events carry story indexes, which are offset by the entries not loaded
+    const at = (index) => index - storyStart.current;
+    on('narration_started', ({ index, story_action }) => {
+      setStoryHistory((prev) => [...prev.slice(0, at(index)), { story_action, narration_result: '', narration_image_url: '' }]);
+    });
+    on('narration_chunk', ({ index, text }) => {
+      setStoryHistory((prev) => prev.map((e, i) => (
+        i === at(index) ? { ...e, narration_result: e.narration_result ? `${e.narration_result} ${text}` : text } : e
+      )));
+    });
+    on('narration_appended', ({ index, entry }) => {
+      setStoryHistory((prev) => [...prev.slice(0, at(index)), entry]);
+    });
+    on('image_updated', ({ index, url }) => {
+      setStoryHistory((prev) => prev.map((e, i) => (i === at(index) ? { ...e, narration_image_url: url } : e)));
+    });
+    on('story_reset', ({ entries }) => {
+      storyStart.current = 0;
+      setStoryHistory(entries);
+    });
+
     // Clean up function: This will be run when the component is unmounted
-    return () => clearInterval(intervalId);
+    return () => source.close();
   }, []);
 
+  // Count down the vote timer locally instead of asking the server every second
+  useEffect(() => {
+    if (!voteDeadline) {
+      setTimeInfo(null);
+      return;
+    }
+    const tick = () => setTimeInfo({
+      seconds_remaining: Math.max(0, (voteDeadline.end - Date.now()) / 1000),
+      total_seconds: voteDeadline.total,
+    });
+    tick();
+    const intervalId = setInterval(tick, 1000);
+    return () => clearInterval(intervalId);
+  }, [voteDeadline]);
+
   useEffect(() => {  // New useEffect for scrolling
     proposalRef.current?.scrollIntoView({ behavior: 'smooth' });
     storyRef.current?.scrollIntoView({ behavior: 'smooth' });  // Scroll to bottom of story
@@ -91,6 +146,9 @@ function App() {
     margin: "0 5px"
   };
 
+  // Sort the proposals by vote count in descending order
+  const sortedProposals = [...proposals].sort((a, b) => b.vote - a.vote);
+
   // Calculate total votes
   const totalVotes = Math.max(1, proposals.map(x => x.vote).reduce((a, b) => a + b, 0));
   return (
@@ -116,17 +174,17 @@ function App() {
               </div>
           </p> : <p>No proposals.</p>}
         </div>
-        {timeInfo && proposals.map((proposal, index) => (
-          <div key={index} style={{ position: 'relative' }} className="card response-card" ref={index === proposals.length - 1 ? proposalRef : null}>
+        {timeInfo && sortedProposals.map((proposal, index) => (
+          <div key={proposal.id} style={{ position: 'relative' }} className="card response-card" ref={index === sortedProposals.length - 1 ? proposalRef : null}>
             <div>
-              <p><b>{index + 1}: </b>{proposal.message}</p>
+              <p><b>{proposal.id}: </b>{proposal.message}</p>
             </div>
             <div>
               <ProgressBar count={proposal.vote} total={totalVotes} />
             </div>
 
             <div style={{ alignSelf: 'flex-start', position: 'absolute', top: 0, right: 0 }}>
-              <p style={{ ...badgeStyle }}>{proposal.user}</p>
+              <p style={{ ...badgeStyle }}>{[proposal.user, ...(proposal.co_authors || [])].join(', ')}</p>
             </div>
           </div>
         ))}
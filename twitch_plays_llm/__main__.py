@@ -1,13 +1,11 @@
-from argparse import ArgumentParser
-
-import openai
-import uvicorn
+import asyncio
+import os
 
-from uvicorn_loguru_integration import run_uvicorn_loguru
+from argparse import ArgumentParser
+from typing import Optional
 
 from .config import config
-from .llm_game import LlmGame
-from .llm_twitch_bot import LlmTwitchBot
+from .runtime import install_event_loop_policy, uvloop_available
 
 
 def main():
@@ -15,12 +13,51 @@ def main():
         description='Backend for Twitch-Plays-LLM, an interactive collaborative text-based twitch game'
     )
     sp = parser.add_subparsers(dest='action')
-    sp.add_parser('run')
+    p = sp.add_parser('run')
+    p.add_argument(
+        '--role',
+        choices=['all', 'owner', 'api'],
+        help='all: bot, game and API in one process. owner: bot and game, publishing state '
+        'to the shared store. api: read-only API workers serving the shared store',
+    )
+    p.add_argument('--workers', type=int, default=1, help='Number of api workers')
+    p = sp.add_parser('benchmark', help='Run the offline load test and micro-benchmarks')
+    p.add_argument('--viewers', type=int, default=1000)
+    p.add_argument('--turns', type=int, default=200)
+    p.add_argument('--commands-per-turn', type=int, default=200)
+    p.add_argument('--llm-latency', type=float, default=0.0, help='Median fake LLM latency in seconds')
+    p.add_argument('--token-delay', type=float, default=0.0)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--baseline', default='benchmarks/baseline.json')
+    p.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    p.add_argument('--tolerance', type=float, default=0.5, help='Allowed relative regression')
+    p.add_argument('--skip-load', action='store_true')
+    p.add_argument('--skip-micro', action='store_true')
+    p.add_argument('--skip-startup', action='store_true')
+    p.add_argument(
+        '--startup-target-ms',
+        type=float,
+        default=1500,
+        help='Maximum time from launch until /proposals is served',
+    )
+    p = sp.add_parser('fake-openai', help='Serve a fake OpenAI API for offline testing')
+    p.add_argument('--port', type=int, default=9512)
+    p.add_argument('--latency', type=float, default=0.0, help='Seconds before each response starts')
+    p.add_argument(
+        '--capacity', type=int, default=None, help='Requests served at once, to simulate saturation'
+    )
     args = parser.parse_args()
 
-    openai.api_key = config.openai_api_key
-
     if args.action == 'run':
+        import uvicorn
+
+        from uvicorn_loguru_integration import run_uvicorn_loguru
+
+        if args.role:
+            # Passed through the environment so uvicorn workers see it too
+            os.environ['ROLE'] = config.role = args.role
+        if args.workers > 1 and config.role != 'api':
+            parser.error('Only api workers can run as multiple processes, the bot must be unique')
         run_uvicorn_loguru(
             uvicorn.Config(
                 'twitch_plays_llm.app:app',
@@ -28,12 +65,33 @@ def main():
                 port=config.backend_port,
                 log_level='info',
                 reload=False,
-                workers=1,  # We need only 1 worker because otherwise multiple chatbots will be running
+                loop='uvloop' if uvloop_available() else 'asyncio',
+                workers=args.workers,  # Only api workers may be multiple, otherwise multiple chatbots would run
             )
         )
+    elif args.action == 'benchmark':
+        from .benchmark import run_benchmarks
+
+        install_event_loop_policy()
+        raise SystemExit(asyncio.run(run_benchmarks(args)))
+    elif args.action == 'fake-openai':
+        install_event_loop_policy()
+        asyncio.run(serve_fake_openai(args.port, args.latency, args.capacity))
     else:
         assert False
 
 
+async def serve_fake_openai(port: int, latency: float = 0.0, capacity: Optional[int] = None):
+    from .fake_openai import FakeOpenAiServer
+    from .llm_backend import FakeLlmBackend
+
+    server = FakeOpenAiServer(FakeLlmBackend(latency=latency, capacity=capacity), port=port)
+    print(f'Serving fake OpenAI API at {await server.start()}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
 if __name__ == '__main__':
     main()
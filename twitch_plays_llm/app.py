@@ -1,22 +1,29 @@
 import asyncio
+import hmac
+import json
 import time
 
-from typing import List, Optional
+from typing import TYPE_CHECKING, AsyncIterator, List, Optional
 
 from pydantic import BaseModel
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 
+from . import metrics, runtime
+from .events import GameEvent
+from .image_pipeline import ImageCache
 from .llm_game import LlmGame
-from .llm_twitch_bot import LlmTwitchBot
 from .models import Proposal, StoryEntry
+from .shared_state import GameView, LiveGameView, SqliteStateStore, StatePublisher
 from .config import config
 
+if TYPE_CHECKING:
+    from .registry import GameRegistry
 
-app = FastAPI()
 
-# We need to maintain a reference to running coroutines to prevent GC
-background_task = None
+app = FastAPI()
 
 
 origins = [
@@ -29,28 +36,157 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 
 @app.on_event('startup')
 def on_startup():
-    global background_task
-    app.state.game = game = LlmGame()
-    app.state.bot = bot = LlmTwitchBot(game)
-    game.hooks = bot
-    background_task = asyncio.create_task(bot.start())
+    """
+    Starts the games, unless this is a read-only API worker serving the
+    state published by the owner process.
+    """
+    app.state.registry = app.state.publisher = app.state.state_store = None
+    runtime.configure_logging()
+    runtime.configure_event_loop(asyncio.get_running_loop())
+    app.state.watchdog = None
+    if config.slow_callback_ms > 0:
+        app.state.watchdog = runtime.LoopWatchdog(config.slow_callback_ms / 1000)
+        app.state.watchdog.start()
+    metrics.Profiling.enabled = config.profiling
+    app.state.loop_lag_monitor = metrics.LoopLagMonitor()
+    app.state.loop_lag_monitor.start()
+    if config.role == 'api':
+        app.state.state_store = SqliteStateStore(config.state_store_path)
+        # Only serves the images cached by the owner process
+        app.state.image_cache = ImageCache(config.image_cache_dir, config.image_cache_max_mb * 2**20)
+        return
+    # Imported here, api workers don't need the chat bot
+    from .registry import GameRegistry
+
+    config.require('twitch_channel_name')
+    if config.twitch_connect:
+        config.require('twitch_bot_username', 'twitch_bot_client_id')
+    if config.llm_backend == 'openai':
+        runtime.preload_modules('openai')  # Imported on the first call otherwise
+    app.state.registry = registry = GameRegistry()
+    for channel in [config.twitch_channel_name, *config.twitch_extra_channel_names]:
+        registry.add_channel(channel)
+    if config.role == 'owner':
+        app.state.publisher = publisher = StatePublisher(
+            SqliteStateStore(config.state_store_path), config.state_publish_interval
+        )
+        for channel, game in registry.games.items():
+            publisher.add_game(channel, game)
+    app.state.image_cache = next(iter(registry.games.values())).generator.image_cache
+    if config.twitch_connect:
+        registry.start()
+
+
+@app.on_event('shutdown')
+async def on_shutdown():
+    await app.state.loop_lag_monitor.close()
+    if app.state.watchdog:
+        await app.state.watchdog.close()
+    if app.state.publisher:
+        await app.state.publisher.close()
+    if app.state.registry:
+        await app.state.registry.close()
+
+
+def _get_game(channel: Optional[str]) -> LlmGame:
+    """Returns the game of a channel, or of the main channel if not given"""
+    registry: Optional['GameRegistry'] = app.state.registry
+    if registry is None:
+        raise HTTPException(status_code=404, detail='Not available on api workers')
+    game = registry.get(channel or config.twitch_channel_name)
+    if game is None:
+        raise HTTPException(status_code=404, detail=f'Unknown channel: {channel}')
+    return game
+
+
+def _get_view(channel: Optional[str]) -> GameView:
+    """Returns the state of a channel, live or from the shared store on api workers"""
+    if app.state.registry is not None:
+        return LiveGameView(_get_game(channel))
+    view = app.state.state_store.view((channel or config.twitch_channel_name).lower())
+    if view is None:
+        raise HTTPException(status_code=404, detail=f'Unknown channel: {channel}')
+    return view
+
+
+@app.get('/channels')
+def get_channels() -> List[str]:
+    if app.state.registry is None:
+        return app.state.state_store.channels()
+    return app.state.registry.channels
+
+
+@app.get('/proposals', response_model=List[Proposal])
+@app.get('/channels/{channel}/proposals', response_model=List[Proposal])
+def get_proposals(channel: Optional[str] = None) -> Response:
+    """Returns the proposals of the current round"""
+    return Response(content=_get_view(channel).proposals_json(), media_type='application/json')
+
+
+@app.get('/story-history', response_model=List[StoryEntry])
+@app.get('/channels/{channel}/story-history', response_model=List[StoryEntry])
+def get_story_history(
+    channel: Optional[str] = None,
+    after: int = Query(-1, ge=-1, description='Only return entries after this index'),
+    limit: Optional[int] = Query(None, ge=1, description='Maximum number of entries'),
+    if_none_match: Optional[str] = Header(None),
+):
+    """
+    Returns the story entries after the given index.
+
+    The response carries a strong ETag derived from the story version, so an
+    unchanged story is answered with 304 Not Modified and no body.
+    """
+    view = _get_view(channel)
+    etag = f'"{view.story_version()}"'
+    if if_none_match == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    start = after + 1
+    version, entries = view.story(start, None if limit is None else start + limit)
+    etag = f'"{version}"'
+    body = b'[' + b','.join(entries) + b']'
+    return Response(content=body, media_type='application/json', headers={'ETag': etag})
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+def get_metrics():
+    """Metrics of this process in the Prometheus text format"""
+    return PlainTextResponse(
+        metrics.render_metrics(), media_type='text/plain; version=0.0.4; charset=utf-8'
+    )
 
 
-@app.get('/proposals')
-def get_proposals() -> List[Proposal]:
-    game: LlmGame = app.state.game
-    return game.proposals
+@app.post('/profiling')
+def set_profiling(enabled: bool, x_profiling_token: Optional[str] = Header(None)) -> bool:
+    """
+    Turns timing of profiled functions on or off at runtime. Only available
+    when profiling_token is set, to requests sending it.
+    """
+    if not config.profiling_token:
+        raise HTTPException(status_code=404, detail='Not Found')
+    token = (x_profiling_token or '').encode()
+    if not hmac.compare_digest(token, config.profiling_token.encode()):
+        raise HTTPException(status_code=403, detail='Invalid profiling token')
+    metrics.Profiling.enabled = enabled
+    return enabled
 
 
-@app.get('/story-history')
-def get_story_history() -> List[StoryEntry]:
-    game: LlmGame = app.state.game
-    return game.generator.past_story_entries
+@app.get('/images/{name}')
+def get_image(name: str):
+    """Serves a cached narration image. Names are content hashes, so they never change"""
+    image_cache: ImageCache = app.state.image_cache
+    path = image_cache.path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail='Unknown image')
+    return FileResponse(
+        path, media_type='image/png', headers={'Cache-Control': 'public, max-age=31536000, immutable'}
+    )
 
 
 class TimeRemainingResponse(BaseModel):
@@ -59,11 +195,134 @@ class TimeRemainingResponse(BaseModel):
 
 
 @app.get('/vote-time-remaining')
-def get_vote_time_remaining() -> Optional[TimeRemainingResponse]:
-    game: LlmGame = app.state.game
-    if game.next_count_vote_time is None:
+@app.get('/channels/{channel}/vote-time-remaining')
+def get_vote_time_remaining(channel: Optional[str] = None) -> Optional[TimeRemainingResponse]:
+    return _time_remaining(_get_view(channel))
+
+
+def _time_remaining(view: GameView) -> Optional[TimeRemainingResponse]:
+    deadline = view.vote_deadline()
+    if deadline is None:
         return None
+    vote_end, total_seconds = deadline
     return TimeRemainingResponse(
-        seconds_remaining=game.next_count_vote_time - time.time(),
-        total_seconds=config.vote_delay
+        seconds_remaining=vote_end - time.time(), total_seconds=total_seconds
+    )
+
+
+def _snapshot_event(view: GameView) -> GameEvent:
+    """
+    Full game state, sent to clients that can't resume from the event backlog.
+    Only the recent story held in memory is included, older entries are
+    paginated through /story-history.
+    """
+    seq = view.event_seq()
+    time_remaining = _time_remaining(view)
+    story_start = max(0, view.story_length() - config.story_hot_entries)
+    _, story = view.story(story_start, None)
+    return GameEvent(
+        seq=seq,
+        type='snapshot',
+        data=dict(
+            proposals=json.loads(view.proposals_json()),
+            story_start=story_start,
+            story_history=[json.loads(bytes(entry)) for entry in story],
+            time_remaining=time_remaining and time_remaining.model_dump(),
+        ),
+    )
+
+
+@app.get('/events')
+@app.get('/channels/{channel}/events')
+async def get_events(
+    request: Request,
+    channel: Optional[str] = None,
+    after: Optional[int] = None,
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Server-sent event stream of game state changes.
+
+    Clients resume from the sequence number in the Last-Event-ID header (sent
+    automatically by EventSource on reconnect) or the `after` query parameter.
+    New clients and clients too far behind receive a full snapshot first.
+    API workers relay the events the owner process publishes to the shared store.
+    """
+    if after is None and last_event_id and last_event_id.isdigit():
+        after = int(last_event_id)
+    if app.state.registry is None:
+        stream = await run_in_threadpool(_stored_events, request, channel, after)
+    else:
+        stream = _live_events(request, _get_game(channel), after)
+    return StreamingResponse(
+        stream, media_type='text/event-stream', headers={'Cache-Control': 'no-cache'}
     )
+
+
+def _live_events(request: Request, game: LlmGame, after: Optional[int]) -> AsyncIterator[str]:
+    queue = game.events.subscribe()
+    missed = None if after is None else game.events.events_since(after)
+    if missed is None:
+        missed = [_snapshot_event(LiveGameView(game))]
+
+    async def stream():
+        try:
+            last_seq = -1
+            for event in missed:
+                last_seq = event.seq
+                yield event.to_sse()
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), 15.0)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                if event is None:
+                    break
+                if event.seq > last_seq:
+                    last_seq = event.seq
+                    yield event.to_sse()
+        finally:
+            game.events.unsubscribe(queue)
+
+    return stream()
+
+
+def _stored_events(
+    request: Request, channel: Optional[str], after: Optional[int]
+) -> AsyncIterator[str]:
+    """Polls the shared store for the events of a channel. Runs on the threadpool"""
+    store: SqliteStateStore = app.state.state_store
+    view = _get_view(channel)
+    channel = (channel or config.twitch_channel_name).lower()
+    missed = None if after is None else store.events_since(channel, after)
+    if missed is None:
+        missed = [_snapshot_event(view)]
+
+    def poll(last_seq: int) -> List[GameEvent]:
+        events = store.events_since(channel, last_seq)
+        if events is None:
+            # Fell behind the stored backlog, or the owner restarted
+            events = [_snapshot_event(_get_view(channel))]
+        return events
+
+    async def stream():
+        last_seq = missed[-1].seq if missed else after
+        for event in missed:
+            yield event.to_sse()
+        idle = 0.0
+        while not await request.is_disconnected():
+            await asyncio.sleep(config.state_publish_interval)
+            try:
+                events = await run_in_threadpool(poll, last_seq)
+            except HTTPException:
+                break  # The channel is no longer published
+            for event in events:
+                last_seq = event.seq
+                yield event.to_sse()
+            idle = 0.0 if events else idle + config.state_publish_interval
+            if idle >= 15.0:
+                idle = 0.0
+                yield ': keepalive\n\n'
+
+    return stream()
@@ -0,0 +1,498 @@
+"""
+Load test, micro-benchmarks and startup benchmark running fully offline.
+
+Simulated viewers send chat commands to a real LlmTwitchBot and LlmGame,
+backed by the fake LLM backend with sampled latencies and a fake channel.
+"""
+import asyncio
+import contextlib
+import gc
+import io
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from typing import Callable, Dict, List, Optional
+
+from loguru import logger
+
+from .chat_queue import FakeChannel
+from .config import config
+from .llm_backend import FakeLlmBackend
+
+
+class _FakeAuthor:
+    def __init__(self, name: str, is_mod: bool = False):
+        self.name = name
+        self.is_mod = is_mod
+
+
+class _FakeMessage:
+    def __init__(self, content: str):
+        self.content = content
+
+
+class _FakeCommand:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class _FakeContext:
+    """The parts of a twitchio command context used by the bot's command handlers"""
+
+    def __init__(self, channel: FakeChannel, author: _FakeAuthor, content: str, command: str):
+        self.channel = channel
+        self.author = author
+        self.message = _FakeMessage(content)
+        self.command = _FakeCommand(command)
+
+
+class SimulatedChat:
+    """
+    Chat of simulated viewers, dispatching their commands to the bot's
+    command handlers the way twitchio does once a message is parsed.
+
+    Args:
+        bot: The bot receiving the commands.
+        game_channel: The channel the commands are sent in.
+        viewers: Number of distinct viewers.
+        rng: Source of randomness, seeded for reproducible runs.
+        weights: Relative frequency of each command.
+    """
+
+    actions = [
+        'open the brass door',
+        'fly up to the clock tower',
+        'follow the messenger pigeon',
+        'ask the guildmaster about the summons',
+        'turn back time by a minute',
+        'inspect the gearworks',
+    ]
+
+    def __init__(
+        self, bot, game_channel, viewers: int, rng: random.Random, weights: Dict[str, float]
+    ):
+        self.bot = bot
+        self.game_channel = game_channel
+        self.users = [_FakeAuthor(f'viewer{i}') for i in range(viewers)]
+        self.rng = rng
+        self.commands = list(weights)
+        self.weights = list(weights.values())
+        self.latencies: Dict[str, List[float]] = {command: [] for command in weights}
+
+    def random_message(self) -> str:
+        command = self.rng.choices(self.commands, self.weights)[0]
+        if command == 'action':
+            action = self.rng.choice(self.actions)
+            return f'!action {action} {self.rng.randrange(1000)}'
+        if command == 'vote':
+            return f'!vote {self.rng.randint(1, max(1, len(self.game_channel.game.proposals)))}'
+        return f'!{command}'
+
+    async def send(self, user: _FakeAuthor, content: str):
+        """Handles one chat message, recording how long the bot took to process it"""
+        name = content[1:].split(' ', 1)[0]
+        command = self.bot.get_command(name)
+        ctx = _FakeContext(self.game_channel.channel, user, content, name)
+        start = time.perf_counter()
+        await self.bot.global_before_invoke(ctx)
+        await command._callback(command._instance or self.bot, ctx)
+        self.latencies[name].append(time.perf_counter() - start)
+
+    async def burst(self, count: int):
+        """Sends count messages from random viewers concurrently"""
+        messages = [(self.rng.choice(self.users), self.random_message()) for _ in range(count)]
+        await asyncio.gather(*(self.send(user, content) for user, content in messages))
+
+
+def lognormal_latency(rng: random.Random, median: float, sigma: float = 0.5) -> Callable[[], float]:
+    """Returns a sampler of latencies with the given median, 0 for no latency"""
+    if median <= 0:
+        return lambda: 0.0
+    return lambda: rng.lognormvariate(0, sigma) * median
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def _rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Silences the game's loguru logs (and any stray stdout), which would dominate the timings"""
+    logger.disable('twitch_plays_llm')
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        logger.enable('twitch_plays_llm')
+
+
+async def run_load_test(
+    viewers: int = 1000,
+    turns: int = 200,
+    commands_per_turn: int = 200,
+    llm_latency: float = 0.0,
+    token_delay: float = 0.0,
+    seed: int = 0,
+    weights: Optional[Dict[str, float]] = None,
+) -> dict:
+    """
+    Plays turns of the game with a simulated chat.
+
+    Each turn a burst of commands arrives while the vote is open, then the
+    vote is closed and the narration generated.
+
+    Args:
+        viewers: Number of simulated viewers.
+        turns: Number of turns to play.
+        commands_per_turn: Chat commands sent during each vote.
+        llm_latency: Median latency of the fake LLM in seconds.
+        token_delay: Seconds between streamed narration tokens.
+        seed: Seed of the simulated chat and latencies.
+        weights: Relative frequency of !action, !vote and !points.
+
+    Returns:
+        The measured throughput, latencies and memory growth.
+    """
+    from .llm_game import LlmGame
+    from .llm_twitch_bot import GameChannel, LlmTwitchBot
+    from .storage import GameStore
+
+    rng = random.Random(seed)
+    weights = weights or {'action': 0.1, 'vote': 0.7, 'points': 0.2}
+    with tempfile.TemporaryDirectory() as tmp, _quiet():
+        config.vote_delay = 3600  # Votes are closed by the simulation
+        config.initial_prompt_pool_path = os.path.join(tmp, 'initial_prompts.json')
+        config.image_cache_dir = os.path.join(tmp, 'images')
+        config.chat_rate_limit = 1e9  # Measure the bot, not Twitch's rate limit
+        config.chat_burst = 1000000
+        backend = FakeLlmBackend(
+            latency=lognormal_latency(rng, llm_latency), token_delay=token_delay
+        )
+        store = GameStore(
+            os.path.join(tmp, 'game.db'), flush_interval=config.storage_flush_interval
+        )
+        game = LlmGame(backend=backend, store=store, stored=store.load())
+        game_channel = GameChannel(game, channel_name='benchmark')
+        game.hooks = game_channel
+        game_channel.channel = FakeChannel(name='benchmark')
+        game_channel.chat_queue.start()
+        store.start()
+        chat = SimulatedChat(LlmTwitchBot([game_channel]), game_channel, viewers, rng, weights)
+
+        turn_latencies = []
+        gc.collect()
+        rss_start = _rss_bytes()
+        rss_warm = rss_start
+        start = time.perf_counter()
+        for turn in range(turns):
+            await chat.burst(commands_per_turn)
+            if game.background_task is None:
+                await chat.send(chat.users[0], '!action wait and listen')
+            task = game.background_task
+            turn_start = time.perf_counter()
+            game.end_vote()
+            await task
+            turn_latencies.append(time.perf_counter() - turn_start)
+            if turn == min(10, turns - 1):
+                gc.collect()
+                rss_warm = _rss_bytes()
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        rss_end = _rss_bytes()
+
+        await game_channel.close()
+        await game.close()
+        await game.generator.image_cache.close()
+
+    command_latencies = [latency for values in chat.latencies.values() for latency in values]
+    return {
+        'turns': turns,
+        'commands': len(command_latencies),
+        'commands_per_second': len(command_latencies) / elapsed,
+        'command_p50_ms': percentile(command_latencies, 50) * 1000,
+        'command_p99_ms': percentile(command_latencies, 99) * 1000,
+        **{
+            f'{command}_p99_ms': percentile(values, 99) * 1000
+            for command, values in chat.latencies.items()
+        },
+        'turn_p50_ms': percentile(turn_latencies, 50) * 1000,
+        'turn_p99_ms': percentile(turn_latencies, 99) * 1000,
+        'chat_messages_sent': len(game_channel.channel.messages),
+        'rss_start_mb': rss_start / 2**20,
+        'rss_growth_after_warmup_mb': (rss_end - rss_warm) / 2**20,
+    }
+
+
+def _best_of(repeat: int, func: Callable[[], object]) -> float:
+    """Returns the fastest of repeat runs of func in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+async def run_micro_benchmarks(seed: int = 0) -> dict:
+    """Times individual hot paths at sizes beyond what the load test reaches"""
+    from fastapi.testclient import TestClient
+
+    from .app import app
+    from .llm_game import LlmGame
+    from .models import Proposal, StoryEntry
+    from .proposal_index import ProposalIndex
+    from .scoring import PointsLedger
+    from .storage import GameStore
+    from .story_history import StoryHistory
+
+    rng = random.Random(seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp, _quiet():
+        config.initial_prompt_pool_path = os.path.join(tmp, 'initial_prompts.json')
+        config.image_cache_dir = os.path.join(tmp, 'images')
+
+        # Story history with 10k entries, served by the API
+        entries = [
+            StoryEntry(story_action=f'action {i}', narration_result='Steam hisses. ' * 40)
+            for i in range(10000)
+        ]
+        game = LlmGame(backend=FakeLlmBackend(), stored=None)
+        history = StoryHistory(config.story_hot_entries)
+        history.extend(entries)
+        game.generator.past_story_entries = history
+        app.state.registry = _SingleGameRegistry(game)
+        app.state.image_cache = game.generator.image_cache
+        client = TestClient(app)
+        results['story_history_10k_cold_ms'] = _best_of(
+            1, lambda: client.get('/story-history')
+        ) * 1000
+        results['story_history_10k_warm_ms'] = _best_of(
+            5, lambda: client.get('/story-history')
+        ) * 1000
+        etag = client.get('/story-history').headers['etag']
+        results['story_history_10k_not_modified_ms'] = _best_of(
+            20, lambda: client.get('/story-history', headers={'If-None-Match': etag})
+        ) * 1000
+        results['story_history_page_ms'] = _best_of(
+            20, lambda: client.get('/story-history', params={'after': 9900, 'limit': 50})
+        ) * 1000
+        await game.generator.images.close()
+
+        # Votes recorded for storage, and the batched write they turn into
+        store = GameStore(os.path.join(tmp, 'votes.db'))
+        store.load()
+        game = LlmGame(backend=FakeLlmBackend(), store=store)
+        for i in range(config.max_proposals):
+            game._insert_proposal(Proposal(user='benchmark', message=f'proposal {i}', vote=0))
+        users = [f'viewer{i}' for i in range(10000)]
+        start = time.perf_counter()
+        for user in users:
+            game.vote(rng.randint(1, config.max_proposals), user=user)
+        results['vote_us'] = (time.perf_counter() - start) / len(users) * 1e6
+        start = time.perf_counter()
+        await store.flush()
+        results['vote_flush_ms'] = (time.perf_counter() - start) * 1000
+        await store.close()
+        await game.generator.images.close()
+
+        # Points of 100k viewers
+        ledger = PointsLedger()
+        start = time.perf_counter()
+        for i in range(100000):
+            ledger.add(f'viewer{i}', rng.randrange(1000))
+        results['points_add_100k_ms'] = (time.perf_counter() - start) * 1000
+        results['points_add_to_all_100k_us'] = _best_of(
+            100, lambda: ledger.add_to_all(20)
+        ) * 1e6
+        results['points_top5_100k_us'] = _best_of(100, lambda: ledger.top(5)) * 1e6
+
+        # Near-duplicate lookups among a full round of proposals
+        index = ProposalIndex(config.proposal_merge_threshold)
+        for i in range(config.max_proposals):
+            index.add(i + 1, f'{rng.choice(SimulatedChat.actions)} number {i}')
+        results['proposal_find_us'] = _best_of(
+            100, lambda: index.find('open the brass door number 7')
+        ) * 1e6
+    return results
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_startup_benchmark(repeat: int = 3, timeout: float = 60.0) -> dict:
+    """
+    Times importing the app and launching it until /proposals is served, in
+    fresh interpreters like a real launch. The game starts from an empty
+    database with the fake LLM backend, without joining Twitch.
+
+    Args:
+        repeat: Number of launches, the fastest counts.
+        timeout: Seconds before a launch is considered hung.
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    import_code = (
+        'import time; start = time.perf_counter(); import twitch_plays_llm.app; '
+        'print(time.perf_counter() - start)'
+    )
+    import_seconds, launch_seconds = [], []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(
+                os.environ,
+                PYTHONPATH=os.pathsep.join([package_root, os.environ.get('PYTHONPATH', '')]),
+                ROLE='all',
+                LLM_BACKEND='fake',
+                TWITCH_CONNECT='false',
+                TWITCH_CHANNEL_NAME='benchmark',
+                TWITCH_EXTRA_CHANNEL_NAMES='[]',
+                DATABASE_PATH=os.path.join(tmp, 'game.db'),
+                INITIAL_PROMPT_POOL_PATH=os.path.join(tmp, 'initial_prompts.json'),
+                IMAGE_CACHE_DIR=os.path.join(tmp, 'images'),
+                SLOW_CALLBACK_MS='0',
+            )
+            output = subprocess.run(
+                [sys.executable, '-c', import_code],
+                env=env, cwd=tmp, capture_output=True, text=True, check=True,
+            ).stdout
+            import_seconds.append(float(output))
+
+            port = _free_port()
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'uvicorn', 'twitch_plays_llm.app:app', '--port', str(port)],
+                env=env, cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            try:
+                while True:
+                    try:
+                        url = f'http://127.0.0.1:{port}/proposals'
+                        with urllib.request.urlopen(url, timeout=1) as response:
+                            if response.status == 200:
+                                break
+                    except OSError:
+                        if process.poll() is not None:
+                            raise RuntimeError('The app exited during startup')
+                        if time.perf_counter() - start > timeout:
+                            raise TimeoutError('The app did not start in time')
+                        time.sleep(0.005)
+                launch_seconds.append(time.perf_counter() - start)
+            finally:
+                process.terminate()
+                process.wait(10)
+    return {
+        'import_app_ms': min(import_seconds) * 1000,
+        'launch_to_proposals_ms': min(launch_seconds) * 1000,
+    }
+
+
+class _SingleGameRegistry:
+    """Just enough of GameRegistry for the API routes"""
+
+    def __init__(self, game):
+        self.game = game
+        self.channels = [config.twitch_channel_name]
+
+    def get(self, channel: str):
+        return self.game
+
+
+# Arguments that change the workload, results are only comparable if they match
+workload_parameters = (
+    'viewers', 'turns', 'commands_per_turn', 'llm_latency', 'token_delay', 'seed'
+)
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Returns the results that regressed beyond the tolerance.
+
+    Metrics ending in _per_second are better when higher, all others when lower.
+
+    Args:
+        results: Freshly measured results.
+        baseline: Previously stored results.
+        tolerance: Allowed relative slowdown (ie. 0.25 for 25%).
+    """
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if not isinstance(base, (int, float)) or base <= 0 or name in ('turns', 'commands'):
+            continue
+        if name.endswith('_per_second'):
+            regressed = value < base * (1 - tolerance)
+        else:
+            regressed = value > base * (1 + tolerance)
+        if regressed:
+            regressions.append(f'{name}: {value:.3f} (baseline {base:.3f})')
+    return regressions
+
+
+async def run_benchmarks(args) -> int:
+    """Runs the benchmarks selected by the command line arguments, returning the exit code"""
+    results = {}
+    if not args.skip_load:
+        results.update(
+            await run_load_test(
+                viewers=args.viewers,
+                turns=args.turns,
+                commands_per_turn=args.commands_per_turn,
+                llm_latency=args.llm_latency,
+                token_delay=args.token_delay,
+                seed=args.seed,
+            )
+        )
+    if not args.skip_micro:
+        results.update(await run_micro_benchmarks(args.seed))
+    if not args.skip_startup:
+        results.update(run_startup_benchmark())
+    for name, value in results.items():
+        print(f'{name:40} {value:12.3f}')
+    launch_ms = results.get('launch_to_proposals_ms')
+    if launch_ms is not None and launch_ms > args.startup_target_ms:
+        print(f'Startup took {launch_ms:.0f}ms, over the {args.startup_target_ms:.0f}ms target')
+        return 1
+
+    parameters = {name: getattr(args, name) for name in workload_parameters}
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or '.', exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({**results, 'parameters': parameters}, f, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != parameters:
+            print(
+                f'Not comparing to {args.baseline}, it was recorded with different parameters:\n'
+                f'  baseline: {baseline.get("parameters")}\n  this run: {parameters}'
+            )
+            return 1
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions:\n  ' + '\n  '.join(regressions))
+            return 1
+        print(f'No regressions against {args.baseline}')
+    return 0
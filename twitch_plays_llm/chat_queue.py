@@ -0,0 +1,252 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from contextlib import suppress
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+from loguru import logger
+
+
+Message = Union[str, Callable[[], Optional[str]]]
+
+
+class ChatPriority:
+    narration = 0  # Story output, never dropped
+    reply = 1  # Direct replies to commands
+    tally = 2  # Coalesced status updates like vote counts
+
+
+class _QueuedMessage:
+    __slots__ = ('priority', 'seq', 'message', 'key', 'expires_at', 'not_before')
+
+    def __init__(self, priority, seq, message, key, expires_at, not_before):
+        self.priority = priority
+        self.seq = seq
+        self.message = message
+        self.key = key
+        self.expires_at = expires_at
+        self.not_before = not_before
+
+    def __lt__(self, other: '_QueuedMessage') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    Args:
+        rate: Tokens added per second.
+        burst: Maximum number of stored tokens.
+        clock: Returns the current time in seconds.
+    """
+
+    def __init__(self, rate: float, burst: int, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class OutboundChatQueue:
+    """
+    Prioritized, rate-limited queue of outgoing chat messages.
+
+    Putting a message never blocks. A background task sends queued messages
+    in priority order as fast as the token bucket allows. Messages with a key
+    are coalesced: putting a message with the key of one still waiting
+    replaces it, and messages of the same key are sent at most once per
+    min_interval. A message may be a function, evaluated at send time so
+    status updates are never out of date. Messages waiting longer than their
+    max age are dropped.
+
+    Args:
+        send: Coroutine sending a message to the chat.
+        rate: Messages per second allowed on average.
+        burst: Messages that may be sent at once after a quiet period.
+        max_age: Default seconds after which a waiting message is dropped.
+        clock: Returns the current time in seconds, on the clock of the event loop.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        rate: float,
+        burst: int,
+        max_age: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.send = send
+        self.clock = clock
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.max_age = max_age
+        self._heap: List[_QueuedMessage] = []
+        self._keyed: Dict[str, _QueuedMessage] = {}
+        self._last_sent: Dict[str, float] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def put(
+        self,
+        message: Message,
+        priority: int = ChatPriority.reply,
+        key: Optional[str] = None,
+        max_age: Optional[float] = ...,
+        min_interval: float = 0.0,
+    ):
+        """
+        Queues a message without waiting.
+
+        Args:
+            message: The text, or a function returning it (or None to skip).
+            priority: One of ChatPriority, lower is sent first.
+            key: Messages with the same key replace each other while waiting.
+            max_age: Seconds after which the message is dropped, None to never drop.
+            min_interval: Minimum seconds between sent messages with this key.
+        """
+        now = self.clock()
+        max_age = self.max_age if max_age is ... else max_age
+        expires_at = None if max_age is None else now + max_age
+        if key is not None and key in self._keyed:
+            queued = self._keyed[key]
+            queued.message = message
+            queued.expires_at = expires_at
+            self.coalesced += 1
+            return
+        not_before = 0.0
+        if key is not None and key in self._last_sent:
+            not_before = self._last_sent[key] + min_interval
+        queued = _QueuedMessage(priority, next(self._seq), message, key, expires_at, not_before)
+        heapq.heappush(self._heap, queued)
+        if key is not None:
+            self._keyed[key] = queued
+        self._wakeup.set()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+
+    def _pop_due(self) -> Optional[_QueuedMessage]:
+        """Pops the first message that may be sent now, dropping expired ones"""
+        now = self.clock()
+        deferred = []
+        found = None
+        while self._heap:
+            queued = heapq.heappop(self._heap)
+            if queued.expires_at is not None and queued.expires_at < now:
+                self._forget(queued)
+                self.dropped += 1
+                continue
+            if queued.not_before > now:
+                deferred.append(queued)
+                continue
+            found = queued
+            break
+        for queued in deferred:
+            heapq.heappush(self._heap, queued)
+        return found
+
+    def _next_due_delay(self) -> Optional[float]:
+        if not self._heap:
+            return None
+        now = self.clock()
+        return max(0.0, min(queued.not_before for queued in self._heap) - now)
+
+    def _forget(self, queued: _QueuedMessage):
+        if queued.key is not None and self._keyed.get(queued.key) is queued:
+            del self._keyed[queued.key]
+
+    async def _run(self):
+        while True:
+            queued = self._pop_due()
+            if queued is None:
+                self._wakeup.clear()
+                # Not wait_for, which can swallow a cancellation racing with the wakeup
+                delay = self._next_due_delay()
+                timer = None
+                if delay is not None:
+                    timer = asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    if timer:
+                        timer.cancel()
+                continue
+            delay = self.bucket.delay()
+            if delay > 0:
+                # Put it back, a more important message may arrive meanwhile
+                heapq.heappush(self._heap, queued)
+                await asyncio.sleep(delay)
+                continue
+            self._forget(queued)
+            message = queued.message() if callable(queued.message) else queued.message
+            if queued.key is not None:
+                self._last_sent[queued.key] = self.clock()
+            if not message:
+                continue
+            self.bucket.take()
+            try:
+                await self.send(message)
+                self.sent += 1
+            except Exception:
+                logger.exception('Failed to send chat message')
+
+
+class FakeChannel:
+    """
+    Stand-in for a Twitch channel that records sent messages, for testing.
+
+    Args:
+        latency: Seconds each send takes.
+        clock: Returns the current time in seconds, recorded for each message.
+        name: Name of the channel.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        clock: Callable[[], float] = time.monotonic,
+        name: str = 'test',
+    ):
+        self.name = name
+        self.latency = latency
+        self.clock = clock
+        self.messages: List[str] = []
+        self.sent_at: List[float] = []
+
+    async def send(self, message: str):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        self.messages.append(message)
+        self.sent_at.append(self.clock())
@@ -1,20 +1,122 @@
+from typing import Dict, List, Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class Settings(BaseSettings):
-    twitch_bot_username: str
-    twitch_bot_client_id: str
-    twitch_channel_name: str
-    openai_api_key: str
+    # Credentials are checked with require() where they are used, so tools like
+    # the benchmark and the api role run without them
+    twitch_bot_username: str = ''
+    twitch_bot_client_id: str = ''
+    twitch_channel_name: str = ''
+    twitch_extra_channel_names: List[str] = []  # more channels hosted by the same process, each with its own game
+    twitch_connect: bool = True  # join the Twitch chats, disable to run the games offline (ie. to benchmark startup)
+    openai_api_key: str = ''
 
-    vote_delay: int = 30
+    vote_delay: int = 30  # maximum duration of a vote in seconds
+    vote_min_seconds: float = 10  # votes never close earlier than this
+    vote_quorum: float = 0.9  # fraction of active chatters whose votes close the vote early, above 1 to disable
+    vote_idle_seconds: float = 10  # seconds without new votes that close the vote early, 0 to disable
+    vote_active_seconds: float = 300  # chatters count as active for this long after their last command
     vote_points: int = 100  # points give per vote for all users
     action_cost: int = 100 # points required per action for all users
     vote_accumulation: int = 20 # points per voting round for all users
     points_earned_per_vote: int = 100 # points earned per vote for the user who is voted for
     backend_port: int = 9511
+    max_proposals: int = 50  # per round, the least voted is replaced beyond this
+    proposal_merge_threshold: float = 0.8  # similarity of near-duplicate proposals merged into one, above 1 merges exact duplicates only
+
+    llm_backend: str = 'openai'  # 'openai' or 'fake' for offline testing
+    openai_api_base: Optional[str] = None  # ie. the url of a local fake_openai server
+    llm_max_concurrency: int = 8  # max simultaneous LLM and image requests
+    llm_timeout: float = 60.0  # seconds per request attempt
+    llm_max_retries: int = 3
+    # models per task, the first is preferred and the others are fallbacks when it times out
+    llm_task_models: Dict[str, List[str]] = {
+        'default': ['gpt-3.5-turbo'],
+        'narration': ['gpt-3.5-turbo-16k', 'gpt-3.5-turbo'],
+        'speculation': ['gpt-3.5-turbo-16k'],
+        'initial_prompt': ['gpt-3.5-turbo-16k'],
+        'summary': ['gpt-3.5-turbo'],
+        'caption': ['gpt-3.5-turbo'],
+        'quest': ['gpt-3.5-turbo'],
+    }
+    llm_task_timeouts: Dict[str, float] = {'narration': 20.0}  # seconds before falling back to the next model
+    llm_task_deadlines: Dict[str, float] = {'caption': 60.0, 'image': 90.0, 'speculation': 20.0}  # seconds a call may wait for a free slot
+    llm_priority_limits: Dict[str, int] = {'normal': 4, 'background': 2}  # max simultaneous calls of the less urgent classes
+
+    initial_prompt_pool_size: int = 3  # openings generated ahead of time for !reset
+    initial_prompt_pool_path: str = 'initial_prompts.json'
+
+    chat_rate_limit: float = 20 / 30  # messages per second, Twitch allows 20 per 30 seconds
+    chat_burst: int = 5
+    chat_message_max_age: float = 30.0  # seconds before a queued reply is dropped as stale
+    chat_tally_interval: float = 5.0  # minimum seconds between vote tallies
+
+    database_path: str = 'twitch_plays_llm.db'  # viewer points, story and proposals survive restarts
+    storage_flush_interval: float = 1.0  # seconds between batched database writes
+    story_hot_entries: int = 64  # recent story entries kept in memory, older ones are read from a spill file
+    story_spill_dir: str = ''  # directory of the spill files, the system temp dir if empty
+
+    speculative_narration: bool = False  # pre-generate narrations of leading proposals during the vote
+    speculation_top_k: int = 2
+    speculation_max_concurrent: int = 2
+
+    context_token_budget: int = 12000  # max prompt tokens sent per narration
+    context_keep_last_turns: int = 8  # recent turns replayed verbatim, older ones are summarized
+    context_summary_max_words: int = 250
+
+    image_workers: int = 1  # images generated at once per channel
+    image_queue_size: int = 1  # waiting images, older scenes are dropped beyond this
+    image_cache_dir: str = 'image_cache'  # generated images are downloaded and served from here
+    image_cache_max_mb: int = 512
+    caption_cache_threshold: float = 0.9  # scene similarity to reuse a caption, above 1 disables
+    image_reuse_threshold: float = 0.7  # caption similarity to reuse an image, above 1 disables
+    semantic_cache_size: int = 256  # captions and images remembered for reuse
+
+    debug: bool = False  # asyncio debug mode and debug logs, slows every callback
+    log_level: str = 'INFO'
+    uvloop: bool = True  # use uvloop as the event loop when installed
+    slow_callback_ms: float = 100  # report callbacks blocking the event loop longer than this, 0 to disable
+
+    profiling: bool = False  # time calls of profiled functions
+    profiling_token: str = ''  # enables POST /profiling for requests sending it as X-Profiling-Token
+
+    role: str = 'all'  # 'all', 'owner' (bot and game, publishes state) or 'api' (read-only workers)
+    state_store_path: str = 'twitch_plays_llm.state.db'  # shared between the owner and api workers
+    state_publish_interval: float = 0.25  # seconds between batched state publishes
 
     model_config = SettingsConfigDict(env_file='.env')
 
+    def require(self, *names: str):
+        """Raises a ValueError naming the given settings that are empty"""
+        missing = [name for name in names if not getattr(self, name)]
+        if missing:
+            raise ValueError(f'Missing settings (set them in .env): {", ".join(missing)}')
+
+
+class _LazySettings:
+    """
+    Reads the settings on first use rather than on import, so importing the
+    package has no side effects and environment changes made before the
+    first use (ie. by the command line) are picked up.
+    """
+
+    def __init__(self):
+        object.__setattr__(self, '_settings', None)
+
+    def _load(self) -> Settings:
+        settings = object.__getattribute__(self, '_settings')
+        if settings is None:
+            settings = Settings()
+            object.__setattr__(self, '_settings', settings)
+        return settings
+
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name: str, value):
+        setattr(self._load(), name, value)
+
 
-config = Settings()
+config: Settings = _LazySettings()  # type: ignore[assignment]
@@ -0,0 +1,174 @@
+import asyncio
+
+from typing import Awaitable, Callable, List, Optional, Sequence
+
+from loguru import logger
+
+from . import metrics
+from .models import StoryEntry
+
+
+Messages = List[dict]
+
+
+class TokenCounter:
+    """
+    Counts prompt tokens locally.
+
+    Uses tiktoken when it is installed and otherwise falls back to an
+    approximation of four characters per token.
+
+    Args:
+        model: The model whose tokenizer should be used.
+    """
+
+    def __init__(self, model: str = 'gpt-3.5-turbo'):
+        try:
+            import tiktoken
+
+            self.encoding = tiktoken.encoding_for_model(model)
+        except (ImportError, KeyError):
+            self.encoding = None
+
+    def count(self, text: str) -> int:
+        if self.encoding is None:
+            return (len(text) + 3) // 4
+        return len(self.encoding.encode(text))
+
+    def count_message(self, message: dict) -> int:
+        # Every message carries a few tokens of role/formatting overhead
+        return 4 + self.count(message['content'])
+
+    def count_messages(self, messages: Messages) -> int:
+        return 2 + sum(self.count_message(message) for message in messages)
+
+
+def story_entry_messages(story_entry: StoryEntry) -> Messages:
+    """Converts a story entry into the user/assistant messages it represents"""
+    messages = []
+    if story_entry.story_action:
+        messages.append({'role': 'user', 'content': story_entry.story_action})
+    if story_entry.narration_result:
+        messages.append({'role': 'assistant', 'content': story_entry.narration_result})
+    return messages
+
+
+class ContextWindow:
+    """
+    Keeps the narration prompt within a token budget.
+
+    The most recent turns are replayed verbatim while older turns are folded
+    into a rolling summary. The summary is extended in the background after a
+    turn is committed, so building a prompt never waits for the LLM.
+
+    Args:
+        summarize: Coroutine taking the current summary and the new story
+            entries to fold in, returning the updated summary.
+        token_budget: Maximum number of prompt tokens sent per turn.
+        keep_last_turns: Number of most recent turns always kept verbatim.
+        counter: Tokenizer used to measure the prompt.
+    """
+
+    def __init__(
+        self,
+        summarize: Callable[[str, List[StoryEntry]], Awaitable[str]],
+        token_budget: int,
+        keep_last_turns: int,
+        counter: Optional[TokenCounter] = None,
+    ):
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.keep_last_turns = keep_last_turns
+        self.counter = counter or TokenCounter()
+        self.summary = ''
+        self.summarized_count = 0  # Number of leading story entries folded into the summary
+        self.summary_task: Optional[asyncio.Task] = None
+        self.dropping_logged = False  # Warned about dropped turns since the last summary update
+
+    def reset(self):
+        """Forgets the summary, ie. when the story restarts"""
+        if self.summary_task:
+            self.summary_task.cancel()
+        self.summary_task = None
+        self.summary = ''
+        self.summarized_count = 0
+        self.dropping_logged = False
+
+    def build_messages(
+        self,
+        system_messages: Messages,
+        entries: Sequence[StoryEntry],
+        story_action: str,
+        record: bool = True,
+    ) -> Messages:
+        """
+        Builds the prompt for the next turn.
+
+        Args:
+            system_messages: Leading messages that are always sent.
+            entries: The whole story so far.
+            story_action: The action for the next turn.
+            record: Whether to count the prompt in the per-turn metrics.
+
+        Returns:
+            The messages to send to the chat completion API.
+        """
+        action_message = {'role': 'user', 'content': story_action}
+        summary_messages = []
+        if self.summary:
+            summary_messages = [
+                {'role': 'system', 'content': 'Summary of the story so far: ' + self.summary}
+            ]
+        fixed = system_messages + summary_messages + [action_message]
+        remaining = self.token_budget - self.counter.count_messages(fixed)
+
+        # Walk back from the newest turn, taking everything not yet summarized
+        # that fits. Turns that don't fit are dropped until the summary catches up
+        history = []
+        for index in range(len(entries) - 1, self.summarized_count - 1, -1):
+            turn = story_entry_messages(entries[index])
+            cost = sum(self.counter.count_message(message) for message in turn)
+            if cost > remaining:
+                if not self.dropping_logged:
+                    self.dropping_logged = True
+                    logger.warning(
+                        'Dropping {} story entries over token budget until the summary catches up',
+                        index + 1 - self.summarized_count,
+                    )
+                break
+            remaining -= cost
+            history[:0] = turn
+
+        messages = system_messages + summary_messages + history + [action_message]
+        if record:
+            tokens = self.token_budget - remaining
+            metrics.narration_prompt_tokens.observe(tokens)
+            logger.info('Narration prompt: {} tokens, {} messages', tokens, len(messages))
+        return messages
+
+    def schedule_summary_update(self, entries: Sequence[StoryEntry]):
+        """
+        Starts folding turns older than keep_last_turns into the summary in
+        the background, unless an update is already running.
+
+        Args:
+            entries: The whole story so far.
+        """
+        if self.summary_task and not self.summary_task.done():
+            return
+        if len(entries) - self.keep_last_turns <= self.summarized_count:
+            return
+        self.summary_task = asyncio.create_task(self._update_summary(entries))
+
+    async def _update_summary(self, entries: Sequence[StoryEntry]):
+        end = len(entries) - self.keep_last_turns
+        new_entries = entries[self.summarized_count : end]
+        try:
+            summary = await self.summarize(self.summary, new_entries)
+        except Exception:
+            logger.exception('Failed to update story summary')
+            return
+        self.summary = summary
+        self.summarized_count = end
+        self.dropping_logged = False
+        logger.debug('Story summary now covers {} entries', end)
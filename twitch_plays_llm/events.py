@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set
+
+from pydantic import BaseModel
+
+
+class GameEvent(BaseModel):
+    """A single state change pushed to overlay clients."""
+
+    seq: int
+    type: str
+    data: Dict[str, Any] = {}
+
+    def to_sse(self) -> str:
+        """Formats the event as a server-sent events message."""
+        return f'id: {self.seq}\nevent: {self.type}\ndata: {json.dumps(self.data)}\n\n'
+
+
+class EventBus:
+    """
+    Fan-out of game events to any number of subscribers.
+
+    Every event gets a monotonically increasing sequence number and is kept in
+    a bounded backlog so that a client reconnecting with the last sequence
+    number it saw can resume without refetching the full game state.
+
+    Args:
+        backlog_size: Number of recent events kept for resuming clients.
+        subscriber_queue_size: Maximum number of undelivered events per
+            subscriber before that subscriber is dropped.
+    """
+
+    def __init__(self, backlog_size: int = 1024, subscriber_queue_size: int = 256):
+        self.seq = 0
+        self.backlog: Deque[GameEvent] = deque(maxlen=backlog_size)
+        self.subscriber_queue_size = subscriber_queue_size
+        self.subscribers: Set[asyncio.Queue] = set()
+
+    def publish(self, type: str, **data) -> GameEvent:
+        """
+        Publishes an event to all subscribers.
+
+        Args:
+            type: The kind of event (ie. "proposal_added").
+            **data: JSON-serializable event payload.
+
+        Returns:
+            The published event.
+        """
+        self.seq += 1
+        event = GameEvent(seq=self.seq, type=type, data=data)
+        self.backlog.append(event)
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Slow client, disconnect it. It will reconnect and resume from its last seq
+                self.subscribers.discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+        return event
+
+    def events_since(self, seq: int) -> Optional[List[GameEvent]]:
+        """
+        Returns the backlogged events after the given sequence number.
+
+        Args:
+            seq: The last sequence number seen by the client.
+
+        Returns:
+            The missed events, or None if some of them are no longer in the backlog.
+        """
+        if seq == self.seq:
+            return []
+        if seq > self.seq or not self.backlog or self.backlog[0].seq > seq + 1:
+            return None
+        return [event for event in self.backlog if event.seq > seq]
+
+    def subscribe(self) -> asyncio.Queue:
+        """
+        Registers a new subscriber.
+
+        Returns:
+            A queue receiving every published event. A None item means the
+            subscriber fell too far behind and was disconnected.
+        """
+        queue = asyncio.Queue(self.subscriber_queue_size)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """Removes a subscriber previously returned by subscribe."""
+        self.subscribers.discard(queue)
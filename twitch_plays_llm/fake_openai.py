@@ -0,0 +1,92 @@
+import json
+import time
+
+from typing import Optional
+
+from aiohttp import web
+
+from .llm_backend import FakeLlmBackend
+
+
+class FakeOpenAiServer:
+    """
+    Local HTTP server imitating the OpenAI chat completion and image endpoints.
+
+    Point openai_api_base at its url to exercise the real OpenAiBackend
+    (pooling, timeouts, retries and streaming) without network access.
+
+    Args:
+        backend: Provides the fake responses and their latency.
+        host: Interface to listen on.
+        port: Port to listen on, 0 to pick a free one.
+    """
+
+    def __init__(
+        self, backend: Optional[FakeLlmBackend] = None, host: str = '127.0.0.1', port: int = 0
+    ):
+        self.backend = backend or FakeLlmBackend()
+        self.host = host
+        self.port = port
+        self.runner: Optional[web.AppRunner] = None
+        self.requests = 0
+
+        self.app = web.Application()
+        self.app.router.add_post('/v1/chat/completions', self.chat_completions)
+        self.app.router.add_post('/v1/images/generations', self.image_generations)
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}/v1'
+
+    async def start(self) -> str:
+        """Starts serving, returning the API base url"""
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self.url
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        model = body.get('model', '')
+        if not body.get('stream'):
+            content = await self.backend.chat(body['messages'], model)
+            return web.json_response(
+                {
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': model,
+                    'choices': [
+                        {
+                            'index': 0,
+                            'message': {'role': 'assistant', 'content': content},
+                            'finish_reason': 'stop',
+                        }
+                    ],
+                }
+            )
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        async for token in self.backend.stream_chat(body['messages'], model):
+            chunk = {
+                'object': 'chat.completion.chunk',
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}],
+            }
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+    async def image_generations(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        url = await self.backend.create_image(body['prompt'], body.get('size', '1024x1024'))
+        return web.json_response({'created': int(time.time()), 'data': [{'url': url}]})
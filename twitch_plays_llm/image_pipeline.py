@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+
+from collections import OrderedDict, deque
+from contextlib import suppress
+from typing import TYPE_CHECKING, Awaitable, Callable, Deque, List, Optional, Tuple
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    import aiohttp
+
+
+class ImageCache:
+    """
+    Disk cache of generated images, so the overlay doesn't hot-link
+    short-lived OpenAI URLs.
+
+    Files are named by the hash of their content, so identical images are
+    stored once and a name never changes meaning. The least recently used
+    files are evicted once the directory grows past max_bytes. The directory
+    is only read on first use and created on the first write.
+
+    Args:
+        directory: Directory the images are stored in.
+        max_bytes: Maximum total size of the cached files.
+        url_prefix: URL path the images are served from.
+    """
+
+    name_pattern = re.compile(r'^[0-9a-f]{64}\.png$')
+
+    def __init__(self, directory: str, max_bytes: int, url_prefix: str = '/images'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.url_prefix = url_prefix
+        self.session: Optional['aiohttp.ClientSession'] = None
+        self.sizes: 'OrderedDict[str, int]' = OrderedDict()  # Name -> size, oldest first
+        self.total_bytes = 0
+        self.scanned = False
+        self._scan_lock = threading.Lock()  # Images are also looked up from the threadpool
+
+    def _scan(self):
+        """Reads the sizes of the images cached by earlier runs, once"""
+        with self._scan_lock:
+            if self.scanned:
+                return
+            files = []
+            with suppress(FileNotFoundError):
+                for name in os.listdir(self.directory):
+                    if self.name_pattern.match(name):
+                        stat = os.stat(os.path.join(self.directory, name))
+                        files.append((stat.st_mtime, name, stat.st_size))
+            for _, name, size in sorted(files):
+                self.sizes[name] = size
+                self.total_bytes += size
+            self.scanned = True
+
+    def path(self, name: str) -> Optional[str]:
+        """
+        Returns the path of a cached image and marks it as recently used.
+
+        Args:
+            name: File name of the image, as in its URL.
+        """
+        if not self.name_pattern.match(name):
+            return None
+        if not self.scanned:
+            self._scan()
+        path = os.path.join(self.directory, name)
+        if name in self.sizes:
+            self.sizes.move_to_end(name)
+        elif not os.path.exists(path):
+            return None  # Written by another process (ie. the owner) if it exists
+        return path
+
+    async def store(self, url: str) -> str:
+        """
+        Downloads an image into the cache.
+
+        Args:
+            url: URL of the generated image.
+
+        Returns:
+            The URL the cached image is served from, or the given one if it
+            isn't an HTTP URL (ie. from the fake backend).
+        """
+        if not url.startswith(('http://', 'https://')):
+            return url
+        import aiohttp
+
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            data = await response.read()
+        name = hashlib.sha256(data).hexdigest() + '.png'
+        loop = asyncio.get_running_loop()
+        if not self.scanned:
+            await loop.run_in_executor(None, self._scan)
+        if name in self.sizes:
+            self.sizes.move_to_end(name)
+        else:
+            evicted = self._evict(len(data))
+            await loop.run_in_executor(None, self._write, name, data, evicted)
+            self.sizes[name] = len(data)
+            self.total_bytes += len(data)
+        return f'{self.url_prefix}/{name}'
+
+    def _evict(self, new_bytes: int) -> List[str]:
+        """Forgets the least recently used images to make room, returning their names"""
+        evicted = []
+        while self.sizes and self.total_bytes + new_bytes > self.max_bytes:
+            name, size = self.sizes.popitem(last=False)
+            self.total_bytes -= size
+            evicted.append(name)
+        return evicted
+
+    def _write(self, name: str, data: bytes, evicted: List[str]):
+        os.makedirs(self.directory, exist_ok=True)
+        for old_name in evicted:
+            with suppress(FileNotFoundError):
+                os.remove(os.path.join(self.directory, old_name))
+        tmp_path = os.path.join(self.directory, name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+
+class ImagePipeline:
+    """
+    Bounded queue of image jobs run by a fixed number of workers.
+
+    Only the newest scenes matter to the overlay, so when more than
+    max_pending jobs are waiting the oldest waiting job is dropped.
+
+    Args:
+        workers: Number of images generated at once.
+        max_pending: Number of jobs that may wait for a worker.
+    """
+
+    def __init__(self, workers: int = 1, max_pending: int = 1):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending: Deque[Tuple[Callable[[], Awaitable[None]], asyncio.Future]] = deque()
+        self.tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self.completed = 0
+        self.superseded = 0
+
+    def submit(self, job: Callable[[], Awaitable[None]]) -> asyncio.Future:
+        """
+        Queues a job without waiting.
+
+        Returns:
+            Future resolving to True once the job ran, or False if it was
+            superseded by newer jobs.
+        """
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((job, future))
+        while len(self.pending) > self.max_pending:
+            _, stale = self.pending.popleft()
+            stale.set_result(False)
+            self.superseded += 1
+        self._wakeup.set()
+        return future
+
+    def clear(self):
+        """Drops all waiting jobs, ie. after the story was reset"""
+        while self.pending:
+            _, stale = self.pending.popleft()
+            stale.set_result(False)
+            self.superseded += 1
+
+    async def close(self):
+        self.clear()
+        for task in self.tasks:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        self.tasks = []
+
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            job, future = self.pending.popleft()
+            try:
+                await job()
+            except Exception:
+                logger.exception('Image job failed')
+            finally:
+                self.completed += 1
+                if not future.done():
+                    future.set_result(True)
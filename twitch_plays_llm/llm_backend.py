@@ -0,0 +1,515 @@
+import asyncio
+import random
+import time
+
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Deque, Dict, List, Optional, Union
+
+from loguru import logger
+
+from . import metrics
+from .config import config
+
+if TYPE_CHECKING:
+    import aiohttp
+
+
+Messages = List[dict]
+
+
+class LlmPriority:
+    critical = 0  # Narration the turn is waiting for
+    normal = 1  # Captions and images of the current scene
+    background = 2  # Summaries, speculation, quests and opening prompts
+
+
+task_priorities = {
+    'narration': LlmPriority.critical,
+    'caption': LlmPriority.normal,
+    'image': LlmPriority.normal,
+    'speculation': LlmPriority.background,
+    'summary': LlmPriority.background,
+    'quest': LlmPriority.background,
+    'initial_prompt': LlmPriority.background,
+}
+
+
+def task_models(task: str) -> List[str]:
+    """Models a task is routed to, the first one preferred and the others as fallbacks"""
+    return config.llm_task_models.get(task) or config.llm_task_models['default']
+
+
+class LlmDeadlineExceeded(asyncio.TimeoutError):
+    """A call waited for the scheduler past the point where its result was useful"""
+
+
+class LlmBackend:
+    """
+    Interface to the language and image models used by the game.
+    """
+
+    async def chat(
+        self, messages: Messages, model: Optional[str] = None, task: str = 'default'
+    ) -> str:
+        """
+        Generates a chat completion.
+
+        Args:
+            messages: The conversation to complete.
+            model: The name of the model to use, routed by task if not given.
+            task: What the completion is for (ie. "narration"), which decides
+                its model and priority.
+
+        Returns:
+            The content of the completion.
+        """
+        raise NotImplementedError
+
+    def stream_chat(
+        self, messages: Messages, model: Optional[str] = None, task: str = 'default'
+    ) -> AsyncIterator[str]:
+        """
+        Generates a chat completion, yielding its tokens as they arrive.
+
+        Args:
+            messages: The conversation to complete.
+            model: The name of the model to use, routed by task if not given.
+            task: What the completion is for, as in chat.
+        """
+        raise NotImplementedError
+
+    async def create_image(self, prompt: str, size: str = '1024x1024') -> str:
+        """
+        Generates an image.
+
+        Args:
+            prompt: Description of the image.
+            size: Dimensions of the image (ie. "1024x1024").
+
+        Returns:
+            The URL of the generated image.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """Releases any held connections"""
+        pass
+
+
+class OpenAiBackend(LlmBackend):
+    """
+    Calls the OpenAI API natively from the event loop.
+
+    All requests share one pooled HTTP session. Each call is bounded by a
+    timeout and retried with jittered exponential backoff on transient
+    errors, and at most max_concurrency requests are in flight at once.
+    The openai client is slow to import, so that happens on the first call.
+
+    Args:
+        max_concurrency: Maximum number of simultaneous requests.
+        timeout: Seconds before a single attempt is abandoned.
+        max_retries: Number of retries after the first failed attempt.
+        api_base: Alternative API URL, ie. a local fake server.
+        api_key: OpenAI API key.
+    """
+
+    backoff_base = 0.5
+    backoff_cap = 8.0
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        timeout: float = 60.0,
+        max_retries: int = 3,
+        api_base: Optional[str] = None,
+        api_key: Optional[str] = None,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.api_base = api_base
+        self.api_key = api_key
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.session: Optional['aiohttp.ClientSession'] = None
+
+    @staticmethod
+    def _retry_errors(openai) -> tuple:
+        return (
+            openai.error.Timeout,
+            openai.error.APIConnectionError,
+            openai.error.RateLimitError,
+            openai.error.ServiceUnavailableError,
+            openai.error.TryAgain,
+            asyncio.TimeoutError,
+        )
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        import aiohttp
+
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            )
+        return self.session
+
+    async def _request(self, resource: str, **kwargs):
+        """Runs acreate of an openai resource (ie. "Image") with retries, returning its response"""
+        import openai
+
+        create = getattr(openai, resource).acreate
+        retry_errors = self._retry_errors(openai)
+        if self.api_base:
+            kwargs['api_base'] = self.api_base
+        if self.api_key:
+            kwargs['api_key'] = self.api_key
+        for attempt in range(self.max_retries + 1):
+            # openai reads the shared session from a context variable, so set
+            # it right around the call (without any yield in between)
+            token = openai.aiosession.set(self._get_session())
+            try:
+                return await asyncio.wait_for(create(**kwargs), self.timeout)
+            except retry_errors as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2**attempt))
+                logger.warning('OpenAI request failed ({!r}), retrying in {:.2f}s', e, delay)
+                await asyncio.sleep(delay)
+            finally:
+                openai.aiosession.reset(token)
+
+    async def chat(
+        self, messages: Messages, model: Optional[str] = None, task: str = 'default'
+    ) -> str:
+        async with self.semaphore:
+            response = await self._request(
+                'ChatCompletion',
+                model=model or task_models(task)[0],
+                messages=messages,
+                request_timeout=self.timeout,
+            )
+        return response['choices'][0]['message']['content']
+
+    async def stream_chat(
+        self, messages: Messages, model: Optional[str] = None, task: str = 'default'
+    ) -> AsyncIterator[str]:
+        async with self.semaphore:
+            response = await self._request(
+                'ChatCompletion',
+                model=model or task_models(task)[0],
+                messages=messages,
+                stream=True,
+                request_timeout=self.timeout,
+            )
+            async for part in response:
+                token = part['choices'][0]['delta'].get('content')
+                if token:
+                    yield token
+
+    async def create_image(self, prompt: str, size: str = '1024x1024') -> str:
+        async with self.semaphore:
+            response = await self._request('Image', prompt=prompt, n=1, size=size)
+        return response['data'][0]['url']
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+
+class FakeLlmBackend(LlmBackend):
+    """
+    Offline stand-in for the OpenAI API with configurable latency.
+
+    Args:
+        latency: Seconds before a response starts, or a function returning it
+            (ie. to sample from a latency distribution).
+        token_delay: Seconds between streamed tokens.
+        image_latency: Seconds to generate an image, defaults to latency.
+        capacity: Number of requests served at once, further ones queue up
+            as with a saturated API. Unlimited if not given.
+        model_latency: Latency per model name, overriding latency (ie. to
+            make the preferred model slower than its fallback).
+    """
+
+    narration = (
+        'The gears of Gearlock grind to a halt as you act. A plume of steam bursts from '
+        'a nearby vent, revealing a brass door etched with a clock face. Somewhere above, '
+        'a mechanical pigeon coos impatiently. What will you do next?'
+    )
+
+    def __init__(
+        self,
+        latency: Union[float, Callable[[], float]] = 0.0,
+        token_delay: float = 0.0,
+        image_latency: Union[float, Callable[[], float], None] = None,
+        capacity: Optional[int] = None,
+        model_latency: Optional[Dict[str, float]] = None,
+    ):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.image_latency = latency if image_latency is None else image_latency
+        self.capacity = capacity and asyncio.Semaphore(capacity)
+        self.model_latency = model_latency or {}
+        self.calls = 0
+        self.models: Dict[str, int] = defaultdict(int)  # Model -> number of calls
+
+    @asynccontextmanager
+    async def _serve(self):
+        if self.capacity is None:
+            yield
+        else:
+            async with self.capacity:
+                yield
+
+    @staticmethod
+    async def _wait(latency: Union[float, Callable[[], float]]):
+        delay = latency() if callable(latency) else latency
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _latency(self, model: str) -> Union[float, Callable[[], float]]:
+        self.models[model] += 1
+        return self.model_latency.get(model, self.latency)
+
+    async def chat(
+        self, messages: Messages, model: Optional[str] = None, task: str = 'default'
+    ) -> str:
+        self.calls += 1
+        async with self._serve():
+            await self._wait(self._latency(model or task_models(task)[0]))
+        return self.narration
+
+    async def stream_chat(
+        self, messages: Messages, model: Optional[str] = None, task: str = 'default'
+    ) -> AsyncIterator[str]:
+        self.calls += 1
+        async with self._serve():
+            await self._wait(self._latency(model or task_models(task)[0]))
+            for word in self.narration.split(' '):
+                if self.token_delay > 0:
+                    await asyncio.sleep(self.token_delay)
+                yield word + ' '
+
+    async def create_image(self, prompt: str, size: str = '1024x1024') -> str:
+        self.calls += 1
+        image_id = self.calls
+        async with self._serve():
+            await self._wait(self.image_latency)
+        return f'fake://image-{image_id}.png'
+
+
+class FairScheduler:
+    """
+    Shares a limit of concurrent LLM calls between clients (ie. channels) and
+    priority classes.
+
+    Waiting calls are admitted most urgent priority first, and round-robin
+    across clients within a priority, so one busy channel can't starve the
+    others. A class can be held to fewer calls than the limit, keeping slots
+    free for more urgent calls. Calls still waiting at their deadline fail
+    with LlmDeadlineExceeded instead of running once their result is stale.
+
+    Args:
+        limit: Maximum number of calls running at once.
+        class_limits: Maximum number of calls running at once per priority.
+    """
+
+    def __init__(self, limit: int, class_limits: Optional[Dict[int, int]] = None):
+        self.limit = limit
+        self.class_limits = class_limits or {}
+        self.active = 0
+        self.class_active: Dict[int, int] = defaultdict(int)
+        # Priority -> client -> waiting calls, most urgent priority first
+        self.waiting: Dict[int, 'OrderedDict[str, Deque[asyncio.Future]]'] = {
+            priority: OrderedDict()
+            for priority in (LlmPriority.critical, LlmPriority.normal, LlmPriority.background)
+        }
+        self.expired = 0
+
+    def _can_run(self, priority: int) -> bool:
+        return self.active < self.limit and self.class_active[priority] < self.class_limits.get(
+            priority, self.limit
+        )
+
+    def _has_waiting(self, max_priority: int) -> bool:
+        return any(
+            waiting for priority, waiting in self.waiting.items() if priority <= max_priority
+        )
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        client: str,
+        priority: int = LlmPriority.critical,
+        deadline: Optional[float] = None,
+    ):
+        """
+        Waits for this client's turn to make a call.
+
+        Args:
+            client: Name of the client making the call.
+            priority: Priority class of the call, lower is more urgent.
+            deadline: Event loop time by which the call must have started.
+        """
+        if self._can_run(priority) and not self._has_waiting(priority):
+            self._acquire(priority)
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.waiting.setdefault(priority, OrderedDict()).setdefault(client, deque()).append(future)
+            timer = deadline and loop.call_at(deadline, self._expire, priority, client, future)
+            start = time.perf_counter()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release(priority)  # Admitted right as we were cancelled
+                else:
+                    self._discard(priority, client, future)
+                raise
+            finally:
+                if timer:
+                    timer.cancel()
+            metrics.llm_wait_seconds.observe(time.perf_counter() - start, str(priority))
+        try:
+            yield
+        finally:
+            self._release(priority)
+
+    def _acquire(self, priority: int):
+        self.active += 1
+        self.class_active[priority] += 1
+
+    def _discard(self, priority: int, client: str, future: asyncio.Future):
+        waiting = self.waiting[priority]
+        queue = waiting.get(client)
+        if queue and future in queue:
+            queue.remove(future)
+            if not queue:
+                del waiting[client]
+
+    def _expire(self, priority: int, client: str, future: asyncio.Future):
+        if not future.done():
+            self._discard(priority, client, future)
+            future.set_exception(LlmDeadlineExceeded())
+            self.expired += 1
+
+    def _release(self, priority: int):
+        self.active -= 1
+        self.class_active[priority] -= 1
+        for waiting_priority, waiting in self.waiting.items():
+            while waiting and self._can_run(waiting_priority):
+                client, queue = next(iter(waiting.items()))
+                future = queue.popleft()
+                if queue:
+                    waiting.move_to_end(client)  # Next client's turn
+                else:
+                    del waiting[client]
+                if not future.done():
+                    future.set_result(None)
+                    self._acquire(waiting_priority)
+            if self.active >= self.limit:
+                break
+
+
+class ScheduledBackend(LlmBackend):
+    """
+    Routes the calls of one client through a scheduler shared with other
+    clients.
+
+    Each call gets the priority and admission deadline of its task, and is
+    sent to the models configured for the task. When a model doesn't answer
+    (or start streaming) within the task's timeout, the call falls back to
+    the next model.
+
+    Args:
+        backend: The backend making the actual calls.
+        scheduler: The scheduler shared by all clients.
+        client: Name of this client (ie. the channel).
+    """
+
+    def __init__(self, backend: LlmBackend, scheduler: FairScheduler, client: str):
+        self.backend = backend
+        self.scheduler = scheduler
+        self.client = client
+
+    def _slot(self, task: str):
+        deadline = config.llm_task_deadlines.get(task)
+        return self.scheduler.slot(
+            self.client,
+            task_priorities.get(task, LlmPriority.normal),
+            deadline and asyncio.get_running_loop().time() + deadline,
+        )
+
+    @staticmethod
+    def _attempts(model: Optional[str], task: str):
+        """Yields the models to try, with the timeout before falling back from each"""
+        models = [model] if model else task_models(task)
+        timeout = config.llm_task_timeouts.get(task)
+        for i, model in enumerate(models):
+            yield model, timeout if i < len(models) - 1 else None
+
+    async def chat(
+        self, messages: Messages, model: Optional[str] = None, task: str = 'default'
+    ) -> str:
+        async with self._slot(task):
+            for model, timeout in self._attempts(model, task):
+                try:
+                    return await asyncio.wait_for(
+                        self.backend.chat(messages, model, task), timeout
+                    )
+                except asyncio.TimeoutError:
+                    if timeout is None:
+                        raise
+                    logger.warning('{} timed out for {}, falling back', model, task)
+                    metrics.llm_fallbacks_total.inc(task)
+
+    async def stream_chat(
+        self, messages: Messages, model: Optional[str] = None, task: str = 'default'
+    ) -> AsyncIterator[str]:
+        async with self._slot(task):
+            for model, timeout in self._attempts(model, task):
+                stream = self.backend.stream_chat(messages, model, task)
+                try:
+                    first = await asyncio.wait_for(stream.__anext__(), timeout)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    await stream.aclose()
+                    if timeout is None:
+                        raise
+                    logger.warning('{} timed out for {}, falling back', model, task)
+                    metrics.llm_fallbacks_total.inc(task)
+                    continue
+                yield first
+                async for token in stream:
+                    yield token
+                return
+
+    async def create_image(self, prompt: str, size: str = '1024x1024') -> str:
+        async with self._slot('image'):
+            return await self.backend.create_image(prompt, size)
+
+
+def create_scheduler() -> FairScheduler:
+    """Creates the scheduler with the limits of the config"""
+    class_limits = {
+        getattr(LlmPriority, name): limit for name, limit in config.llm_priority_limits.items()
+    }
+    return FairScheduler(config.llm_max_concurrency, class_limits)
+
+
+def create_llm_backend() -> LlmBackend:
+    """Creates the backend selected in the config"""
+    if config.llm_backend == 'fake':
+        return FakeLlmBackend()
+    if config.llm_backend == 'openai':
+        config.require('openai_api_key')
+        return OpenAiBackend(
+            max_concurrency=config.llm_max_concurrency,
+            timeout=config.llm_timeout,
+            max_retries=config.llm_max_retries,
+            api_base=config.openai_api_base,
+            api_key=config.openai_api_key,
+        )
+    raise ValueError(f'Unknown llm_backend: {config.llm_backend}')
@@ -2,11 +2,24 @@ import asyncio
 
 from contextlib import suppress
 import time
-from typing import Optional
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
 
 from .config import config
-from .models import Proposal
+from .events import EventBus
+from . import metrics
+from .image_pipeline import ImageCache
+from .llm_backend import LlmBackend
+from .models import Proposal, Quest
+from .prompt_pool import InitialPromptPool
+from .proposal_index import ProposalIndex
+from .quest_handle import QuestHandler
+from .scoring import ProposalRanking
+from .speculation import NarrationSpeculator
+from .storage import GameStore, StoredGame
 from .story_generator import StoryGenerator
+from .vote_window import ActiveChatters, VoteWindow
 
 
 class LlmGameHooks:
@@ -14,6 +27,26 @@ class LlmGameHooks:
     Hooks that get called for various events within the game.
     """
 
+    async def on_narration_start(self, proposal: Proposal, proposal_id: int):
+        """
+        Triggered after choosing a proposal, before its narration is generated.
+
+        Args:
+            proposal: The chosen proposal object.
+            proposal_id: The unique id of the proposal.
+        """
+        pass
+
+    async def on_narration_chunk(self, chunk: str):
+        """
+        Triggered for every sentence-aligned chunk of a narration while it is
+        being generated.
+
+        Args:
+            chunk: The next part of the story narration.
+        """
+        pass
+
     async def on_get_narration_result(
         self, narration_result: str, proposal: Proposal, proposal_id: int
     ):
@@ -27,6 +60,15 @@ class LlmGameHooks:
         """
         pass
 
+    async def on_quest_updated(self, quest: Quest):
+        """
+        Triggered when a quest was completed or failed.
+
+        Args:
+            quest: The quest, with its new status.
+        """
+        pass
+
 
 class LlmGame:
     """
@@ -34,16 +76,70 @@ class LlmGame:
 
     Args:
         hooks: Handlers
+        backend: Language model backend, created from the config if not given
+        store: Storage the game state is persisted to
+        stored: Game state previously loaded from the store to resume from
+        initial_prompts: Pool of openings for restarts, shared between games
+        image_cache: Disk cache of generated images, shared between games
     """
 
-    def __init__(self, hooks: LlmGameHooks = LlmGameHooks()):
-        self.generator = StoryGenerator()
+    def __init__(
+        self,
+        hooks: LlmGameHooks = LlmGameHooks(),
+        backend: LlmBackend = None,
+        store: Optional[GameStore] = None,
+        stored: Optional[StoredGame] = None,
+        initial_prompts: Optional[InitialPromptPool] = None,
+        image_cache: Optional[ImageCache] = None,
+    ):
+        self.events = EventBus()
+        self.store = store
+        self.generator = StoryGenerator(
+            self.events,
+            backend,
+            store=store,
+            story_entries=store.iter_story_entries() if store and stored else None,
+            initial_prompts=initial_prompts,
+            image_cache=image_cache,
+        )
+        self.quests = QuestHandler(self.generator.backend, self.events, self._on_quest_updated)
+        self.quests.reset(len(self.generator.past_story_entries))
+        self.speculator = None
+        if config.speculative_narration:
+            self.speculator = NarrationSpeculator(
+                self.generator,
+                top_k=config.speculation_top_k,
+                max_concurrent=config.speculation_max_concurrent,
+            )
         self.background_task = None
-        self.background_task_lock = asyncio.Lock()
+        self.background_task_lock = asyncio.Lock()  # Serializes narrations
+        self.narrating = False  # Proposals go to the next round meanwhile
         self.hooks = hooks
-        self.proposals = []
+        self.proposals = list(stored.proposals) if stored else []
+        # Order in which the proposals were made, replaced ones get a new place
+        self.proposal_order = list(range(len(self.proposals)))
+        # The runner-up is tracked to tell when the vote is decided
+        self.ranking = ProposalRanking(max(2, config.speculation_top_k if self.speculator else 1))
+        self.ranking.reset([proposal.vote for proposal in self.proposals])
+        self.index = ProposalIndex(config.proposal_merge_threshold)
+        for proposal_id, proposal in enumerate(self.proposals, start=1):
+            self.index.add(proposal_id, proposal.message)
+        # user -> (proposal id, weight) of everyone who voted this round. A vote
+        # for a replaced proposal becomes (0, 0), the user still voted
+        self.voters: Dict[str, Tuple[int, int]] = dict(stored.voters) if stored else {}
         self.count_votes_event = asyncio.Event()
-        self.next_count_vote_time: Optional[int] = None
+        self.next_count_vote_time: Optional[float] = None
+        self.chatters = ActiveChatters(config.vote_active_seconds)
+        self.vote_window = VoteWindow(
+            config.vote_min_seconds,
+            config.vote_delay,
+            config.vote_quorum,
+            config.vote_idle_seconds,
+        )
+        self._vote_activity = asyncio.Event()
+        if self.proposals:
+            # Resume the vote that was interrupted
+            self._start_vote()
 
     @property
     def initial_story_message(self) -> str:
@@ -56,79 +152,307 @@ class LlmGame:
         assert self.generator.past_story_entries
         return self.generator.past_story_entries[-1].narration_result
 
-    def vote(self, proposal_id: int, weight: int = 1) -> Proposal:
+    @metrics.profile
+    def vote(self, proposal_id: int, weight: int = 1, user: Optional[str] = None) -> Proposal:
         """
         Adds a vote to a proposal.
 
+        Each user has one vote per round. Voting again moves the user's vote
+        (and its weight) to the new proposal.
+
         Args:
             proposal_id: The id of the proposal to be voted.
             weight: The weight of the vote (defaults to 1).
+            user: The name of the voter, anonymous votes are always counted.
 
         Returns:
             The proposal object that was voted on.
         """
         if not 0 < proposal_id <= len(self.proposals):
             raise ValueError(f'Invalid proposal id: {proposal_id}')
-        self.proposals[proposal_id - 1].vote += weight
-        return self.proposals[proposal_id - 1]
+        if user is not None:
+            self.note_chatter(user)
+            previous = self.voters.get(user)
+            if previous == (proposal_id, weight):
+                return self.proposals[proposal_id - 1]
+            self._set_vote(user, proposal_id, weight)
+            if previous is not None and previous[0]:
+                self._add_votes(*previous, sign=-1)
+        proposal = self._add_votes(proposal_id, weight)
+        self.vote_window.record_vote()
+        self._vote_activity.set()
+        if self.store:
+            self.store.set_proposals(self.proposals)
+        if self.speculator and self.background_task and not self.narrating:
+            self.speculator.update(self.ranking.leaders, self.proposals)
+        return proposal
+
+    def voted_for(self, user: str) -> Optional[int]:
+        """
+        Returns the id of the proposal the user currently votes for, if any.
+        """
+        vote = self.voters.get(user)
+        return vote[0] if vote and vote[0] else None
+
+    def has_voted(self, user: str) -> bool:
+        """
+        Returns whether the user voted this round, even if their proposal was replaced since.
+        """
+        return user in self.voters
+
+    def _set_vote(self, user: str, proposal_id: int, weight: int):
+        self.voters[user] = (proposal_id, weight)
+        if self.store:
+            self.store.set_vote(user, proposal_id, weight)
+
+    def _add_votes(self, proposal_id: int, weight: int, sign: int = 1) -> Proposal:
+        proposal = self.proposals[proposal_id - 1]
+        proposal.vote = self.ranking.vote(proposal_id, sign * weight)
+        self.events.publish('vote_changed', id=proposal_id, vote=proposal.vote)
+        return proposal
+
+    def note_chatter(self, user: str):
+        """
+        Marks a user as active in chat, ie. as a potential voter. The first
+        chatter also starts the background work deferred at startup.
+        """
+        self.chatters.see(user)
+        if not self.generator.warmed_up:
+            self.generator.warm_up()
 
     def end_vote(self):
         """Ends the voting process by setting the count_votes_event."""
         self.count_votes_event.set()
+        self._vote_activity.set()
 
-    def restart(self):
+    async def restart(self):
         """Restarts the game by resetting the story generator and initializing a new turn."""
-        self.generator.reset()
+        task, self.background_task = self.background_task, None
+        if task and not task.done():
+            task.cancel()  # Its vote or narration belongs to the old story
+            with suppress(asyncio.CancelledError):
+                await task
+        await self.generator.reset()
+        self.quests.reset(len(self.generator.past_story_entries))
         self._new_turn()
 
-    async def add_proposal(self, story_action: str, author: str) -> int:
+    async def close(self):
+        """
+        Stops the vote, narration and background LLM calls of the game and
+        closes its storage. The shared image cache and backend stay open.
+        """
+        if self.speculator:
+            self.speculator.clear()
+        tasks = (self.background_task, self.quests.task, self.generator.context.summary_task)
+        tasks = [task for task in tasks if task and not task.done()]
+        self.background_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.generator.images.close()
+        if self.store:
+            await self.store.close()
+        self.generator.past_story_entries.close()
+
+    @metrics.profile
+    async def add_proposal(self, story_action: str, author: str) -> Tuple[int, bool]:
         """
         Adds a proposal for an action for the main character to take
 
+        A duplicate or near-duplicate of a proposal of this round is merged
+        into it instead, making the author a co-author who votes for it. When
+        the round already has max_proposals proposals, the one with the
+        fewest votes is replaced.
+
+        Never waits for a narration: while one is generated, proposals go to
+        the next round, whose vote opens once the narration is committed.
+
         Args:
             story_action: The proposed story action by a user.
             author: The username of the person submitting the proposal.
 
         Returns:
-            The id of the newly created proposal.
+            The id of the new proposal, or of the one it was merged into, and
+            whether a new proposal was added.
         """
-        async with self.background_task_lock:
-            proposal = Proposal(user=author, message=story_action, vote=0)
-            print(proposal)
+        self.note_chatter(author)
+        proposal_id = self.index.find(story_action)
+        added = proposal_id is None
+        if added:
+            proposal_id = self._insert_proposal(Proposal(user=author, message=story_action, vote=0))
+        else:
+            self._merge_proposal(proposal_id, author)
+        if self.store:
+            self.store.set_proposals(self.proposals)
+        if self.background_task is None:
+            self._start_vote()
+        if self.speculator and not self.narrating:
+            self.speculator.update(self.ranking.leaders, self.proposals)
+        self._vote_activity.set()
+        return proposal_id, added
+
+    def _merge_proposal(self, proposal_id: int, author: str):
+        proposal = self.proposals[proposal_id - 1]
+        if author == proposal.user or author in proposal.co_authors:
+            return
+        proposal.co_authors.append(author)
+        logger.info('{} joined proposal {}', author, proposal_id)
+        self.events.publish('proposal_updated', id=proposal_id, proposal=proposal.model_dump())
+        if self.voted_for(author) is None:
+            self._set_vote(author, proposal_id, 1)
+            self._add_votes(proposal_id, 1)
+            self.vote_window.record_vote()
+
+    def _insert_proposal(self, proposal: Proposal) -> int:
+        """Appends a proposal, or replaces the lowest voted one if the round is full"""
+        logger.info('New proposal by {}: {}', proposal.user, proposal.message)
+        if len(self.proposals) < config.max_proposals:
             self.proposals.append(proposal)
-            proposal_id = len(self.proposals)
-            if self.background_task is None:
-                self.background_task = asyncio.create_task(self._background_thread_run())
+            self.proposal_order.append(self._next_proposal_order())
+            proposal_id = self.ranking.add()
+        else:
+            # Oldest of the least voted, it had the most time to gather votes
+            proposal_id = min(
+                range(1, len(self.proposals) + 1),
+                key=lambda i: (self.proposals[i - 1].vote, self.proposal_order[i - 1]),
+            )
+            evicted = self.proposals[proposal_id - 1]
+            logger.info(
+                'Replacing proposal {} ({} votes): {}', proposal_id, evicted.vote, evicted.message
+            )
+            self.index.remove(proposal_id)
+            for user, (voted_id, _) in list(self.voters.items()):
+                if voted_id == proposal_id:
+                    self._set_vote(user, 0, 0)  # They may vote again, without earning points
+            if evicted.vote:
+                self.ranking.vote(proposal_id, -evicted.vote)
+            self.proposals[proposal_id - 1] = proposal
+            self.proposal_order[proposal_id - 1] = self._next_proposal_order()
+        self.index.add(proposal_id, proposal.message)
+        self.events.publish('proposal_added', id=proposal_id, proposal=proposal.model_dump())
         return proposal_id
 
+    def _next_proposal_order(self) -> int:
+        return max(self.proposal_order, default=-1) + 1
+
+    def _start_vote(self):
+        """Opens the vote of the round, with its first proposal"""
+        self.vote_window.start()
+        self.count_votes_event.clear()
+        self.background_task = asyncio.create_task(self._background_thread_run())
+
+    def _vote_deadline(self) -> float:
+        """Time at which the vote closes given the current votes"""
+        leaders = self.ranking.leaders
+        leader_votes = self.ranking.votes[leaders[0] - 1] if leaders else 0
+        runner_up_votes = self.ranking.votes[leaders[1] - 1] if len(leaders) > 1 else 0
+        decided = self.vote_window.is_decided(
+            leader_votes, runner_up_votes, len(self.voters), self.chatters.count()
+        )
+        return self.vote_window.deadline(decided)
+
+    async def _wait_for_votes(self):
+        """
+        Waits until the vote closes, moving next_count_vote_time as votes
+        come in and publishing vote_deadline_changed when it moved.
+        """
+        self.next_count_vote_time = self._vote_deadline()
+        self.events.publish(
+            'vote_started',
+            seconds_remaining=self.next_count_vote_time - time.time(),
+            total_seconds=config.vote_delay,
+        )
+        while not self.count_votes_event.is_set():
+            deadline = self._vote_deadline()
+            if abs(deadline - self.next_count_vote_time) >= 0.5:
+                self.next_count_vote_time = deadline
+                self.events.publish(
+                    'vote_deadline_changed',
+                    seconds_remaining=deadline - time.time(),
+                    total_seconds=config.vote_delay,
+                )
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            self._vote_activity.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._vote_activity.wait(), timeout)
+
     async def _background_thread_run(self):
         """
         A private asynchronous method which handles the collection of
-        the votes after the time limit has elapsed
+        the votes once the vote closed
         """
-        print('Waiting for votes...')
-        self.next_count_vote_time = time.time() + config.vote_delay
-        with suppress(asyncio.TimeoutError):
-            await asyncio.wait_for(self.count_votes_event.wait(), config.vote_delay)
+        logger.info('Waiting for votes...')
+        await self._wait_for_votes()
 
         self.next_count_vote_time = None
-        print('Waiting complete!')
+        self.events.publish('vote_ended')
+        logger.info('Waiting complete!')
 
-        async with self.background_task_lock:
+        proposal_id, proposal = self._close_round()
+        async with metrics.acquire_timed(self.background_task_lock, 'narration'):
             try:
-                proposal = max(self.proposals, key=lambda x: x.vote)
-                proposal_id = self.proposals.index(proposal)
+                await self.hooks.on_narration_start(proposal, proposal_id)
+                narration = None
+                if self.speculator:
+                    narration = await self.speculator.take(proposal_id, proposal.message)
                 story_entry = await self.generator.generate_next_story_narration(
-                    proposal.message
+                    proposal.message, on_chunk=self.hooks.on_narration_chunk, narration=narration
                 )
+                self.quests.schedule(self.generator.past_story_entries)
                 await self.hooks.on_get_narration_result(
                     story_entry.narration_result, proposal, proposal_id
                 )
             finally:
-                self._new_turn()
+                self._open_round()
+
+    async def _on_quest_updated(self, quest: Quest):
+        await self.hooks.on_quest_updated(quest)
+
+    def _close_round(self) -> Tuple[int, Proposal]:
+        """
+        Takes the winner out of the closing round and empties the proposals,
+        so new ones are collected for the next round during the narration.
+
+        Returns:
+            The id of the winning proposal, and the proposal.
+        """
+        proposal_id = self.ranking.leader
+        proposal = self.proposals[proposal_id - 1]
+        self.narrating = True
+        self._clear_proposals()
+        return proposal_id, proposal
+
+    def _open_round(self):
+        """Starts the vote on the proposals made during the narration, if any"""
+        if self.background_task is not asyncio.current_task():
+            return  # The game was restarted during the narration
+        self.narrating = False
+        self.background_task = None
+        if self.speculator:
+            self.speculator.clear()
+        if self.proposals:
+            self._start_vote()
+            if self.speculator:
+                self.speculator.update(self.ranking.leaders, self.proposals)
 
     def _new_turn(self):
         """Initializes a new turn within the game"""
-        self.proposals = []
+        if self.speculator:
+            self.speculator.clear()
+        self._clear_proposals()
         self.background_task = None
+        self.narrating = False
         self.count_votes_event.clear()
+
+    def _clear_proposals(self):
+        self.proposals = []
+        self.proposal_order = []
+        self.ranking.reset()
+        self.index.clear()
+        self.voters = {}
+        self.events.publish('proposals_cleared')
+        if self.store:
+            self.store.set_proposals(self.proposals)
+            self.store.clear_votes()
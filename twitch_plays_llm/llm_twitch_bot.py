@@ -1,95 +1,287 @@
-import asyncio
-
-from typing import Optional
+from typing import Dict, List, Optional
 
+from loguru import logger
 from twitchio.channel import Channel
 from twitchio.ext import commands
 
+from . import metrics
+from .chat_queue import ChatPriority, Message, OutboundChatQueue
 from .config import config
 from .llm_game import LlmGame, LlmGameHooks
-from .models import Proposal
+from .models import Proposal, Quest
+from .scoring import PointsLedger
 
 
 """
 point system task list:
 channel.chatters() returns a list of chatters in the channel
 -   regularly increment points for chatters (method)
--   move points from being a variable to a persistant database somewhere
 """
 
 
-class LlmTwitchBot(commands.Bot, LlmGameHooks):
+class GameChannel(LlmGameHooks):
+    """
+    The game of one Twitch channel as played through its chat: the points of
+    its viewers, the messages queued for it and the hooks of its game.
+
+    Args:
+        llm_game: Game played in the channel.
+        viewer_points: Points of the channel's viewers, none if not given.
+        channel_name: Name of the channel, the main channel if not given.
+    """
+
     max_message_len = 500  # Twitch has a 500 character limit
 
-    def __init__(self, llm_game: LlmGame):
+    def __init__(
+        self,
+        llm_game: LlmGame,
+        viewer_points: Optional[PointsLedger] = None,
+        channel_name: Optional[str] = None,
+    ):
+        self.name = (channel_name or config.twitch_channel_name).lower()
+        self.game = llm_game
+        self.channel: Optional[Channel] = None
+        self.chat_queue = OutboundChatQueue(
+            self._send_now,
+            rate=config.chat_rate_limit,
+            burst=config.chat_burst,
+            max_age=config.chat_message_max_age,
+        )
+        self.new_votes = 0  # Votes not yet reported in a tally
+        self.viewer_points = viewer_points or PointsLedger()
+        metrics.chat_queue_depth.set_function(lambda: len(self.chat_queue), self.name)
+
+    async def joined(self, channel: Channel):
+        """Starts sending to the channel once the bot joined it"""
+        first_join = self.channel is None
+        self.channel = channel
+        if first_join:
+            self.chat_queue.start()
+            await self.send_chunked(f'Story: {self.game.initial_story_message}')
+
+    async def close(self):
+        await self.chat_queue.close()
+
+    async def on_narration_start(self, proposal: Proposal, proposal_id: int):
+        await self.send(
+            f'Chose action {proposal_id} ({proposal.vote} votes): {proposal.message}',
+            priority=ChatPriority.narration,
+            max_age=None,
+        )
+
+    async def on_narration_chunk(self, chunk: str):
+        logger.debug(chunk)
+        await self.send(chunk, priority=ChatPriority.narration, max_age=None)
+
+    async def on_get_narration_result(
+        self, narration_result: str, proposal: Proposal, proposal_id: int
+    ):
+        self.add_points(proposal.user, config.vote_points)
+        self.viewer_points.add_to_all(config.vote_accumulation)
+        if self.game.store:
+            self.game.store.set_points_offset(self.viewer_points.offset)
+
+    async def on_quest_updated(self, quest: Quest):
+        outcome = 'completed' if quest.status == 'Complete' else 'failed'
+        await self.send(f'Quest {quest.id} {outcome}: {quest.description}')
+
+    def add_points(self, user: str, points: int):
+        """Adds (or with a negative value, removes) points of a user and stores the new total"""
+        raw_points = self.viewer_points.add(user, points)
+        if self.game.store:
+            self.game.store.set_points(user, raw_points)
+
+    async def propose_story_action(self, story_action: str, author: str) -> bool:
+        """
+        Continues the story by performing an action, communicating the result to the channel
+
+        Returns:
+            Whether a new option was added, rather than merged into an existing one.
+        """
+        proposal_id, added = await self.game.add_proposal(story_action, author)
+        proposal = self.game.proposals[proposal_id - 1]
+        if added:
+            await self.send(f'Option {proposal_id} added: {story_action}')
+        elif proposal.user == author:
+            await self.send(f'{author} already proposed option {proposal_id}: {proposal.message}')
+        else:
+            await self.send(f'{author} joins option {proposal_id}: {proposal.message}')
+        return added
+
+    @metrics.profile
+    async def vote(self, user: str, vote_option_str: str, weight: int = 1):
+        """Votes for the next action on behalf of a user"""
+        try:
+            proposal_id = int(vote_option_str)
+            first_vote = not self.game.has_voted(user)
+            previous = self.game.voted_for(user)
+            proposal = self.game.vote(proposal_id, weight, user=user)
+            proposer = proposal.user
+            if first_vote:  # Only the first vote of a round earns points
+                if user != proposer:
+                    self.add_points(user, config.vote_points)
+                self.add_points(proposer, config.points_earned_per_vote)
+        except ValueError:
+            await self.send(f'Invalid vote option: {vote_option_str}')
+        else:
+            if previous != proposal_id:
+                # Acknowledge votes with a periodic tally rather than one message each
+                self.new_votes += 1
+                await self.send(
+                    self._vote_tally,
+                    priority=ChatPriority.tally,
+                    key='vote-tally',
+                    min_interval=config.chat_tally_interval,
+                )
+
+    async def send_chunked(self, text: str):
+        while text:
+            suffix = '...' if len(text) >= self.max_message_len else ''
+            await self.send(
+                text[: self.max_message_len - 3] + suffix,
+                priority=ChatPriority.narration,
+                max_age=None,
+            )
+            logger.debug(text[: self.max_message_len - 3] + suffix)
+            text = text[self.max_message_len - 3 :]
+
+    def _vote_tally(self) -> Optional[str]:
+        """Summarizes the votes received since the last tally"""
+        if not self.new_votes or not self.game.proposals:
+            return None
+        new_votes, self.new_votes = self.new_votes, 0
+        counts = ' | '.join(
+            f'{i}: {proposal.vote}' for i, proposal in enumerate(self.game.proposals, start=1)
+        )
+        return f'{new_votes} new vote(s). Current votes: {counts}'[: self.max_message_len]
+
+    async def send(
+        self,
+        message: Message,
+        priority: int = ChatPriority.reply,
+        key: Optional[str] = None,
+        max_age: Optional[float] = ...,
+        min_interval: float = 0.0,
+    ):
+        """Queues a message for the channel without waiting for the rate limit"""
+        self.chat_queue.put(message, priority, key=key, max_age=max_age, min_interval=min_interval)
+
+    async def _send_now(self, message: str):
+        await self.channel.send(message)
+
+
+class LlmTwitchBot(commands.Bot):
+    """
+    Plays the games of any number of channels over one IRC connection, each
+    command acting on the game of the channel it was sent in.
+
+    Args:
+        game_channels: Channels to join on boot.
+    """
+
+    def __init__(self, game_channels: List[GameChannel]):
         # Initialise our Bot with our access token, prefix and a list of channels to join on boot...
         super().__init__(
             token=config.twitch_bot_client_id,
             prefix='!',
-            initial_channels=[config.twitch_channel_name],
+            initial_channels=[game_channel.name for game_channel in game_channels],
         )
-        self.game = llm_game
-        self.channel: Optional[Channel] = None
-        self.viewer_points = {}
+        self.game_channels: Dict[str, GameChannel] = {
+            game_channel.name: game_channel for game_channel in game_channels
+        }
 
     async def event_ready(self):
         """Function that runs when bot connects to server"""
-        asyncio.get_running_loop().set_debug(True)
-        print(f'Logged in as | {self.nick}')
-        print(f'User id is | {self.user_id}')
-        self.channel = self.get_channel(config.twitch_channel_name)
-        await self._send_chunked(f'Story: {self.game.initial_story_message}')
+        logger.info('Logged in as | {}', self.nick)
+        logger.info('User id is | {}', self.user_id)
+
+    async def event_channel_joined(self, channel: Channel):
+        game_channel = self.game_channels.get(channel.name)
+        if game_channel:
+            await game_channel.joined(channel)
+
+    async def event_message(self, message):
+        """Counts chatters as potential voters before handling commands"""
+        if message.echo:
+            return
+        game_channel = self.game_channels.get(message.channel.name)
+        if game_channel is None:
+            return
+        game_channel.game.note_chatter(message.author.name)
+        await self.handle_commands(message)
+
+    async def global_before_invoke(self, ctx: commands.Context):
+        """Called before any command runs"""
+        metrics.commands_total.inc(ctx.channel.name, ctx.command.name)
+
+    def _game_channel(self, ctx: commands.Context) -> GameChannel:
+        """Returns the game of the channel a command was sent in"""
+        return self.game_channels[ctx.channel.name]
 
     @commands.command()
     async def action(self, ctx: commands.Context):
         """Trigger for user to perform an action within the game"""
+        game_channel = self._game_channel(ctx)
         story_action = self._extract_message_text(ctx)
         user = ctx.author.name
-        if user not in self.viewer_points:
-            self.viewer_points[user] = 500
-        if self.viewer_points[user] > config.action_cost: #first action is free, or if they have enough points
-            self.viewer_points[user] -= config.action_cost
-            await self._propose_story_action(story_action, user)
+        if user not in game_channel.viewer_points:
+            game_channel.add_points(user, 500)
+        if game_channel.viewer_points[user] > config.action_cost: #first action is free, or if they have enough points
+            game_channel.add_points(user, -config.action_cost)
+            if not await game_channel.propose_story_action(story_action, user):
+                game_channel.add_points(user, config.action_cost)  # Refund, no option was added
         else:
-            await self._send(f'{user} does not have enough points to perform an action. Try voting for someone else!')
+            await game_channel.send(f'{user} does not have enough points to perform an action. Try voting for someone else!')
 
 
     @commands.command()
     async def points(self, ctx: commands.Context):
         """Add command to check points (command)"""
+        game_channel = self._game_channel(ctx)
         user_id = ctx.author.name
-        if user_id in self.viewer_points:
-            await self._send(f'{user_id} has {self.viewer_points[user_id]} points')
+        if user_id in game_channel.viewer_points:
+            await game_channel.send(f'{user_id} has {game_channel.viewer_points[user_id]} points')
         else:
-            await self._send(f'{user_id} has 0 points')
-        
+            await game_channel.send(f'{user_id} has 0 points')
+
 
     @commands.command()
     async def say(self, ctx: commands.Context):
         """Trigger for user to say something within the game"""
         story_action = 'You say "' + self._extract_message_text(ctx) + '"'
-        await self._propose_story_action(story_action, ctx.author.name)
+        await self._game_channel(ctx).propose_story_action(story_action, ctx.author.name)
 
     @commands.command()
     async def vote(self, ctx):
-        await self._vote(ctx)
+        await self._game_channel(ctx).vote(ctx.author.name, self._extract_message_text(ctx))
 
     @commands.command()
     async def leaderboard(self, ctx: commands.Context):
-        leaderboard = [(user, points) for user, points in self.viewer_points.items()]
-        leaderboard.sort(key=lambda x: x[1], reverse=True)  # Sort the leaderboard by points in descending order
-        top_5 = leaderboard[:5]  # Get the top 5 users
+        game_channel = self._game_channel(ctx)
+        top_5 = game_channel.viewer_points.top(5)  # Get the top 5 users
 
         leaderboard_text = "Top 5 Users:\n"
         for i, (user, points) in enumerate(top_5, start=1):
             leaderboard_text += f" {i}. {user}: {points} | \n"
 
-        await ctx.send(leaderboard_text)
+        await game_channel.send(leaderboard_text)
+
+    @commands.command()
+    async def quests(self, ctx: commands.Context):
+        """Lists the active quests"""
+        game_channel = self._game_channel(ctx)
+        quests = game_channel.game.quests.active_quests
+        if not quests:
+            await game_channel.send('There are no active quests')
+            return
+        await game_channel.send(
+            ' | '.join(f'Quest {quest.id}: {quest.description}' for quest in quests)
+        )
 
     @commands.command()
     async def help(self, ctx: commands.Context):
         """Help command"""
-        await self._send(
+        await self._game_channel(ctx).send(
             """
             Commands:
             !action <action> - Perform an action within the game
@@ -97,41 +289,58 @@ class LlmTwitchBot(commands.Bot, LlmGameHooks):
             !vote <user> - Vote for a user to perform an action
             !leaderboard - Show the leaderboard
             !points - Check your points
+            !quests - Show the active quests
             !help - Show this message"""
         )
-    
+
     # --- MOD COMMANDS ---
 
     @commands.command()
     async def reset(self, ctx: commands.Context):
         """Resets the game if the user is a mod"""
+        game_channel = self._game_channel(ctx)
         if not ctx.author.is_mod:
-            await self._send(ctx.author.name + ', You are not a mod')
+            await game_channel.send(ctx.author.name + ', You are not a mod')
             return
 
-        self.game.restart()
-        await self._send_chunked(f'Game has been reset | {self.game.initial_story_message}')
+        await game_channel.game.restart()
+        await game_channel.send_chunked(
+            f'Game has been reset | {game_channel.game.initial_story_message}'
+        )
 
     @commands.command()
     async def modvote(self, ctx: commands.Context):
+        game_channel = self._game_channel(ctx)
         if not ctx.author.is_mod:
-            await self._send(ctx.author.name + ', You are not a mod')
+            await game_channel.send(ctx.author.name + ', You are not a mod')
             return
-        await self._vote(ctx, weight=99)
+        await game_channel.vote(ctx.author.name, self._extract_message_text(ctx), weight=99)
 
     @commands.command()
     async def endvote(self, ctx: commands.Context):
+        game_channel = self._game_channel(ctx)
+        if not ctx.author.is_mod:
+            await game_channel.send(ctx.author.name + ', You are not a mod')
+            return
+        game_channel.game.end_vote()
+
+    @commands.command()
+    async def quest(self, ctx: commands.Context):
+        """Gives the players a quest (ie. !quest Find the clockmaker's missing key)"""
+        game_channel = self._game_channel(ctx)
         if not ctx.author.is_mod:
-            await self._send(ctx.author.name + ', You are not a mod')
+            await game_channel.send(ctx.author.name + ', You are not a mod')
             return
-        self.game.end_vote()
+        quest = game_channel.game.quests.add(self._extract_message_text(ctx))
+        await game_channel.send(f'New quest {quest.id}: {quest.description}')
 
     @commands.command()
     async def givepoints(self, ctx: commands.Context):
         """Give points to a user"""
         #!givepoints <user> <points>
+        game_channel = self._game_channel(ctx)
         if not ctx.author.is_mod:
-            await self._send(ctx.author.name + ', You are not a mod')
+            await game_channel.send(ctx.author.name + ', You are not a mod')
             return
         else:
             try:
@@ -139,63 +348,17 @@ class LlmTwitchBot(commands.Bot, LlmGameHooks):
                 message_split = ctx.message.content.split()
                 user = ''.join(filter(str.isalnum, message_split[1]))  # Remove non-alphanumeric characters
                 points = message_split[2]
-                self.viewer_points[user] += int(points)
-                await self._send(f'{user} was given {points} points ')
+                if user not in game_channel.viewer_points:
+                    raise KeyError(user)
+                game_channel.add_points(user, int(points))
+                await game_channel.send(f'{user} was given {points} points ')
             except KeyError:
-                await self._send(f'{user} does not exist')
+                await game_channel.send(f'{user} does not exist')
             except TypeError:
-                await self._send(f'Invalid input')
+                await game_channel.send(f'Invalid input')
 
     # --- Other Methods ---
 
-    async def _vote(self, ctx: commands.Context, weight: int = 1):
-        """Trigger for user to vote on the next action"""
-        vote_option_str = self._extract_message_text(ctx)
-        user = ctx.author.name
-        try:
-            proposal = self.game.vote(int(vote_option_str))
-            new_count = proposal.vote
-            proposer = proposal.user
-            if user != proposer:
-                if user in self.viewer_points:
-                    self.viewer_points[user] += config.vote_points
-                else:
-                    self.viewer_points[user] = config.vote_points
-            if proposer in self.viewer_points:
-                self.viewer_points[proposer] += config.points_earned_per_vote
-            else:
-                self.viewer_points[proposer] = config.points_earned_per_vote
-        except ValueError:
-            await self._send(f'Invalid vote option: {vote_option_str}')
-        else:
-            await self._send(f'Vote added for option {vote_option_str}. Current votes: {new_count}')
-
-    async def on_get_narration_result(
-        self, narration_result: str, proposal: Proposal, proposal_id: int
-    ):
-        if proposal.user in self.viewer_points:
-            self.viewer_points[proposal.user] += config.vote_points
-        else:
-            self.viewer_points[proposal.user] = config.vote_points
-        await self._send_chunked(
-            f'Chose action {proposal_id} ({proposal.vote} votes): {proposal.message} | {narration_result}'
-        )
-        for user, points in self.viewer_points.items():
-            self.viewer_points[user] += config.vote_accumulation
-
-    async def _propose_story_action(self, story_action: str, author: str):
-        """Continues the story by performing an action, communicating the result to the channel"""
-        proposal_id = await self.game.add_proposal(story_action, author)
-        await self._send(f'Option {proposal_id} added: {story_action}')
-
-    async def _send_chunked(self, text: str):
-        while text:
-            suffix = '...' if len(text) >= self.max_message_len else ''
-            await self._send(text[: self.max_message_len - 3] + suffix)
-            print(text[: self.max_message_len - 3] + suffix)
-            await asyncio.sleep(2.0)
-            text = text[self.max_message_len - 3 :]
-
     @staticmethod
     def _extract_message_text(ctx: commands.Context) -> str:
         """
@@ -203,6 +366,3 @@ class LlmTwitchBot(commands.Bot, LlmGameHooks):
         (ie. "bar baz" from the message "!foo bar baz")
         """
         return ctx.message.content.split(' ', 1)[1]
-
-    async def _send(self, message: str):
-        await self.channel.send(message)
@@ -0,0 +1,255 @@
+import asyncio
+import bisect
+import functools
+import inspect
+import time
+
+from contextlib import asynccontextmanager, contextmanager, suppress
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """Base of metrics exposed in the Prometheus text format"""
+
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for label_values, value in self.values.items():
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {value}'
+
+
+class Gauge(Metric):
+    """Gauge whose values are read from functions when scraped"""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], *label_values: str):
+        self.functions[label_values] = function
+
+    def samples(self) -> Iterator[str]:
+        for label_values, function in list(self.functions.items()):
+            yield f'{self.name}{_format_labels(self.labels, label_values)} {function()}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = latency_buckets,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # Label values -> (count per bucket, with +Inf last, sum)
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *label_values: str):
+        counts, total = self.values.setdefault(
+            label_values, ([0] * (len(self.buckets) + 1), [0.0])
+        )
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, *label_values: str):
+        """Observes the seconds spent in the block, also across awaits"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self) -> Iterator[str]:
+        for label_values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip([*self.buckets, '+Inf'], counts):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labels, label_values)
+            yield f'{self.name}_sum{labels} {total[0]}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+narration_seconds = Histogram(
+    'twitch_plays_llm_narration_seconds', 'Time to stream a narration from the LLM'
+)
+caption_seconds = Histogram(
+    'twitch_plays_llm_caption_seconds', 'Time to generate an image caption'
+)
+image_seconds = Histogram('twitch_plays_llm_image_seconds', 'Time to generate an image')
+narration_prompt_tokens = Histogram(
+    'twitch_plays_llm_narration_prompt_tokens',
+    'Prompt tokens sent per narration',
+    buckets=(500, 1000, 2000, 4000, 6000, 8000, 10000, 12000, 16000, 32000),
+)
+lock_wait_seconds = Histogram(
+    'twitch_plays_llm_lock_wait_seconds',
+    'Time spent waiting for the game lock',
+    labels=('operation',),
+)
+commands_total = Counter(
+    'twitch_plays_llm_commands_total', 'Chat commands received', labels=('channel', 'command')
+)
+chat_queue_depth = Gauge(
+    'twitch_plays_llm_chat_queue_depth', 'Outgoing chat messages waiting', labels=('channel',)
+)
+event_loop_lag_seconds = Histogram(
+    'twitch_plays_llm_event_loop_lag_seconds',
+    'Delay of timer callbacks on the event loop',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+llm_wait_seconds = Histogram(
+    'twitch_plays_llm_llm_wait_seconds',
+    'Time LLM calls waited for the scheduler',
+    labels=('priority',),
+)
+llm_fallbacks_total = Counter(
+    'twitch_plays_llm_llm_fallbacks_total',
+    'LLM calls retried with a fallback model after a timeout',
+    labels=('task',),
+)
+profile_seconds = Histogram(
+    'twitch_plays_llm_profile_seconds',
+    'Time spent in profiled functions, while profiling is enabled',
+    labels=('function',),
+)
+
+all_metrics: List[Metric] = [
+    narration_seconds,
+    caption_seconds,
+    image_seconds,
+    narration_prompt_tokens,
+    lock_wait_seconds,
+    commands_total,
+    chat_queue_depth,
+    event_loop_lag_seconds,
+    llm_wait_seconds,
+    llm_fallbacks_total,
+    profile_seconds,
+]
+
+
+def render_metrics() -> str:
+    """Returns all metrics in the Prometheus text exposition format"""
+    return '\n'.join(metric.render() for metric in all_metrics) + '\n'
+
+
+@asynccontextmanager
+async def acquire_timed(lock: asyncio.Lock, operation: str):
+    """Acquires a lock, recording how long that took"""
+    start = time.perf_counter()
+    async with lock:
+        lock_wait_seconds.observe(time.perf_counter() - start, operation)
+        yield
+
+
+class Profiling:
+    """Runtime switch of the profile decorator"""
+
+    enabled = False
+
+
+def profile(func):
+    """
+    Records the duration of every call of the decorated function in
+    profile_seconds while Profiling.enabled is set. Costs one attribute
+    check per call while disabled.
+    """
+    name = func.__qualname__
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not Profiling.enabled:
+                return await func(*args, **kwargs)
+            with profile_seconds.time(name):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not Profiling.enabled:
+            return func(*args, **kwargs)
+        with profile_seconds.time(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag as the overshoot of a periodic sleep.
+
+    Args:
+        interval: Seconds between measurements.
+        warn_after: Lag in seconds above which a warning is logged.
+    """
+
+    def __init__(self, interval: float = 0.5, warn_after: float = 0.25):
+        self.interval = interval
+        self.warn_after = warn_after
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            event_loop_lag_seconds.observe(lag)
+            if lag > self.warn_after:
+                logger.warning('Event loop lagged by {:.3f}s', lag)
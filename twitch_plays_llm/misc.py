@@ -1,7 +1,21 @@
+import inspect
+import re
+
+from typing import AsyncIterator
+
 from loguru import logger
 
 
 def log_exceptions(func):
+    if inspect.iscoroutinefunction(func):
+        async def async_wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                logger.exception(f"Exception calling {func.__name__}: {str(e)}")
+                raise
+        return async_wrapper
+
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
@@ -9,3 +23,45 @@ def log_exceptions(func):
             logger.exception(f"Exception calling {func.__name__}: {str(e)}")
             raise
     return wrapper
+
+
+# End of a sentence: punctuation, optional closing quotes/brackets, then whitespace
+_sentence_end = re.compile(r'[.!?…]+["\'”’)\]]*\s+')
+
+
+async def iter_sentence_chunks(
+    tokens: AsyncIterator[str], max_len: int, min_len: int = 0
+) -> AsyncIterator[str]:
+    """
+    Regroups streamed text into chunks that end on sentence boundaries.
+
+    The first complete sentence is yielded as soon as it arrives. Later chunks
+    gather complete sentences until they are at least min_len long. Chunks
+    never exceed max_len; overlong sentences are cut at the last space.
+
+    Args:
+        tokens: Stream of text fragments (ie. LLM completion tokens).
+        max_len: Maximum length of a yielded chunk.
+        min_len: Minimum length of every chunk after the first.
+    """
+    buffer = ''
+    first = True
+    async for token in tokens:
+        buffer += token
+        while True:
+            boundary = 0
+            for match in _sentence_end.finditer(buffer, 0, max_len + 1):
+                boundary = match.end()
+            if len(buffer) > max_len and not boundary:
+                boundary = buffer.rfind(' ', 0, max_len) + 1 or max_len
+            elif not boundary or (not first and boundary < min_len and len(buffer) <= max_len):
+                break
+            chunk, buffer = buffer[:boundary].strip(), buffer[boundary:]
+            first = False
+            if chunk:
+                yield chunk
+    while buffer.strip():
+        cut = len(buffer) if len(buffer) <= max_len else buffer.rfind(' ', 0, max_len) + 1 or max_len
+        chunk, buffer = buffer[:cut].strip(), buffer[cut:]
+        if chunk:
+            yield chunk
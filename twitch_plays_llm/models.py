@@ -1,4 +1,6 @@
 # BaseModel is similar to a dataclass (used to store data in a structure way)
+from typing import List
+
 from pydantic import BaseModel
 
 
@@ -12,3 +14,11 @@ class Proposal(BaseModel):
     user: str
     message: str
     vote: int
+    co_authors: List[str] = []  # Users who proposed the same action
+
+
+class Quest(BaseModel):
+    id: int
+    description: str
+    keywords: List[str] = []  # words hinting at progress, derived from the description if empty
+    status: str = 'Incomplete'  # 'Incomplete', 'Complete' or 'Failure'
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import os
+
+from typing import Awaitable, Callable, List, Optional
+
+from loguru import logger
+
+
+class InitialPromptPool:
+    """
+    Pool of pre-generated opening narrations.
+
+    Taking a prompt never waits on the LLM: the pool is refilled in the
+    background and saved to disk, so it survives restarts. The saved pool
+    is only read once a prompt is needed.
+
+    Args:
+        generate: Coroutine generating a new opening narration.
+        path: JSON file the pool is persisted to.
+        size: Number of prompts to keep ready.
+        fallback: Opening returned when the pool is empty.
+    """
+
+    def __init__(
+        self, generate: Callable[[], Awaitable[str]], path: str, size: int, fallback: str
+    ):
+        self.generate = generate
+        self.path = path
+        self.size = size
+        self.fallback = fallback
+        self.refill_task: Optional[asyncio.Task] = None
+        self.persist_task: Optional[asyncio.Task] = None
+        self.persist_pending = False
+        self._prompts: Optional[List[str]] = None
+
+    @property
+    def prompts(self) -> List[str]:
+        """The ready prompts, read from disk on first use"""
+        if self._prompts is None:
+            self._prompts = self._load()
+        return self._prompts
+
+    def _load(self) -> List[str]:
+        try:
+            with open(self.path) as f:
+                prompts = json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError):
+            logger.exception('Failed to load initial prompt pool from {}', self.path)
+            return []
+        return [prompt for prompt in prompts if isinstance(prompt, str) and prompt]
+
+    def _save(self, prompts: List[str]):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(prompts, f)
+        os.replace(tmp_path, self.path)
+
+    def _persist(self):
+        """
+        Saves the pool in the background. Saves never overlap, changes made
+        during one are coalesced into one more.
+        """
+        self.persist_pending = True
+        if self.persist_task is None or self.persist_task.done():
+            self.persist_task = asyncio.create_task(self._run_persist())
+
+    async def _run_persist(self):
+        loop = asyncio.get_running_loop()
+        while self.persist_pending:
+            self.persist_pending = False
+            try:
+                await loop.run_in_executor(None, self._save, list(self.prompts))
+            except OSError:
+                logger.exception('Failed to save initial prompt pool to {}', self.path)
+
+    def take(self) -> str:
+        """
+        Returns a ready opening narration and starts refilling the pool.
+
+        Returns:
+            A pre-generated opening, or the fallback if none is ready.
+        """
+        if self.prompts:
+            prompt = self.prompts.pop(0)
+            self._persist()
+        else:
+            logger.warning('Initial prompt pool is empty, using the default opening')
+            prompt = self.fallback
+        self.refill()
+        return prompt
+
+    def refill(self):
+        """Tops the pool up to its size in the background"""
+        if len(self.prompts) >= self.size:
+            return
+        if self.refill_task and not self.refill_task.done():
+            return
+        self.refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        while len(self.prompts) < self.size:
+            try:
+                prompt = await self.generate()
+            except Exception:
+                logger.exception('Failed to generate initial prompt')
+                return
+            self.prompts.append(prompt)
+            self._persist()
+            logger.info('Initial prompt pool: {}/{}', len(self.prompts), self.size)
@@ -0,0 +1,59 @@
+from typing import Dict, Optional
+
+from .similarity import LshIndex, MinHasher, normalize_text, shingles
+
+
+class ProposalIndex:
+    """
+    Finds proposals of the current round that duplicate a new one.
+
+    Exact duplicates (after normalization) are found with a dict lookup,
+    near-duplicates with MinHash signatures of word bigrams in an LSH index,
+    both in O(1) amortized time per proposal.
+
+    Args:
+        threshold: Minimum estimated Jaccard similarity of near-duplicates,
+            above 1 to only merge exact duplicates.
+        num_perm: Length of the MinHash signatures.
+        bands: Number of LSH bands. Wider bands (fewer of them) than the
+            default suit the high thresholds used for near-duplicates, and
+            keep templated spam from all landing in the same buckets.
+    """
+
+    def __init__(self, threshold: float, num_perm: int = 60, bands: int = 10):
+        self.threshold = threshold
+        self.bands = bands
+        self.hasher = MinHasher(num_perm)
+        self.lsh: LshIndex[int] = LshIndex(num_perm, bands)
+        self.exact: Dict[str, int] = {}  # Normalized text -> proposal id
+        self.texts: Dict[int, str] = {}  # Proposal id -> normalized text
+
+    def find(self, text: str) -> Optional[int]:
+        """Returns the id of a proposal duplicating the text, if any"""
+        normalized = normalize_text(text)
+        proposal_id = self.exact.get(normalized)
+        if proposal_id is not None or self.threshold > 1:
+            return proposal_id
+        found = self.lsh.query(self.hasher.signature(shingles(normalized)), self.threshold)
+        return found and found[0]
+
+    def add(self, proposal_id: int, text: str):
+        self.remove(proposal_id)
+        normalized = normalize_text(text)
+        self.texts[proposal_id] = normalized
+        self.exact.setdefault(normalized, proposal_id)
+        if self.threshold <= 1:
+            self.lsh.add(proposal_id, self.hasher.signature(shingles(normalized)))
+
+    def remove(self, proposal_id: int):
+        normalized = self.texts.pop(proposal_id, None)
+        if normalized is None:
+            return
+        if self.exact.get(normalized) == proposal_id:
+            del self.exact[normalized]
+        self.lsh.remove(proposal_id)
+
+    def clear(self):
+        self.lsh = LshIndex(len(self.hasher.params), self.bands)
+        self.exact = {}
+        self.texts = {}
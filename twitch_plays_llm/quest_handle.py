@@ -1,16 +1,190 @@
-# placeholder for quest handler
-from models import StoryEntry
+import asyncio
+import re
+
+from typing import Awaitable, Callable, Iterable, List, Optional, Sequence, Set
+
+from loguru import logger
+
+from .events import EventBus
+from .llm_backend import LlmBackend
+from .models import Quest, StoryEntry
+from .similarity import normalize_text
+
+
+_stopwords = frozenset(
+    'the and for with from into onto that this then than your you their they them '
+    'have has had will would should could must what when where which while who whom '
+    'about after before over under some any all find make take give go get'.split()
+)
+# Words that can end any quest, whatever it is about
+_state_cues = frozenset(
+    'complete completed accomplish fulfill reward fail failed failure die died dies dead '
+    'death killed destroyed lost defeated abandon'.split()
+)
+_result_pattern = re.compile(r'^\W*(\d+)\W+(complete|incomplete|failure)\b', re.I | re.M)
+
+QuestCallback = Callable[[Quest], Awaitable[None]]
+
+
+def _stems(words: Iterable[str]) -> Set[str]:
+    """Reduces words to their first five letters, a crude but cheap stemmer"""
+    return {word[:5] for word in words if len(word) > 2 and word not in _stopwords}
+
+
+_state_cue_stems = _stems(_state_cues)
 
 
 class QuestHandler:
-    def __init__(self, quest):
-        self.quest = quest
-
-    def evaluateQuest(self, context: list[StoryEntry]):
-        """Evaluates the current quest and returns a boolean indicating whether the quest is complete"""
-        evaluate_input = [
-            {
-                'role': 'system',
-                'content': """Acting as a quest classifier for a adventure game, classify whether a player has fulfilled the quest or not. Classify and respond with "Complete", "Incomplete", or "Failure" """,
-            }
+    """
+    Tracks the quests of a game and evaluates their progress.
+
+    Each evaluation only looks at the story entries added since the previous
+    one. A keyword prefilter skips quests the new entries don't mention, and
+    the remaining active quests are classified together in one LLM call.
+
+    Args:
+        backend: Language model backend of the game.
+        events: Event bus the quest changes are published on.
+        on_update: Called with each quest whose status changed.
+    """
+
+    system_prompt = (
+        'Acting as a quest classifier for an adventure game, classify whether the player '
+        'has fulfilled each quest based on the latest story events. Respond with one line '
+        'per quest, in the form "<number>: Complete", "<number>: Incomplete" or '
+        '"<number>: Failure".'
+    )
+
+    def __init__(
+        self,
+        backend: LlmBackend,
+        events: EventBus,
+        on_update: Optional[QuestCallback] = None,
+    ):
+        self.backend = backend
+        self.events = events
+        self.on_update = on_update
+        self.quests: List[Quest] = []
+        self.checked_until = 0  # Number of story entries evaluated so far
+        self.entries: Sequence[StoryEntry] = []
+        self.task: Optional[asyncio.Task] = None
+        self.pending = False
+        self.generation = 0  # Incremented by reset, to discard stale results
+        self.llm_calls = 0
+        self.prefiltered = 0
+
+    @property
+    def active_quests(self) -> List[Quest]:
+        return [quest for quest in self.quests if quest.status == 'Incomplete']
+
+    def add(self, description: str, keywords: Optional[List[str]] = None) -> Quest:
+        """
+        Adds a quest, evaluated against the story entries that follow.
+
+        Args:
+            description: What the player has to do.
+            keywords: Words hinting at progress, derived from the description
+                if not given.
+        """
+        quest = Quest(id=len(self.quests) + 1, description=description, keywords=keywords or [])
+        self.quests.append(quest)
+        self.events.publish('quest_added', quest=quest.model_dump())
+        return quest
+
+    def reset(self, story_length: int = 0):
+        """Drops all quests, ie. after the story was reset"""
+        self.quests = []
+        self.checked_until = story_length
+        self.generation += 1
+        self.pending = False
+
+    def schedule(self, entries: Sequence[StoryEntry]):
+        """
+        Evaluates the quests in the background, without delaying the turn.
+        Calls made while an evaluation runs are coalesced into one more.
+
+        Args:
+            entries: All story entries so far.
+        """
+        self.entries = entries
+        self.pending = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.pending:
+            self.pending = False
+            try:
+                await self.evaluate(self.entries)
+            except Exception:
+                logger.exception('Quest evaluation failed')
+
+    def might_change(self, quest: Quest, story_stems: Set[str]) -> bool:
+        """Whether new story text with the given stems could affect the quest"""
+        if story_stems & _state_cue_stems:
+            return True
+        words = quest.keywords or normalize_text(quest.description).split()
+        return bool(story_stems & _stems(normalize_text(' '.join(words)).split()))
+
+    async def evaluate(self, entries: Sequence[StoryEntry]) -> List[Quest]:
+        """
+        Evaluates the active quests against the entries added since the last
+        evaluation. If the LLM call fails, the entries are evaluated again
+        with the next ones.
+
+        Args:
+            entries: All story entries so far.
+
+        Returns:
+            The quests whose status changed.
+        """
+        new_entries = entries[self.checked_until :]
+        checked_until = max(self.checked_until, len(entries))
+        active = self.active_quests
+        if not new_entries or not active:
+            self.checked_until = checked_until
+            return []
+        story = ' '.join(f'{entry.story_action} {entry.narration_result}' for entry in new_entries)
+        story_stems = _stems(normalize_text(story).split())
+        candidates = [quest for quest in active if self.might_change(quest, story_stems)]
+        self.prefiltered += len(active) - len(candidates)
+        if not candidates:
+            self.checked_until = checked_until
+            return []
+
+        generation = self.generation
+        self.llm_calls += 1
+        response = await self.backend.chat(self._messages(candidates, new_entries), task='quest')
+        if generation != self.generation:
+            return []  # The quests were reset meanwhile
+        self.checked_until = checked_until
+        results = {
+            int(number): status.capitalize()
+            for number, status in _result_pattern.findall(response)
+        }
+
+        changed = []
+        for number, quest in enumerate(candidates, start=1):
+            status = results.get(number, 'Incomplete')
+            if status == quest.status:
+                continue
+            quest.status = status
+            changed.append(quest)
+            logger.info('Quest {} is now {}: {}', quest.id, status, quest.description)
+            self.events.publish('quest_updated', quest=quest.model_dump())
+            if self.on_update:
+                await self.on_update(quest)
+        return changed
+
+    def _messages(self, quests: List[Quest], entries: List[StoryEntry]) -> List[dict]:
+        story = '\n'.join(
+            f'Player: {entry.story_action}\nNarrator: {entry.narration_result}'
+            for entry in entries
+        )
+        numbered = '\n'.join(
+            f'{number}. {quest.description}' for number, quest in enumerate(quests, start=1)
+        )
+        return [
+            {'role': 'system', 'content': self.system_prompt},
+            {'role': 'user', 'content': f'Latest story events:\n{story}\n\nQuests:\n{numbered}'},
         ]
@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+from contextlib import suppress
+from typing import Dict, List, Optional
+
+from .config import config
+from .llm_backend import LlmBackend, ScheduledBackend, create_llm_backend, create_scheduler
+from .llm_game import LlmGame
+from .llm_twitch_bot import GameChannel, LlmTwitchBot
+from .scoring import PointsLedger
+from .storage import GameStore
+
+
+def channel_database_path(channel: str) -> str:
+    """
+    Returns the database file of a channel. The main channel uses
+    database_path as is, other channels get a file next to it.
+    """
+    if channel == config.twitch_channel_name.lower():
+        return config.database_path
+    root, ext = os.path.splitext(config.database_path)
+    return f'{root}.{channel}{ext or ".db"}'
+
+
+class GameRegistry:
+    """
+    Hosts independent games for any number of Twitch channels in one process.
+
+    Every channel has its own game and storage, played through one bot that
+    joins all channels. LLM calls of all channels share one backend, admitted
+    fairly across channels.
+
+    Args:
+        backend: Backend shared by all channels, created from the config if not given.
+    """
+
+    def __init__(self, backend: Optional[LlmBackend] = None):
+        self.backend = backend or create_llm_backend()
+        self.scheduler = create_scheduler()
+        self.games: Dict[str, LlmGame] = {}
+        self.game_channels: Dict[str, GameChannel] = {}
+        self.bot: Optional[LlmTwitchBot] = None
+        self.bot_task: Optional[asyncio.Task] = None
+
+    @property
+    def channels(self) -> List[str]:
+        return list(self.games)
+
+    def get(self, channel: str) -> Optional[LlmGame]:
+        return self.games.get(channel.lower())
+
+    def add_channel(self, channel: str) -> LlmGame:
+        """
+        Creates the game of a channel, resuming its stored state.
+
+        Args:
+            channel: Name of the Twitch channel.
+
+        Returns:
+            The game of the channel.
+        """
+        channel = channel.lower()
+        if channel in self.games:
+            return self.games[channel]
+        store = GameStore(
+            channel_database_path(channel), flush_interval=config.storage_flush_interval
+        )
+        stored = store.load()
+        # All channels draw openings from the pool of the first one
+        first_game = next(iter(self.games.values()), None)
+        game = LlmGame(
+            backend=ScheduledBackend(self.backend, self.scheduler, channel),
+            store=store,
+            stored=stored,
+            initial_prompts=first_game and first_game.generator.initial_prompts,
+            image_cache=first_game and first_game.generator.image_cache,
+        )
+        viewer_points = PointsLedger(stored.viewer_points, stored.points_offset)
+        game_channel = GameChannel(game, viewer_points=viewer_points, channel_name=channel)
+        game.hooks = game_channel
+        self.games[channel] = game
+        self.game_channels[channel] = game_channel
+        store.start()
+        return game
+
+    def start(self):
+        """Connects the bot, joining the channels added so far"""
+        self.bot = LlmTwitchBot(list(self.game_channels.values()))
+        # We need to maintain a reference to running coroutines to prevent GC
+        self.bot_task = asyncio.create_task(self.bot.start())
+
+    async def close(self):
+        """Disconnects the bot, then stops the games and closes their storage"""
+        if self.bot:
+            with suppress(AttributeError):  # twitchio fails to close a bot that never connected
+                await self.bot.close()
+            self.bot_task.cancel()
+            await asyncio.gather(self.bot_task, return_exceptions=True)
+        for game_channel in self.game_channels.values():
+            await game_channel.close()
+        await asyncio.gather(*(game.close() for game in self.games.values()))
+        for game in self.games.values():
+            await game.generator.image_cache.close()  # Shared, closing twice is harmless
+        await self.backend.close()
@@ -0,0 +1,121 @@
+import asyncio
+import importlib
+import sys
+import threading
+import time
+import traceback
+
+from typing import Optional
+
+from loguru import logger
+
+from .config import config
+
+
+def configure_logging():
+    """
+    Logs through a queue drained by a background thread, so writing a log
+    line never blocks the event loop.
+    """
+    logger.remove()
+    logger.add(sys.stderr, level='DEBUG' if config.debug else config.log_level, enqueue=True)
+
+
+def uvloop_available() -> bool:
+    """Whether uvloop should and can be used as the event loop"""
+    if not config.uvloop:
+        return False
+    try:
+        import uvloop  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def install_event_loop_policy():
+    """Makes asyncio.run use uvloop if enabled and installed"""
+    if uvloop_available():
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def preload_modules(*names: str):
+    """
+    Imports slow modules in a background thread, so their first use doesn't
+    block the event loop.
+    """
+
+    def run():
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                logger.exception('Failed to preload {}', name)
+
+    threading.Thread(target=run, name='preload-modules', daemon=True).start()
+
+
+def configure_event_loop(loop: asyncio.AbstractEventLoop):
+    """Applies the debug switch to the running loop"""
+    if config.debug:
+        loop.set_debug(True)
+        loop.slow_callback_duration = config.slow_callback_ms / 1000
+
+
+class LoopWatchdog:
+    """
+    Reports callbacks that block the event loop.
+
+    The loop touches a heartbeat every few milliseconds. A watchdog thread
+    checks it and, when the loop has been stuck for more than threshold
+    seconds, logs the stack of the loop thread, showing the blocking code.
+
+    Args:
+        threshold: Seconds the loop may be blocked before it is reported.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.blocked_count = 0
+
+    def start(self):
+        if self.task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self._beat())
+        self.thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self.thread.start()
+
+    async def close(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _beat(self):
+        interval = self.threshold / 4
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(interval)
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat
+            if blocked <= self.threshold or reported == heartbeat:
+                continue
+            reported = heartbeat  # Report each blocking episode once
+            self.blocked_count += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else ''
+            logger.warning(
+                'Event loop blocked for {:.0f}ms, at:\n{}', blocked * 1000, stack
+            )
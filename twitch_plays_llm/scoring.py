@@ -0,0 +1,180 @@
+import heapq
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class PointsLedger:
+    """
+    Viewer points with O(1) updates, O(1) per-round accumulation and an
+    O(log n) amortized leaderboard.
+
+    Points given to every viewer at once are kept as a global offset instead
+    of touching each viewer: a viewer's points are their raw balance plus the
+    offset. The leaderboard is a max-heap of raw balances with lazy
+    invalidation, since the common offset doesn't change the ranking.
+
+    Args:
+        raw_points: Raw balances of known viewers (ie. loaded from storage).
+        offset: Points given to all viewers, not included in the raw balances.
+    """
+
+    def __init__(self, raw_points: Optional[Dict[str, int]] = None, offset: int = 0):
+        self.raw_points: Dict[str, int] = dict(raw_points or {})
+        self.offset = offset
+        self._heap: List[Tuple[int, str]] = [(-raw, user) for user, raw in self.raw_points.items()]
+        heapq.heapify(self._heap)
+
+    def __contains__(self, user: str) -> bool:
+        return user in self.raw_points
+
+    def __len__(self) -> int:
+        return len(self.raw_points)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.raw_points)
+
+    def __getitem__(self, user: str) -> int:
+        return self.raw_points[user] + self.offset
+
+    def get(self, user: str, default: int = 0) -> int:
+        raw = self.raw_points.get(user)
+        return default if raw is None else raw + self.offset
+
+    def add(self, user: str, points: int) -> int:
+        """
+        Adds points to a viewer, starting from zero for new viewers.
+
+        Args:
+            user: The viewer's name.
+            points: Points to add, negative to remove.
+
+        Returns:
+            The viewer's new raw balance.
+        """
+        raw = self.raw_points.get(user, -self.offset) + points
+        self.raw_points[user] = raw
+        heapq.heappush(self._heap, (-raw, user))
+        if len(self._heap) > 2 * len(self.raw_points) + 64:
+            self._compact()
+        return raw
+
+    def add_to_all(self, points: int):
+        """Gives points to every known viewer in O(1)"""
+        self.offset += points
+
+    def top(self, n: int) -> List[Tuple[str, int]]:
+        """
+        Returns the n viewers with the most points.
+
+        Returns:
+            List of (user, points), highest first.
+        """
+        result = []
+        while self._heap and len(result) < n:
+            neg_raw, user = heapq.heappop(self._heap)
+            if self.raw_points.get(user) == -neg_raw and all(user != u for u, _ in result):
+                result.append((user, -neg_raw + self.offset))
+        for user, points in result:
+            heapq.heappush(self._heap, (-(points - self.offset), user))
+        return result
+
+    def _compact(self):
+        """Drops heap entries of outdated balances"""
+        self._heap = [(-raw, user) for user, raw in self.raw_points.items()]
+        heapq.heapify(self._heap)
+
+
+class ProposalRanking:
+    """
+    Running top-k of proposal votes for the current round, in O(log n)
+    amortized per vote.
+
+    As with the points leaderboard, vote counts are kept in a max-heap with
+    lazy invalidation. The top-k is cached and updated in place while votes
+    are added. Only when votes are taken from a leader, which may let another
+    proposal overtake it, is the top-k read again from the heap.
+
+    Proposals are identified by their 1-based id. Ties are broken in favor of
+    the earlier proposal.
+
+    Args:
+        k: Number of leading proposals to track (at least 1).
+    """
+
+    def __init__(self, k: int = 1):
+        self.k = max(1, k)
+        self.votes: List[int] = []
+        self._heap: List[Tuple[int, int]] = []
+        self._leaders: Optional[List[int]] = []  # None when it has to be read from the heap
+
+    def _key(self, proposal_id: int) -> Tuple[int, int]:
+        return -self.votes[proposal_id - 1], proposal_id
+
+    def reset(self, votes: Optional[List[int]] = None):
+        """Starts a new round, optionally from existing vote counts"""
+        self.votes = list(votes or [])
+        self._compact()
+        self._leaders = None
+
+    def add(self) -> int:
+        """Registers a new proposal without votes, returning its id"""
+        self.votes.append(0)
+        proposal_id = len(self.votes)
+        heapq.heappush(self._heap, self._key(proposal_id))
+        # Without votes it ranks after every earlier proposal
+        if self._leaders is not None and len(self._leaders) < self.k:
+            self._leaders.append(proposal_id)
+        return proposal_id
+
+    def vote(self, proposal_id: int, weight: int) -> int:
+        """
+        Adds votes to a proposal.
+
+        Returns:
+            The new vote count of the proposal.
+        """
+        self.votes[proposal_id - 1] += weight
+        heapq.heappush(self._heap, self._key(proposal_id))
+        if len(self._heap) > 2 * len(self.votes) + 64:
+            self._compact()
+        leaders = self._leaders
+        if leaders is None:
+            pass
+        elif proposal_id in leaders:
+            if weight < 0:
+                self._leaders = None  # The best of the others may overtake it
+            else:
+                leaders.sort(key=self._key)
+        elif weight > 0 and self._key(proposal_id) < self._key(leaders[-1]):
+            leaders[-1] = proposal_id
+            leaders.sort(key=self._key)
+        return self.votes[proposal_id - 1]
+
+    @property
+    def leaders(self) -> List[int]:
+        """Ids of the top-k proposals, best first"""
+        if self._leaders is None:
+            self._leaders = self._top()
+        return self._leaders
+
+    @property
+    def leader(self) -> Optional[int]:
+        """Id of the proposal with the most votes"""
+        leaders = self.leaders
+        return leaders[0] if leaders else None
+
+    def _top(self) -> List[int]:
+        """Pops the top-k off the heap, dropping outdated entries, and pushes it back"""
+        result = []
+        while self._heap and len(result) < self.k:
+            neg_votes, proposal_id = heapq.heappop(self._heap)
+            if self.votes[proposal_id - 1] == -neg_votes and proposal_id not in result:
+                result.append(proposal_id)
+        for proposal_id in result:
+            heapq.heappush(self._heap, self._key(proposal_id))
+        return result
+
+    def _compact(self):
+        """Drops heap entries of outdated vote counts"""
+        self._heap = [self._key(proposal_id) for proposal_id in range(1, len(self.votes) + 1)]
+        heapq.heapify(self._heap)
@@ -0,0 +1,389 @@
+import asyncio
+import json
+import sqlite3
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from loguru import logger
+from pydantic import BaseModel
+
+from .config import config
+from .events import GameEvent
+from .llm_game import LlmGame
+
+
+class ChannelStateUpdate(BaseModel):
+    """Changes to the published state of one channel"""
+
+    proposals: Optional[bytes] = None  # JSON list of proposals
+    vote_deadline: Optional[float] = None  # Wall clock time the vote closes, if open
+    vote_total_seconds: float = 0.0
+    story_version: int = 0
+    story_length: int = 0
+    story_entries: Dict[int, bytes] = {}  # Index -> entry JSON
+    event_seq: int = 0  # Sequence number of the last event the state includes
+    events: List[GameEvent] = []  # Events since the previous update
+    events_reset: bool = False  # Whether earlier events were lost, ie. after a restart
+
+
+class GameView:
+    """
+    Read-only view of a game, as served by the API.
+    """
+
+    def proposals_json(self) -> bytes:
+        raise NotImplementedError
+
+    def vote_deadline(self) -> Optional[Tuple[float, float]]:
+        """Returns the wall clock time the vote closes and its total duration, if open"""
+        raise NotImplementedError
+
+    def story(self, start: int, stop: Optional[int]) -> Tuple[int, List[Union[bytes, memoryview]]]:
+        """
+        Returns the story version and the JSON of the story entries in the
+        given range.
+        """
+        raise NotImplementedError
+
+    def story_version(self) -> int:
+        raise NotImplementedError
+
+    def story_length(self) -> int:
+        raise NotImplementedError
+
+    def event_seq(self) -> int:
+        """Returns the sequence number of the last game event reflected in the view"""
+        raise NotImplementedError
+
+
+class LiveGameView(GameView):
+    """View of a game running in this process"""
+
+    def __init__(self, game: LlmGame):
+        self.game = game
+
+    def proposals_json(self) -> bytes:
+        return json.dumps([proposal.model_dump() for proposal in self.game.proposals]).encode()
+
+    def vote_deadline(self) -> Optional[Tuple[float, float]]:
+        if self.game.next_count_vote_time is None:
+            return None
+        return self.game.next_count_vote_time, float(config.vote_delay)
+
+    def story(self, start: int, stop: Optional[int]) -> Tuple[int, List[Union[bytes, memoryview]]]:
+        generator = self.game.generator
+        entries = generator.past_story_entries
+        stop = len(entries) if stop is None else min(stop, len(entries))
+        # Older entries are views into the spill file, joined into the response without copies
+        return generator.version, entries.json_slice(start, stop)
+
+    def story_version(self) -> int:
+        return self.game.generator.version
+
+    def story_length(self) -> int:
+        return len(self.game.generator.past_story_entries)
+
+    def event_seq(self) -> int:
+        return self.game.events.seq
+
+
+class SharedStateStore:
+    """
+    State published by the process running the games, read by API workers.
+    """
+
+    def write(self, channel: str, update: ChannelStateUpdate, story_reset: bool):
+        raise NotImplementedError
+
+    def channels(self) -> List[str]:
+        raise NotImplementedError
+
+    def view(self, channel: str) -> Optional[GameView]:
+        raise NotImplementedError
+
+    def events_since(self, channel: str, seq: int) -> Optional[List[GameEvent]]:
+        """
+        Returns the published events of a channel after the given sequence
+        number, or None if some of them are no longer stored.
+        """
+        raise NotImplementedError
+
+
+class SqliteStateStore(SharedStateStore):
+    """
+    Shared store in a SQLite database in WAL mode, so any number of worker
+    processes can read while the game process writes.
+
+    Args:
+        path: Path to the database file.
+        event_backlog: Number of recent events kept per channel for the
+            event streams of the API workers.
+    """
+
+    def __init__(self, path: str, event_backlog: int = 1024):
+        self.path = path
+        self.event_backlog = event_backlog
+        self.local = threading.local()  # One connection per thread
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, check_same_thread=False)
+            db.executescript(
+                """
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                CREATE TABLE IF NOT EXISTS channel_state (
+                    channel TEXT PRIMARY KEY,
+                    proposals BLOB NOT NULL,
+                    vote_deadline REAL,
+                    vote_total_seconds REAL NOT NULL,
+                    story_version INTEGER NOT NULL,
+                    event_seq INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS story_entries (
+                    channel TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    entry BLOB NOT NULL,
+                    PRIMARY KEY (channel, idx)
+                );
+                CREATE TABLE IF NOT EXISTS events (
+                    channel TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    type TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (channel, seq)
+                );
+                """
+            )
+            columns = [row[1] for row in db.execute('PRAGMA table_info(channel_state)')]
+            if 'event_seq' not in columns:
+                # Stores from before events were published
+                db.execute(
+                    'ALTER TABLE channel_state ADD COLUMN event_seq INTEGER NOT NULL DEFAULT 0'
+                )
+        return db
+
+    def write(self, channel: str, update: ChannelStateUpdate, story_reset: bool):
+        db = self._db()
+        with db:
+            proposals = update.proposals
+            if proposals is None:
+                row = db.execute(
+                    'SELECT proposals FROM channel_state WHERE channel = ?', (channel,)
+                ).fetchone()
+                proposals = row[0] if row else b'[]'
+            db.execute(
+                'INSERT OR REPLACE INTO channel_state VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    channel,
+                    proposals,
+                    update.vote_deadline,
+                    update.vote_total_seconds,
+                    update.story_version,
+                    update.event_seq,
+                ),
+            )
+            if story_reset:
+                db.execute('DELETE FROM story_entries WHERE channel = ?', (channel,))
+            db.execute(
+                'DELETE FROM story_entries WHERE channel = ? AND idx >= ?',
+                (channel, update.story_length),
+            )
+            db.executemany(
+                'INSERT OR REPLACE INTO story_entries VALUES (?, ?, ?)',
+                [(channel, index, data) for index, data in update.story_entries.items()],
+            )
+            if update.events_reset:
+                db.execute('DELETE FROM events WHERE channel = ?', (channel,))
+            db.executemany(
+                'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?)',
+                [(channel, e.seq, e.type, json.dumps(e.data)) for e in update.events],
+            )
+            db.execute(
+                'DELETE FROM events WHERE channel = ? AND seq <= ?',
+                (channel, update.event_seq - self.event_backlog),
+            )
+
+    def channels(self) -> List[str]:
+        return [channel for channel, in self._db().execute('SELECT channel FROM channel_state')]
+
+    def view(self, channel: str) -> Optional[GameView]:
+        db = self._db()
+        row = db.execute(
+            'SELECT proposals, vote_deadline, vote_total_seconds, story_version, event_seq'
+            ' FROM channel_state WHERE channel = ?',
+            (channel,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        def story(start: int, stop: Optional[int]) -> List[bytes]:
+            stop = 2**62 if stop is None else stop
+            return [
+                entry
+                for entry, in db.execute(
+                    'SELECT entry FROM story_entries WHERE channel = ? AND idx >= ? AND idx < ?'
+                    ' ORDER BY idx',
+                    (channel, start, stop),
+                )
+            ]
+
+        def story_length() -> int:
+            return db.execute(
+                'SELECT COUNT(*) FROM story_entries WHERE channel = ?', (channel,)
+            ).fetchone()[0]
+
+        return _StateView(*row, story, story_length)
+
+    def events_since(self, channel: str, seq: int) -> Optional[List[GameEvent]]:
+        db = self._db()
+        with db:
+            db.execute('BEGIN')  # Both reads see the same publish
+            row = db.execute(
+                'SELECT event_seq FROM channel_state WHERE channel = ?', (channel,)
+            ).fetchone()
+            last_seq = row[0] if row else 0
+            if seq == last_seq:
+                return []
+            events = [
+                GameEvent(seq=s, type=t, data=json.loads(d))
+                for s, t, d in db.execute(
+                    'SELECT seq, type, data FROM events'
+                    ' WHERE channel = ? AND seq > ? AND seq <= ? ORDER BY seq',
+                    (channel, seq, last_seq),
+                )
+            ]
+        if seq > last_seq or not events or events[0].seq != seq + 1:
+            return None
+        return events
+
+
+class _StateView(GameView):
+    def __init__(
+        self,
+        proposals,
+        vote_deadline,
+        vote_total_seconds,
+        story_version,
+        event_seq,
+        story,
+        story_length,
+    ):
+        self._proposals = proposals
+        self._vote_deadline = vote_deadline
+        self._vote_total_seconds = vote_total_seconds
+        self._story_version = story_version
+        self._event_seq = event_seq
+        self._story = story
+        self._story_length = story_length
+
+    def proposals_json(self) -> bytes:
+        return self._proposals
+
+    def vote_deadline(self) -> Optional[Tuple[float, float]]:
+        if self._vote_deadline is None:
+            return None
+        return self._vote_deadline, self._vote_total_seconds
+
+    def story(self, start: int, stop: Optional[int]) -> Tuple[int, List[bytes]]:
+        return self._story_version, self._story(start, stop)
+
+    def story_version(self) -> int:
+        return self._story_version
+
+    def story_length(self) -> int:
+        return self._story_length()
+
+    def event_seq(self) -> int:
+        return self._event_seq
+
+
+class StatePublisher:
+    """
+    Mirrors the state of running games into a shared store.
+
+    Follows each game's event stream and writes the changed parts in batches
+    every interval seconds on a background thread, along with the events
+    themselves for the event streams of the API workers.
+
+    Args:
+        store: The store to publish to.
+        interval: Seconds between batched writes.
+    """
+
+    def __init__(self, store: SharedStateStore, interval: float = 0.25):
+        self.store = store
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='state-publisher')
+        self.tasks: List[asyncio.Task] = []
+
+    def add_game(self, channel: str, game: LlmGame):
+        self.tasks.append(asyncio.create_task(self._follow(channel, game)))
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+    async def _follow(self, channel: str, game: LlmGame):
+        loop = asyncio.get_running_loop()
+        last_seq = None  # Of the last published event, the store may hold older runs' events
+        while True:
+            queue = game.events.subscribe()
+            # Publish everything after (re)subscribing
+            dirty_proposals, story_reset = True, True
+            dirty_entries: Set[int] = set(range(len(game.generator.past_story_entries)))
+            try:
+                while True:
+                    update = ChannelStateUpdate(
+                        vote_deadline=game.next_count_vote_time,
+                        vote_total_seconds=float(config.vote_delay),
+                        story_version=game.generator.version,
+                        story_length=len(game.generator.past_story_entries),
+                        story_entries={
+                            i: game.generator.entry_json(i)
+                            for i in dirty_entries
+                            if i < len(game.generator.past_story_entries)
+                        },
+                    )
+                    if dirty_proposals:
+                        update.proposals = LiveGameView(game).proposals_json()
+                    missed = None if last_seq is None else game.events.events_since(last_seq)
+                    update.events = list(game.events.backlog) if missed is None else missed
+                    update.events_reset = missed is None
+                    update.event_seq = last_seq = game.events.seq
+                    try:
+                        await loop.run_in_executor(
+                            self.executor, self.store.write, channel, update, story_reset
+                        )
+                    except Exception:
+                        logger.exception('Failed to publish state of {}', channel)
+                    dirty_proposals, story_reset, dirty_entries = False, False, set()
+
+                    event = await queue.get()
+                    await asyncio.sleep(self.interval)  # Let changes accumulate
+                    events = [event]
+                    while not queue.empty():
+                        events.append(queue.get_nowait())
+                    if None in events:
+                        break  # Fell behind, resubscribe and publish everything
+                    for event in events:
+                        if event.type in (
+                            'proposal_added',
+                            'proposal_updated',
+                            'vote_changed',
+                            'proposals_cleared',
+                        ):
+                            dirty_proposals = True
+                        elif event.type in ('narration_appended', 'image_updated'):
+                            dirty_entries.add(event.data['index'])
+                        elif event.type == 'story_reset':
+                            story_reset = True
+                            dirty_entries = {0}
+            finally:
+                game.events.unsubscribe(queue)
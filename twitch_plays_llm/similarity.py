@@ -0,0 +1,193 @@
+import random
+import re
+import zlib
+
+from collections import OrderedDict, defaultdict
+from typing import Dict, Generic, Hashable, Iterable, List, Optional, Set, Tuple, TypeVar
+
+
+T = TypeVar('T')
+K = TypeVar('K', bound=Hashable)
+
+_word_pattern = re.compile(r'[a-z0-9]+')
+_mersenne_prime = (1 << 61) - 1
+
+
+def normalize_text(text: str) -> str:
+    """Lowercases text and reduces it to words separated by single spaces"""
+    return ' '.join(_word_pattern.findall(text.lower()))
+
+
+def shingles(text: str, n: int = 2) -> Set[str]:
+    """Returns the word n-grams of normalized text (the words themselves if shorter)"""
+    words = text.split()
+    if len(words) < n:
+        return set(words)
+    return {' '.join(words[i : i + n]) for i in range(len(words) - n + 1)}
+
+
+class MinHasher:
+    """
+    Computes MinHash signatures, whose matching positions estimate the
+    Jaccard similarity of the shingle sets they were made from.
+
+    Args:
+        num_perm: Length of the signatures.
+        seed: Seed of the hash functions, signatures are only comparable
+            between hashers with the same seed.
+    """
+
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        rng = random.Random(seed)
+        self.params = [
+            (rng.randrange(1, _mersenne_prime), rng.randrange(0, _mersenne_prime))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, items: Iterable[str]) -> Tuple[int, ...]:
+        hashes = [zlib.crc32(item.encode()) for item in items] or [0]
+        return tuple(
+            min((a * h + b) % _mersenne_prime for h in hashes) for a, b in self.params
+        )
+
+    @staticmethod
+    def similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+        return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class LshIndex(Generic[K]):
+    """
+    Locality-sensitive hashing index of MinHash signatures.
+
+    Signatures are split into bands, and keys sharing any band are
+    candidates. Inserting, removing and querying take O(bands) time.
+
+    Args:
+        num_perm: Length of the indexed signatures.
+        bands: Number of bands, more bands find less similar candidates.
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16):
+        self.rows = num_perm // bands
+        self.bands = bands
+        self.buckets: List[Dict[Tuple[int, ...], Set[K]]] = [
+            defaultdict(set) for _ in range(bands)
+        ]
+        self.signatures: Dict[K, Tuple[int, ...]] = {}
+
+    def _band_keys(self, signature: Tuple[int, ...]) -> Iterable[Tuple[int, Tuple[int, ...]]]:
+        for band in range(self.bands):
+            yield band, signature[band * self.rows : (band + 1) * self.rows]
+
+    def add(self, key: K, signature: Tuple[int, ...]):
+        self.signatures[key] = signature
+        for band, band_key in self._band_keys(signature):
+            self.buckets[band][band_key].add(key)
+
+    def remove(self, key: K):
+        signature = self.signatures.pop(key, None)
+        if signature is None:
+            return
+        for band, band_key in self._band_keys(signature):
+            bucket = self.buckets[band][band_key]
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[band][band_key]
+
+    def query(self, signature: Tuple[int, ...], threshold: float) -> Optional[Tuple[K, float]]:
+        """
+        Finds the most similar indexed key.
+
+        Returns:
+            The key and its estimated similarity, if at least threshold.
+        """
+        candidates = set()
+        for band, band_key in self._band_keys(signature):
+            candidates.update(self.buckets[band].get(band_key, ()))
+        best = None
+        for key in candidates:
+            similarity = MinHasher.similarity(signature, self.signatures[key])
+            if similarity >= threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
+
+
+class SemanticCache(Generic[T]):
+    """
+    Cache of results of slow calls, looked up by the similarity of their
+    input text rather than exact equality.
+
+    Keeps the max_entries most recently used results. Tracks the hit rate
+    and the latency saved by hits, estimated from the average latency of
+    the calls that were made.
+
+    Args:
+        threshold: Minimum estimated Jaccard similarity of the word bigrams
+            for a cached result to be reused.
+        max_entries: Number of results kept.
+        num_perm: Length of the MinHash signatures.
+    """
+
+    def __init__(self, threshold: float, max_entries: int = 256, num_perm: int = 64):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hasher = MinHasher(num_perm)
+        self.index: LshIndex[int] = LshIndex(num_perm)
+        self.entries: 'OrderedDict[int, T]' = OrderedDict()
+        self._next_key = 0
+        self.hits = 0
+        self.misses = 0
+        self.calls = 0
+        self.call_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def signature(self, text: str) -> Tuple[int, ...]:
+        return self.hasher.signature(shingles(normalize_text(text)))
+
+    def get(self, text: str) -> Optional[T]:
+        """Returns the result cached for text similar enough to the given one"""
+        if self.threshold > 1:
+            return None  # Disabled
+        found = self.index.query(self.signature(text), self.threshold)
+        if found is None:
+            self.misses += 1
+            return None
+        key, _ = found
+        self.entries.move_to_end(key)
+        self.hits += 1
+        if self.calls:
+            self.saved_seconds += self.call_seconds / self.calls
+        return self.entries[key]
+
+    def put(self, text: str, value: T, seconds: float = 0.0):
+        """
+        Caches the result computed for a text.
+
+        Args:
+            text: Input the value was computed from.
+            value: The result to reuse.
+            seconds: How long computing it took.
+        """
+        self.calls += 1
+        self.call_seconds += seconds
+        key = self._next_key
+        self._next_key += 1
+        self.entries[key] = value
+        self.index.add(key, self.signature(text))
+        while len(self.entries) > self.max_entries:
+            old_key, _ = self.entries.popitem(last=False)
+            self.index.remove(old_key)
+
+    def stats(self) -> dict:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hit_rate,
+            saved_seconds=self.saved_seconds,
+        )
+
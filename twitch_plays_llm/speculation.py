@@ -0,0 +1,116 @@
+import asyncio
+
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from .models import Proposal
+from .story_generator import StoryGenerator
+
+
+class NarrationSpeculator:
+    """
+    Pre-generates narrations for the leading proposals while the vote is open.
+
+    When the ranking changes, speculations for proposals that left the top
+    ranks are cancelled. When the vote closes, the winner's narration is
+    taken if it was speculated, skipping the LLM round trip.
+
+    Args:
+        generator: The story generator used to produce narrations.
+        top_k: Number of leading proposals to speculate on.
+        max_concurrent: Maximum number of speculative LLM calls in flight.
+    """
+
+    def __init__(self, generator: StoryGenerator, top_k: int, max_concurrent: int):
+        self.generator = generator
+        self.top_k = top_k
+        self.max_concurrent = max_concurrent
+        # proposal_id -> (story_action, story position, task)
+        self.speculations: Dict[int, Tuple[str, Tuple[int, int], asyncio.Task]] = {}
+        self.started = 0
+        self.cancelled = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of turns whose winning narration was speculated"""
+        return self.hits / max(1, self.hits + self.misses)
+
+    def update(self, leaders: List[int], proposals: List[Proposal]):
+        """
+        Cancels speculations for proposals that fell out of the top ranks and
+        starts ones for new leaders within the budget.
+
+        Args:
+            leaders: Ids of the leading proposals, best first.
+            proposals: The proposals of the current round, in id order.
+        """
+        leaders = leaders[: self.top_k]
+        for proposal_id, (story_action, _, _) in list(self.speculations.items()):
+            # Proposals may be replaced when the round is full
+            if proposal_id not in leaders or proposals[proposal_id - 1].message != story_action:
+                self._cancel(proposal_id)
+
+        running = sum(1 for _, _, task in self.speculations.values() if not task.done())
+        for proposal_id in leaders:
+            if proposal_id in self.speculations:
+                continue
+            if running >= self.max_concurrent:
+                break
+            story_action = proposals[proposal_id - 1].message
+            task = asyncio.create_task(self.generator.speculate_narration(story_action))
+            self.speculations[proposal_id] = (story_action, self.generator.position, task)
+            self.started += 1
+            running += 1
+
+    async def take(self, proposal_id: int, story_action: str) -> Optional[str]:
+        """
+        Claims the speculated narration of the winning proposal and discards
+        all other speculations.
+
+        Args:
+            proposal_id: The id of the winning proposal.
+            story_action: The action of the winning proposal.
+
+        Returns:
+            The narration, or None if it wasn't speculated or is outdated.
+        """
+        speculation = self.speculations.pop(proposal_id, None)
+        self.clear()
+        narration = None
+        if speculation:
+            action, position, task = speculation
+            if action == story_action and position == self.generator.position:
+                try:
+                    narration = await task
+                except Exception:
+                    logger.exception('Speculative narration failed')
+            else:
+                task.cancel()
+        if narration:
+            self.hits += 1
+        else:
+            self.misses += 1
+        logger.info(
+            'Speculation {} (hit rate {:.0%}, {} started, {} cancelled)',
+            'hit' if narration else 'miss',
+            self.hit_rate,
+            self.started,
+            self.cancelled,
+        )
+        return narration
+
+    def clear(self):
+        """Cancels all speculations"""
+        for proposal_id in list(self.speculations):
+            self._cancel(proposal_id)
+
+    def _cancel(self, proposal_id: int):
+        _, _, task = self.speculations.pop(proposal_id)
+        if not task.done():
+            task.cancel()
+            self.cancelled += 1
+        elif not task.cancelled():
+            task.exception()  # Mark any failure as retrieved
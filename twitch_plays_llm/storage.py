@@ -0,0 +1,245 @@
+import asyncio
+import json
+import sqlite3
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+from .models import Proposal, StoryEntry
+
+
+class StoredGame(BaseModel):
+    """Game state recovered from storage at startup, the story is read by iter_story_entries"""
+
+    viewer_points: Dict[str, int] = {}  # Raw balances, excluding points_offset
+    points_offset: int = 0  # Points given to all viewers
+    proposals: List[Proposal] = []
+    voters: Dict[str, Tuple[int, int]] = {}  # user -> (proposal id, weight) this round
+
+
+class GameStore:
+    """
+    Crash-safe SQLite storage for viewer points, the story, the proposals and
+    who voted for them.
+
+    Changes are only recorded in memory by the game (a dict assignment) and
+    written in batches by a background task every flush_interval seconds on a
+    dedicated thread, so chat floods coalesce into at most one write per key
+    per flush and never block the event loop. The database runs in WAL mode so
+    a crash loses at most the last unflushed batch.
+
+    Args:
+        path: Path to the SQLite database file.
+        flush_interval: Seconds between batched writes.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='game-store')
+        self.connection: Optional[sqlite3.Connection] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        self._pending_points: Dict[str, int] = {}
+        self._pending_offset: Optional[int] = None
+        self._pending_entries: Dict[int, StoryEntry] = {}
+        self._pending_reset = False
+        self._pending_proposals: Optional[List[Proposal]] = None
+        self._pending_votes: Dict[str, Tuple[int, int]] = {}
+        self._pending_clear_votes = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.executescript(
+                """
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                CREATE TABLE IF NOT EXISTS viewer_points (
+                    user TEXT PRIMARY KEY, points INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS story_entries (
+                    idx INTEGER PRIMARY KEY,
+                    story_action TEXT NOT NULL,
+                    narration_result TEXT NOT NULL,
+                    narration_image_url TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS proposals (
+                    idx INTEGER PRIMARY KEY,
+                    user TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    vote INTEGER NOT NULL,
+                    co_authors TEXT NOT NULL DEFAULT '[]'
+                );
+                CREATE TABLE IF NOT EXISTS voters (
+                    user TEXT PRIMARY KEY, proposal_id INTEGER NOT NULL, weight INTEGER NOT NULL
+                );
+                """
+            )
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(proposals)')]
+            if 'co_authors' not in columns:
+                # Databases from before proposals were merged
+                self.connection.execute(
+                    "ALTER TABLE proposals ADD COLUMN co_authors TEXT NOT NULL DEFAULT '[]'"
+                )
+        return self.connection
+
+    def load(self) -> StoredGame:
+        """Reads the stored game state. Runs synchronously, meant for startup"""
+        db = self.executor.submit(self._connect).result()
+        return StoredGame(
+            viewer_points=dict(db.execute('SELECT user, points FROM viewer_points')),
+            points_offset=dict(db.execute('SELECT key, value FROM meta')).get('points_offset', 0),
+            proposals=[
+                Proposal(user=u, message=m, vote=v, co_authors=json.loads(c))
+                for u, m, v, c in db.execute(
+                    'SELECT user, message, vote, co_authors FROM proposals ORDER BY idx'
+                )
+            ],
+            voters={
+                u: (i, w) for u, i, w in db.execute('SELECT user, proposal_id, weight FROM voters')
+            },
+        )
+
+    def iter_story_entries(self) -> Iterator[StoryEntry]:
+        """
+        Reads the stored story one entry at a time, so resuming a long story
+        never holds all of it in memory. Runs synchronously, meant for startup.
+        """
+        db = self.executor.submit(self._connect).result()
+        for a, n, u in db.execute(
+            'SELECT story_action, narration_result, narration_image_url'
+            ' FROM story_entries ORDER BY idx'
+        ):
+            yield StoryEntry(story_action=a, narration_result=n, narration_image_url=u)
+
+    def start(self):
+        """Starts periodically flushing changes"""
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Writes any remaining changes and closes the database"""
+        if self.flush_task:
+            self.flush_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.flush_task
+            self.flush_task = None
+        await self.flush()
+        if self.connection:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.connection.close)
+            self.connection = None
+
+    def set_points(self, user: str, points: int):
+        """Records the raw point balance of a viewer"""
+        self._pending_points[user] = points
+
+    def set_points_offset(self, offset: int):
+        """Records the points given to all viewers"""
+        self._pending_offset = offset
+
+    def put_story_entry(self, index: int, entry: StoryEntry):
+        self._pending_entries[index] = entry
+
+    def reset_story(self):
+        """Removes all story entries, ie. on !reset"""
+        self._pending_reset = True
+        self._pending_entries.clear()
+
+    def set_proposals(self, proposals: List[Proposal]):
+        self._pending_proposals = proposals
+
+    def set_vote(self, user: str, proposal_id: int, weight: int):
+        """Records the vote of a viewer this round, proposal id 0 if it was cleared"""
+        self._pending_votes[user] = (proposal_id, weight)
+
+    def clear_votes(self):
+        """Removes the votes of the round, ie. when it closes"""
+        self._pending_clear_votes = True
+        self._pending_votes.clear()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to write game state')
+
+    async def flush(self):
+        """Writes all pending changes in a single transaction"""
+        if not (
+            self._pending_points
+            or self._pending_offset is not None
+            or self._pending_entries
+            or self._pending_reset
+            or self._pending_proposals is not None
+            or self._pending_votes
+            or self._pending_clear_votes
+        ):
+            return
+        points = list(self._pending_points.items())
+        offset = self._pending_offset
+        entries = [
+            (i, e.story_action, e.narration_result, e.narration_image_url)
+            for i, e in self._pending_entries.items()
+        ]
+        reset = self._pending_reset
+        proposals = None
+        if self._pending_proposals is not None:
+            proposals = [
+                (i, p.user, p.message, p.vote, json.dumps(p.co_authors))
+                for i, p in enumerate(self._pending_proposals)
+            ]
+        votes = [(u, i, w) for u, (i, w) in self._pending_votes.items()]
+        clear_votes = self._pending_clear_votes
+        self._pending_points = {}
+        self._pending_offset = None
+        self._pending_entries = {}
+        self._pending_reset = False
+        self._pending_proposals = None
+        self._pending_votes = {}
+        self._pending_clear_votes = False
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            self._write,
+            points,
+            offset,
+            entries,
+            reset,
+            proposals,
+            votes,
+            clear_votes,
+        )
+
+    def _write(
+        self,
+        points: list,
+        offset: Optional[int],
+        entries: list,
+        reset: bool,
+        proposals: Optional[list],
+        votes: list,
+        clear_votes: bool,
+    ):
+        db = self._connect()
+        with db:
+            if points:
+                db.executemany('INSERT OR REPLACE INTO viewer_points VALUES (?, ?)', points)
+            if offset is not None:
+                db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('points_offset', offset))
+            if reset:
+                db.execute('DELETE FROM story_entries')
+            if entries:
+                db.executemany('INSERT OR REPLACE INTO story_entries VALUES (?, ?, ?, ?)', entries)
+            if proposals is not None:
+                db.execute('DELETE FROM proposals')
+                db.executemany('INSERT INTO proposals VALUES (?, ?, ?, ?, ?)', proposals)
+            if clear_votes:
+                db.execute('DELETE FROM voters')
+            if votes:
+                db.executemany('INSERT OR REPLACE INTO voters VALUES (?, ?, ?)', votes)
@@ -1,32 +1,117 @@
 import asyncio
-from loguru import logger
-import openai
+import time
+
+from contextlib import suppress
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List, Optional, Tuple
 
-from asgiref.sync import sync_to_async
+from loguru import logger
 
-from .misc import log_exceptions
+from .config import config
+from .context_window import ContextWindow, story_entry_messages
+from .events import EventBus
+from . import metrics
+from .image_pipeline import ImageCache, ImagePipeline
+from .llm_backend import LlmBackend, ScheduledBackend, create_llm_backend, create_scheduler
+from .misc import iter_sentence_chunks, log_exceptions
+from .prompt_pool import InitialPromptPool
+from .similarity import SemanticCache
+from .storage import GameStore
+from .story_history import StoryHistory
 
 from .models import StoryEntry
 
 
 class StoryGenerator:
-    def __init__(self):
-        # TODO: Dynamically generate initial prompt
+    max_chunk_len = 497  # Streamed narration chunks must fit in a Twitch message
+    min_chunk_len = 200  # Gather sentences after the first to avoid flooding chat
+    default_initial_narration = """Welcome, brave Esther, to the sprawling city of Gearlock, a symphony of cogwheel and steam where airships drift through the sooty skies and giant gearworks define the horizon. Here, a bird's-eye view is a literal commodity you possess, becoming as sparrows or falcons at will. Time isn't a river but a swirling eddy for you, bendable and controllable. The diverse, lively chatter of your "Twitch" keeps your world kaleidoscopic, pushing and pulling you through the cacophonic rhythm of your dual existence. As you walk through the vibrant brass streets, your skilled eyes see the intricate beauty of life sketched in every corner. A sudden flutter of wings catches your attention; a mechanical messenger pigeon lands near you, a note gripped in its tiny metallic talons. A quick scan of the message, and it's clear: an urgent summons from the enigmatic Clockwork Guildmaster, a call to action that your many voices are eager to answer."""
+
+    def __init__(
+        self,
+        events: EventBus = None,
+        backend: LlmBackend = None,
+        store: Optional[GameStore] = None,
+        story_entries: Optional[Iterable[StoryEntry]] = None,
+        initial_prompts: Optional[InitialPromptPool] = None,
+        image_cache: Optional[ImageCache] = None,
+    ):
+        self.events = events or EventBus()
+        self.backend = backend or ScheduledBackend(
+            create_llm_backend(), create_scheduler(), 'default'
+        )
+        self.store = store
         initial_entry = StoryEntry(
             story_action='',
             # narration_result="You are a middle aged man in downtown Chicago, 1910. You're in a steak restaurant talking to the waiter as you just sat down.",
             # narration_result="You are a quirky time travelling inventor with a handlebar mustache and a knack for mischievous inventions. Blinking your eyes open, you realize you have accidentally landed in the year 1875, right in the heart of a bustling Wild West town. Dusty roads, saloons, and cowboys on horseback surround you, while the sound of piano music drifts through the air.",
-            narration_result=
-            """Welcome, brave Esther, to the sprawling city of Gearlock, a symphony of cogwheel and steam where airships drift through the sooty skies and giant gearworks define the horizon. Here, a bird's-eye view is a literal commodity you possess, becoming as sparrows or falcons at will. Time isn't a river but a swirling eddy for you, bendable and controllable. The diverse, lively chatter of your "Twitch" keeps your world kaleidoscopic, pushing and pulling you through the cacophonic rhythm of your dual existence. As you walk through the vibrant brass streets, your skilled eyes see the intricate beauty of life sketched in every corner. A sudden flutter of wings catches your attention; a mechanical messenger pigeon lands near you, a note gripped in its tiny metallic talons. A quick scan of the message, and it's clear: an urgent summons from the enigmatic Clockwork Guildmaster, a call to action that your many voices are eager to answer."""
+            narration_result=self.default_initial_narration,
         )
-        self.past_story_entries = [
-            initial_entry
-        ]
-        self.generate_image_task = asyncio.create_task(self._generate_narration_image(initial_entry))
+        self.past_story_entries = self._new_history()
+        # Resume the stored story
+        self.past_story_entries.extend(story_entries or ())
+        if not self.past_story_entries:
+            self.past_story_entries.append(initial_entry)
+            if self.store:
+                self.store.put_story_entry(0, initial_entry)
+        # Bumped on every change to past_story_entries, used for HTTP caching. Starts
+        # from the clock in microseconds, so a restarted process never repeats a
+        # version served by an earlier one for a different story
+        self.version = time.time_ns() // 1000
+        self.generation = 0  # Bumped when the story restarts
+        self.context = ContextWindow(
+            self._summarize_story,
+            token_budget=config.context_token_budget,
+            keep_last_turns=config.context_keep_last_turns,
+        )
+        self.initial_prompts = initial_prompts or InitialPromptPool(
+            self.construct_initial_prompt,
+            path=config.initial_prompt_pool_path,
+            size=config.initial_prompt_pool_size,
+            fallback=self.default_initial_narration,
+        )
+        self.image_cache = image_cache or ImageCache(
+            config.image_cache_dir, max_bytes=config.image_cache_max_mb * 2**20
+        )
+        self.images = ImagePipeline(
+            workers=config.image_workers, max_pending=config.image_queue_size
+        )
+        # Consecutive scenes often get near-identical captions, reuse their results
+        self.caption_cache: SemanticCache[str] = SemanticCache(
+            config.caption_cache_threshold, max_entries=config.semantic_cache_size
+        )
+        self.image_url_cache: SemanticCache[str] = SemanticCache(
+            config.image_reuse_threshold, max_entries=config.semantic_cache_size
+        )
+        self.generate_image_task = None
+        self.warmed_up = False
+
+    @property
+    def position(self) -> Tuple[int, int]:
+        """
+        Identifies the committed story the next prompt continues. Unlike
+        version, it doesn't change when an image is filled in.
+        """
+        return self.generation, len(self.past_story_entries)
+
+    @staticmethod
+    def _new_history() -> StoryHistory:
+        return StoryHistory(config.story_hot_entries, directory=config.story_spill_dir)
+
+    def warm_up(self):
+        """
+        Starts the paid background work deferred at startup, once there are
+        viewers: the image of the current scene and the pool of openings.
+        """
+        if self.warmed_up:
+            return
+        self.warmed_up = True
+        self.initial_prompts.refill()
+        last_entry = self.past_story_entries[-1]
+        if not last_entry.narration_image_url:
+            self.generate_image_task = self._schedule_narration_image(last_entry)
 
-    def construct_initial_prompt(self):
-        """Not used
-        construct initial prompt for story generation"""
+    async def construct_initial_prompt(self):
+        """Construct initial prompt for story generation, used to fill the initial prompt pool"""
         # rules = """Create a writing prompt to start an RPG text adventure game.  Adhere to the following rules:
         #             1. The story should take place in Baldur's Gate from Dungeons and Dragons' Forgotten Realms.
         #             2  You should describe the player's characteristics, where they are, what time period they are in, and what surrounds them.
@@ -44,15 +129,12 @@ class StoryGenerator:
         messages = [{ 'role': 'user',
                 'content': rules}]
 
-        response = openai.ChatCompletion.create(
-            model='gpt-3.5-turbo-16k',
-            messages = messages,
-        )
-        initial_prompt = response['choices'][0]['message']['content']
-        print('generated initial prompt')
+        initial_prompt = await self.backend.chat(messages, task='initial_prompt')
+        logger.debug('Generated initial prompt')
         return initial_prompt
 
-    def construct_prompt_messages(self, story_action: str):
+    @metrics.profile
+    def construct_prompt_messages(self, story_action: str, record: bool = True):
         # === ChatCompletions API reference ===
         # system: tells ChatGPT what it's role is/the context of its responses
         # assistant: pseudo-history of messages from openai model
@@ -84,79 +166,203 @@ class StoryGenerator:
                             Start Game.""",
             },
         ]
-        for story_entry in self.past_story_entries:
-            if story_entry.story_action:
-                messages += [{'role': 'user', 'content': story_entry.story_action}]
-            if story_entry.narration_result:
-                messages += [
-                    {
-                        'role': 'assistant',
-                        'content': story_entry.narration_result,
-                    }
-                ]
-        messages.append({'role': 'user', 'content': story_action})
-        return messages
-
-    async def generate_next_story_narration(self, story_action: str) -> StoryEntry:
-        entry = await self._generate_next_story_narration(story_action)
-        if self.generate_image_task:
-            await self.generate_image_task
-            self.generate_image_task = asyncio.create_task(self._generate_narration_image(entry))
-        return entry
-
-    @sync_to_async
-    def _generate_next_story_narration(self, story_action: str) -> StoryEntry:
-        """Generates the continuation of the story given a user action"""
-        response = openai.ChatCompletion.create(
-            model='gpt-3.5-turbo-16k',
-            messages=self.construct_prompt_messages(story_action),
+        return self.context.build_messages(
+            messages, self.past_story_entries, story_action, record=record
         )
-        next_narration = response['choices'][0]['message']['content']
-        entry = StoryEntry(story_action=story_action, narration_result=next_narration)
+
+    async def generate_next_story_narration(
+        self,
+        story_action: str,
+        on_chunk: Optional[Callable[[str], Awaitable[None]]] = None,
+        narration: Optional[str] = None,
+    ) -> StoryEntry:
+        """
+        Generates and commits the continuation of the story given a user action.
+
+        Args:
+            story_action: The action the main character takes.
+            on_chunk: Called with each sentence-aligned chunk of the narration
+                as soon as it has been streamed from the LLM.
+            narration: An already generated narration (ie. speculated during
+                the vote) to commit instead of calling the LLM.
+
+        Returns:
+            The new story entry.
+        """
+        messages = self.construct_prompt_messages(story_action)
+        index = len(self.past_story_entries)
+        self.events.publish('narration_started', index=index, story_action=story_action)
+        parts = []
+        start = time.perf_counter()
+
+        async def tokens():
+            if narration is not None:
+                stream = _iter_once(narration)
+            else:
+                stream = self._stream_next_story_narration(messages)
+            async for token in stream:
+                parts.append(token)
+                yield token
+
+        async for chunk in iter_sentence_chunks(
+            tokens(), self.max_chunk_len, min_len=self.min_chunk_len
+        ):
+            self.events.publish('narration_chunk', index=index, text=chunk)
+            if on_chunk:
+                await on_chunk(chunk)
+        if narration is None:
+            metrics.narration_seconds.observe(time.perf_counter() - start)
+
+        entry = StoryEntry(story_action=story_action, narration_result=''.join(parts))
         self.past_story_entries.append(entry)
+        self.version += 1
+        if self.store:
+            self.store.put_story_entry(len(self.past_story_entries) - 1, entry)
+        self.events.publish(
+            'narration_appended',
+            index=len(self.past_story_entries) - 1,
+            entry=entry.model_dump(),
+        )
+        self.context.schedule_summary_update(self.past_story_entries)
+        # Don't wait for the previous image, narration must not queue behind it
+        self.generate_image_task = self._schedule_narration_image(entry)
         return entry
 
-    @sync_to_async
+    async def speculate_narration(self, story_action: str) -> str:
+        """
+        Generates the continuation of the story for an action without
+        committing it to the story.
+        """
+        messages = self.construct_prompt_messages(story_action, record=False)
+        return await self.backend.chat(messages, task='speculation')
+
+    def _stream_next_story_narration(self, messages: list) -> AsyncIterator[str]:
+        """Streams the tokens of the continuation of the story"""
+        return self.backend.stream_chat(messages, task='narration')
+
+    async def _summarize_story(self, summary: str, story_entries: List[StoryEntry]) -> str:
+        """Extends the rolling story summary with the given story entries"""
+        messages = [{'role': 'user', 'content': 'Write a story.'}]
+        if summary:
+            messages.append({'role': 'assistant', 'content': summary})
+        for story_entry in story_entries:
+            messages += story_entry_messages(story_entry)
+        messages.append(
+            {
+                'role': 'user',
+                'content': f'Summarize the story so far in at most {config.context_summary_max_words} words. Keep the characters, places, items and unresolved goals that matter for continuing it.',
+            }
+        )
+        return await self.backend.chat(messages, task='summary')
+
+    def entry_json(self, index: int) -> bytes:
+        """
+        Returns the serialized JSON of a story entry.
+
+        Args:
+            index: Position of the entry in past_story_entries.
+        """
+        return self.past_story_entries.entry_json(index)
+
+    def _schedule_narration_image(self, story_entry: StoryEntry) -> asyncio.Future:
+        """Queues generating the image of a story entry and publishes it once ready"""
+        index = len(self.past_story_entries) - 1
+        entries = self.past_story_entries
+
+        async def run():
+            with suppress(Exception):  # Already logged
+                await self._generate_narration_image(story_entry, index)
+            # Skip if the story was reset in the meantime
+            if self.past_story_entries is entries and story_entry.narration_image_url:
+                entries.set_image_url(index, story_entry.narration_image_url)
+                self.version += 1
+                if self.store:
+                    self.store.put_story_entry(index, story_entry)
+                self.events.publish(
+                    'image_updated', index=index, url=story_entry.narration_image_url
+                )
+
+        return self.images.submit(run)
+
     @log_exceptions
-    def _generate_narration_image(self, story_entry: StoryEntry):
+    async def _generate_narration_image(self, story_entry: StoryEntry, index: int):
         """Populate the narration_image_url of the provided story entry using OpenAI image API"""
         logger.debug('Generating image caption...')
-        story_prefix = self.past_story_entries[0].narration_result[:500] + '...\n'
-        if len(self.past_story_entries) == 1:
-            story_prefix = ''
-        story_summary = story_prefix + self.past_story_entries[-1].narration_result
-        image_caption = openai.ChatCompletion.create(
-            model='gpt-3.5-turbo',
-            messages=[
-                {'role': 'user', 'content': 'Write a story.'},
-                {'role': 'assistant', 'content': story_summary},
-                {'role': 'user', 'content': 'Think of an image that depicts the world of this story, focusing on the most recent event. Write a caption of this image (ie. a series of fragment descriptors). The sentence format and length should be similar to this example: "Cyberpunk digital art of a neon-lit city with a samurai figure, highlighting the contrast between traditional and futuristic".'}
-            ],
-        )['choices'][0]['message']['content']
+        story_prefix = ''
+        if index > 0:
+            story_prefix = self.past_story_entries[0].narration_result[:500] + '...\n'
+        story_summary = story_prefix + story_entry.narration_result
+        image_caption = self.caption_cache.get(story_entry.narration_result)
+        if image_caption is None:
+            start = time.monotonic()
+            image_caption = await self.backend.chat(
+                task='caption',
+                messages=[
+                    {'role': 'user', 'content': 'Write a story.'},
+                    {'role': 'assistant', 'content': story_summary},
+                    {'role': 'user', 'content': 'Think of an image that depicts the world of this story, focusing on the most recent event. Write a caption of this image (ie. a series of fragment descriptors). The sentence format and length should be similar to this example: "Cyberpunk digital art of a neon-lit city with a samurai figure, highlighting the contrast between traditional and futuristic".'}
+                ],
+            )
+            metrics.caption_seconds.observe(time.monotonic() - start)
+            self.caption_cache.put(
+                story_entry.narration_result, image_caption, time.monotonic() - start
+            )
         logger.info('Generated image caption: {}', image_caption)
-        logger.debug('Generating image...')
-        image_url = openai.Image.create(
-            prompt=image_caption,
-            n=1,
-            size="1024x1024"
-        )['data'][0]['url']
-        logger.info('Generated image: {}', image_url)
+        image_url = self.image_url_cache.get(image_caption)
+        if image_url is not None and not self.image_cache.path(image_url.rsplit('/', 1)[-1]):
+            image_url = None  # Evicted from disk since
+        if image_url is not None:
+            stats = self.image_url_cache.stats()
+            logger.info(
+                'Reusing the image of a similar caption ({:.0%} hit rate, {:.1f}s saved)',
+                stats['hit_rate'],
+                stats['saved_seconds'],
+            )
+        else:
+            logger.debug('Generating image...')
+            start = time.monotonic()
+            image_url = await self.backend.create_image(image_caption, size='1024x1024')
+            metrics.image_seconds.observe(time.monotonic() - start)
+            logger.info('Generated image: {}', image_url)
+            import aiohttp  # Imported on first use, like by the image cache
+
+            try:
+                image_url = await self.image_cache.store(image_url)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                logger.warning('Failed to cache image, linking the original ({!r})', e)
+            else:
+                # Only images on disk are reused, OpenAI links expire
+                self.image_url_cache.put(image_caption, image_url, time.monotonic() - start)
         story_entry.narration_image_url = image_url
 
-    @sync_to_async
-    def generate_image_prompt(self):
+    async def generate_image_prompt(self):
         """Generates a prompt for DALL-E based on the current scene"""
         # Use the last narration result as the scene description
         scene_description = self.past_story_entries[-1].narration_result
         return scene_description
 
-    def reset(self):
+    async def reset(self):
+        """Restarts the story from a pre-generated opening without waiting on the LLM"""
         initial_entry = StoryEntry(
             story_action='',
             # narration_result="You are a middle aged man in downtown Chicago, 1910. You're in a steak restaurant talking to the waiter as you just sat down.",
             # narration_result="You are a quirky time travelling inventor with a handlebar mustache and a knack for mischievous inventions. Blinking your eyes open, you realize you have accidentally landed in the year 1875, right in the heart of a bustling Wild West town. Dusty roads, saloons, and cowboys on horseback surround you, while the sound of piano music drifts through the air.",
             # narration_result="""In the heart of the iron-clad city of Gearford, within the cloud-shrouded aeries of the Cog Tower, you, Esther, find solace among the thrumming machinations and whistling steam pipes, your fingers dancing across the canvas and keyboard alike. From the corner of your eye, you witness the blinking gears of your ornithopter clock, its rhythmic tick-tocking a constant reminder of your temporal prowess. Yet, the whispering voices in your mind, your loyal Twitch, sing in discordant harmony, guiding, prodding, or sometimes even commanding you. As you shape-shift into a shimmering bird and take flight, the metropolis sprawls beneath you, a mechanical marvel of brass and steam. Below, in the twisting alleyways, you catch sight of a frantic messenger being accosted by clockwork constables, his desperate eyes seemingly pleading for your intervention. It seems that Gearford, once again, requires the touch of your wing and the turn of your gear."""
-            narration_result= self.construct_initial_prompt(),
+            narration_result=self.initial_prompts.take(),
         )
-        self.past_story_entries = [initial_entry]
-        self.generate_image_task = asyncio.create_task(self._generate_narration_image(initial_entry))
+        self.images.clear()  # Images of the old story are no longer needed
+        # The old history and its file are dropped once background work is done with it
+        self.past_story_entries = self._new_history()
+        self.past_story_entries.append(initial_entry)
+        self.context.reset()
+        self.version += 1
+        self.generation += 1
+        if self.store:
+            self.store.reset_story()
+            self.store.put_story_entry(0, initial_entry)
+        self.events.publish('story_reset', entries=[initial_entry.model_dump()])
+        self.generate_image_task = self._schedule_narration_image(initial_entry)
+
+
+async def _iter_once(text: str) -> AsyncIterator[str]:
+    yield text
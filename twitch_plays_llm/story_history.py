@@ -0,0 +1,184 @@
+import mmap
+import tempfile
+import threading
+
+from array import array
+from collections import deque
+from collections.abc import Sequence
+from typing import Deque, Iterable, List, Optional, Union
+
+from .models import StoryEntry
+
+
+class _Record:
+    """A story entry held in memory, with its serialized form cached"""
+
+    __slots__ = ('story_action', 'narration_result', 'narration_image_url', 'json')
+
+    def __init__(self, entry: StoryEntry):
+        self.story_action = entry.story_action
+        self.narration_result = entry.narration_result
+        self.narration_image_url = entry.narration_image_url
+        self.json: Optional[bytes] = None
+
+    def entry(self) -> StoryEntry:
+        return StoryEntry(
+            story_action=self.story_action,
+            narration_result=self.narration_result,
+            narration_image_url=self.narration_image_url,
+        )
+
+    def to_json(self) -> bytes:
+        if self.json is None:
+            self.json = self.entry().model_dump_json().encode()
+        return self.json
+
+
+class StoryHistory(Sequence):
+    """
+    The story entries of a game, with memory use independent of the story length.
+
+    Only the last hot_entries entries and the opening (needed for every image
+    caption) are kept in memory, as slotted records. Older entries are spilled
+    as JSON lines to an append-only temporary file, located through an offset
+    index of 12 bytes per entry. Spilled entries are read back through a
+    memory map, and their JSON is served as a view into it without copying.
+
+    Entries are read as new StoryEntry objects, so changes must go through
+    set_image_url. The file only caches entries, the GameStore keeps them.
+    The history is appended to on the event loop and read by the sync API
+    endpoints on the threadpool, so every access holds a lock.
+
+    Args:
+        hot_entries: Number of most recent entries kept in memory.
+        directory: Directory of the spill file, the system default if empty.
+    """
+
+    def __init__(self, hot_entries: int, directory: str = ''):
+        self.hot_entries = max(1, hot_entries)
+        self.directory = directory or None
+        self.first: Optional[_Record] = None
+        self.hot: Deque[_Record] = deque()
+        self.spilled = 0  # Number of leading entries spilled to the file
+        self.offsets = array('Q')  # Index -> position of the entry JSON in the file
+        self.lengths = array('I')
+        self.file = None
+        self.size = 0  # Bytes written to the file
+        self._view: Optional[memoryview] = None  # Map of the first _mapped_size bytes
+        self._mapped_size = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.spilled + len(self.hot)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[StoryEntry, List[StoryEntry]]:
+        with self._lock:
+            if isinstance(index, slice):
+                return [self[i] for i in range(*index.indices(len(self)))]
+            index = self._check_index(index)
+            record = self._record(index)
+            if record is not None:
+                return record.entry()
+            return StoryEntry.model_validate_json(bytes(self._spilled_json(index)))
+
+    @property
+    def tail_start(self) -> int:
+        """Index of the oldest entry held in memory, besides the opening"""
+        return self.spilled
+
+    def append(self, entry: StoryEntry):
+        record = _Record(entry)
+        with self._lock:
+            if self.first is None:
+                self.first = record
+            self.hot.append(record)
+            while len(self.hot) > self.hot_entries:
+                self._spill(self.hot.popleft())
+
+    def extend(self, entries: Iterable[StoryEntry]):
+        for entry in entries:
+            self.append(entry)
+
+    def set_image_url(self, index: int, url: str):
+        """Fills in the image of an entry, appending a new version if it was spilled"""
+        with self._lock:
+            index = self._check_index(index)
+            record = self._record(index)
+            if index < self.spilled:
+                entry = self[index] if record is None else record.entry()
+                entry.narration_image_url = url
+                self._write(index, entry.model_dump_json().encode())
+            if record is not None:
+                record.narration_image_url = url
+                record.json = None
+
+    def entry_json(self, index: int) -> bytes:
+        """Returns the serialized JSON of an entry"""
+        return bytes(self.json_slice(index, index + 1)[0])
+
+    def json_slice(self, start: int, stop: int) -> List[Union[bytes, memoryview]]:
+        """
+        Returns the serialized JSON of the entries in the given range. Spilled
+        entries are views into the memory map, valid as long as they are referenced.
+        """
+        with self._lock:
+            start, stop, _ = slice(start, stop).indices(len(self))
+            result = []
+            for index in range(start, stop):
+                record = self._record(index)
+                result.append(
+                    record.to_json() if record is not None else self._spilled_json(index)
+                )
+            return result
+
+    def close(self):
+        """Deletes the spill file. Views handed out before stay readable"""
+        with self._lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self._view = None
+            self._mapped_size = 0
+
+    def _check_index(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('story entry index out of range')
+        return index
+
+    def _record(self, index: int) -> Optional[_Record]:
+        if index >= self.spilled:
+            return self.hot[index - self.spilled]
+        if index == 0:
+            return self.first
+        return None
+
+    def _spill(self, record: _Record):
+        self._write(self.spilled, record.to_json())
+        self.spilled += 1
+
+    def _write(self, index: int, data: bytes):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix='story-', dir=self.directory)
+        self.file.write(data + b'\n')
+        if index == len(self.offsets):
+            self.offsets.append(self.size)
+            self.lengths.append(len(data))
+        else:
+            # Older versions of the entry are left behind in the file
+            self.offsets[index] = self.size
+            self.lengths[index] = len(data)
+        self.size += len(data) + 1
+
+    def _spilled_json(self, index: int) -> memoryview:
+        start = self.offsets[index]
+        end = start + self.lengths[index]
+        if end > self._mapped_size:
+            # Remap to cover the entries appended since. The old map is closed
+            # once nothing references it anymore
+            self.file.flush()
+            self._view = memoryview(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ))
+            self._mapped_size = self.size
+        return self._view[start:end]
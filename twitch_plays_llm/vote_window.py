@@ -0,0 +1,102 @@
+import time
+
+from collections import OrderedDict
+from typing import Optional
+
+
+class ActiveChatters:
+    """
+    Users seen in chat within the last window seconds.
+
+    Sightings are kept oldest first, so counting only drops stale users from
+    the front, in O(1) amortized time per sighting.
+
+    Args:
+        window: Seconds a user stays active after their last message.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self.last_seen: 'OrderedDict[str, float]' = OrderedDict()
+
+    def see(self, user: str, now: Optional[float] = None):
+        self.last_seen[user] = time.time() if now is None else now
+        self.last_seen.move_to_end(user)
+
+    def count(self, now: Optional[float] = None) -> int:
+        cutoff = (time.time() if now is None else now) - self.window
+        while self.last_seen and next(iter(self.last_seen.values())) < cutoff:
+            self.last_seen.popitem(last=False)
+        return len(self.last_seen)
+
+
+class VoteWindow:
+    """
+    Decides when the vote of a round closes.
+
+    The vote stays open for at least min_seconds and at most max_seconds.
+    In between it closes as soon as:
+
+    - the leader can't be overtaken, even if every active chatter who hasn't
+      voted yet votes for the runner-up,
+    - at least a quorum fraction of the active chatters voted, or
+    - no vote came in for idle_seconds.
+
+    Remaining votes are counted with a weight of 1, and votes moving between
+    proposals are not anticipated; mods can still end the vote themselves.
+
+    Args:
+        min_seconds: Minimum duration of the vote.
+        max_seconds: Maximum duration of the vote.
+        quorum: Fraction of the active chatters that closes the vote, above 1
+            to disable.
+        idle_seconds: Seconds without votes that close the vote, 0 to disable.
+    """
+
+    def __init__(self, min_seconds: float, max_seconds: float, quorum: float, idle_seconds: float):
+        self.min_seconds = min(min_seconds, max_seconds)
+        self.max_seconds = max_seconds
+        self.quorum = quorum
+        self.idle_seconds = idle_seconds
+        self.started = 0.0
+        self.last_vote: Optional[float] = None
+
+    def start(self, now: Optional[float] = None):
+        self.started = time.time() if now is None else now
+        self.last_vote = None
+
+    def record_vote(self, now: Optional[float] = None):
+        self.last_vote = time.time() if now is None else now
+
+    def is_decided(self, leader_votes: int, runner_up_votes: int, voters: int, active: int) -> bool:
+        """
+        Whether the outcome of the vote can't change anymore, or enough of
+        the chat took part.
+
+        Args:
+            leader_votes: Votes of the leading proposal.
+            runner_up_votes: Votes of the second proposal, 0 if there is none.
+            voters: Number of users who voted this round.
+            active: Number of active chatters.
+        """
+        if voters == 0:
+            return False
+        active = max(active, voters)
+        if leader_votes - runner_up_votes > active - voters:
+            return True
+        return voters >= self.quorum * active
+
+    def deadline(self, decided: bool) -> float:
+        """
+        Returns the time at which the vote closes, given what is known now.
+
+        Args:
+            decided: Result of is_decided for the current votes.
+        """
+        end = self.started + self.max_seconds
+        earliest = self.started + self.min_seconds
+        if decided:
+            return earliest
+        if self.idle_seconds > 0 and self.last_vote is not None:
+            end = min(end, max(earliest, self.last_vote + self.idle_seconds))
+        return end